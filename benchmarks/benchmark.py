@@ -0,0 +1,296 @@
+"""Benchmarks embedding text, adding to the index and searching it. E.g.
+
+    python benchmarks/benchmark.py --output results.json
+
+Everything runs offline: abstracts are synthetic, and, unless --model is given, text is embedded
+with a tiny, randomly initialized BERT model built on the fly. Absolute numbers therefore say
+little about production, but they are reproducible, so comparing them across commits on the same
+machine shows regressions. Pass --baseline to report the change from an earlier run's results.
+"""
+
+import json
+import os
+import platform
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import faiss
+import numpy as np
+import torch
+import transformers
+import typer
+from transformers import BertConfig, BertModel, BertTokenizerFast
+
+from semantic_search.common.util import (
+    add_to_faiss_index,
+    encode_by_length,
+    setup_faiss_index,
+    setup_model_and_tokenizer,
+)
+
+# Words the synthetic abstracts are made of, which make up the vocabulary of the tiny model.
+WORDS = (
+    "the of and in to a with by is that for was were are as on from cell cells protein proteins "
+    "gene genes expression activity signaling pathway receptor binding kinase phosphorylation "
+    "regulation response mice human patients tumor cancer growth factor transcription mutant "
+    "mutation domain complex levels increased decreased reduced induced mediated required "
+    "function role mechanism results suggest show demonstrate analysis study data model "
+    "inhibition inhibitor treatment disease clinical specific novel significantly observed "
+    "identified associated interaction membrane nuclear mitochondrial dna rna sequence structure"
+).split()
+# The range of the number of words in each kind of text, e.g. titles are short and abstracts long.
+LENGTHS = {"title": (8, 24), "abstract": (150, 300)}
+# The special tokens of a BERT vocabulary.
+SPECIAL_TOKENS = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+
+
+def synthetic_texts(num_texts: int, lengths: str, seed: int = 13) -> List[str]:
+    """Returns `num_texts` texts of random words, with a number of words drawn from the range
+    `LENGTHS[lengths]` or, if `lengths` is "mixed", from either range with equal probability.
+    """
+    rng = np.random.default_rng(seed)
+    texts = []
+    for _ in range(num_texts):
+        kind = rng.choice(list(LENGTHS)) if lengths == "mixed" else lengths
+        num_words = rng.integers(*LENGTHS[kind], endpoint=True)
+        texts.append(" ".join(rng.choice(WORDS, size=num_words)) + ".")
+    return texts
+
+
+def synthetic_vectors(num_vectors: int, embedding_dim: int, seed: int = 13) -> np.ndarray:
+    return np.random.default_rng(seed).standard_normal((num_vectors, embedding_dim), "float32")
+
+
+def save_tiny_model(directory: Path, seed: int = 13) -> None:
+    """Saves a tiny, randomly initialized BERT model, whose vocabulary covers `WORDS`, and its
+    tokenizer to `directory`.
+    """
+    vocab_file = directory / "vocab.txt"
+    vocab_file.write_text("\n".join(SPECIAL_TOKENS + [".", *WORDS]) + "\n")
+    BertTokenizerFast(vocab_file=str(vocab_file)).save_pretrained(str(directory))
+    torch.manual_seed(seed)
+    config = BertConfig(
+        vocab_size=len(SPECIAL_TOKENS) + 1 + len(WORDS),
+        hidden_size=128,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=512,
+    )
+    BertModel(config).save_pretrained(str(directory))
+
+
+def timings(func: Callable[[], Any], repeats: int) -> List[float]:
+    """Returns the seconds taken by each of `repeats` calls to `func`, after one warm-up call."""
+    func()
+    seconds = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def latency_ms(seconds: List[float]) -> Dict[str, float]:
+    return {
+        "latency_ms_median": float(np.median(seconds) * 1000),
+        "latency_ms_p95": float(np.percentile(seconds, 95) * 1000),
+    }
+
+
+def benchmark_encode(
+    model_path: str, num_texts: int, batch_sizes: List[int], max_length: int, repeats: int
+) -> Iterator[Dict[str, Any]]:
+    """Measures the throughput of `encode_by_length` for each kind of text and batch size."""
+    tokenizer, model = setup_model_and_tokenizer(model_path)
+    for lengths in ("title", "abstract", "mixed"):
+        texts = synthetic_texts(num_texts, lengths)
+        num_tokens = sum(
+            len(ids)
+            for ids in tokenizer(texts, truncation=True, max_length=max_length)["input_ids"]
+        )
+        for batch_size in batch_sizes:
+            seconds = np.median(
+                timings(
+                    lambda: encode_by_length(
+                        texts, tokenizer, model, max_length=max_length, max_batch_size=batch_size
+                    ),
+                    repeats,
+                )
+            )
+            yield {
+                "benchmark": "encode",
+                "lengths": lengths,
+                "num_texts": num_texts,
+                "batch_size": batch_size,
+                "texts_per_s": num_texts / seconds,
+                "tokens_per_s": num_tokens / seconds,
+            }
+
+
+def benchmark_index(
+    index_factory: str,
+    index_sizes: List[int],
+    embedding_dim: int,
+    add_batch_size: int,
+    top_ks: List[int],
+    num_queries: int,
+) -> Iterator[Dict[str, Any]]:
+    """Measures the rate at which `add_to_faiss_index` adds vectors to an index of each size, and
+    the latency of searching it one query at a time, as the service does, for each top_k.
+    """
+    queries = synthetic_vectors(num_queries, embedding_dim, seed=1)
+    queries /= np.linalg.norm(queries, axis=-1, keepdims=True)
+    for index_size in index_sizes:
+        vectors = synthetic_vectors(index_size, embedding_dim)
+        index = setup_faiss_index(embedding_dim, index_factory)
+        index.train(vectors)
+        start = time.perf_counter()
+        for i in range(0, index_size, add_batch_size):
+            add_to_faiss_index(
+                list(range(i, min(i + add_batch_size, index_size))),
+                vectors[i : i + add_batch_size],
+                index,
+            )
+        yield {
+            "benchmark": "index_add",
+            "index_factory": index_factory,
+            "index_size": index_size,
+            "batch_size": add_batch_size,
+            "vectors_per_s": index_size / (time.perf_counter() - start),
+        }
+        for top_k in top_ks:
+            seconds = []
+            for query in queries:
+                start = time.perf_counter()
+                index.search(query[None, :], top_k)
+                seconds.append(time.perf_counter() - start)
+            yield {
+                "benchmark": "index_search",
+                "index_factory": index_factory,
+                "index_size": index_size,
+                "top_k": top_k,
+                **latency_ms(seconds),
+            }
+
+
+def benchmark_search_request(
+    model_path: str, num_documents: List[int], max_length: int, repeats: int
+) -> Iterator[Dict[str, Any]]:
+    """Measures the latency of the /search endpoint, with and without `docs_only`, for requests
+    with each number of (already indexed) documents.
+    """
+    # The server reads its settings from the environment when it is imported. Load the model and
+    # index before the server starts, rather than in the background, so that searches succeed.
+    os.environ.update(
+        LOAD_IN_BACKGROUND="false",
+        PRETRAINED_MODEL_NAME_OR_PATH=model_path,
+        MAX_LENGTH=str(max_length),
+        CUDA_DEVICE="-1",
+        EMBEDDING_CACHE_SIZE="0",
+        LOG_LEVEL="WARNING",
+    )
+    from fastapi.testclient import TestClient
+
+    from semantic_search.main import app
+
+    texts = synthetic_texts(max(num_documents), "abstract")
+    documents = [{"uid": str(uid), "text": text} for uid, text in enumerate(texts, start=1)]
+    query = {"uid": "0", "text": synthetic_texts(1, "abstract", seed=1)[0]}
+    with TestClient(app) as client:
+        # Index every document up front, so that only the search itself is timed.
+        response = client.post("/search", json={"query": query, "documents": documents})
+        response.raise_for_status()
+        for num in num_documents:
+            for docs_only in (False, True):
+                request = {
+                    "query": query,
+                    "documents": [{"uid": document["uid"]} for document in documents[:num]],
+                    "docs_only": docs_only,
+                }
+                seconds = timings(
+                    lambda: client.post("/search", json=request).raise_for_status(), repeats
+                )
+                yield {
+                    "benchmark": "search_request",
+                    "num_documents": num,
+                    "docs_only": docs_only,
+                    **latency_ms(seconds),
+                }
+
+
+def _parameters(row: Dict[str, Any]) -> Dict[str, Any]:
+    return {key: value for key, value in row.items() if not isinstance(value, float)}
+
+
+def compare(row: Dict[str, Any], baseline: List[Dict[str, Any]]) -> str:
+    """Returns the change in the first metric of `row` from that of the same benchmark, with the
+    same parameters, in `baseline`, e.g. "texts_per_s +5.2%".
+    """
+    for other in baseline:
+        if _parameters(other) == _parameters(row):
+            metric = next(key for key, value in row.items() if isinstance(value, float))
+            return f"{metric} {(row[metric] / other[metric] - 1) * 100:+.1f}%"
+    return ""
+
+
+def main(
+    model: Optional[str] = typer.Option(
+        None, help="Model to embed text with. Defaults to a tiny, randomly initialized model."
+    ),
+    num_texts: int = typer.Option(256, help="Number of texts to embed."),
+    batch_size: List[int] = typer.Option([1, 8, 32, 64], help="Encoder batch sizes."),
+    max_length: int = typer.Option(384, help="Maximum number of tokens per text."),
+    index_factory: str = typer.Option("Flat", help="faiss.index_factory description of the index."),
+    index_size: List[int] = typer.Option([1000, 10000, 100000], help="Index sizes."),
+    embedding_dim: int = typer.Option(768, help="Dimension of the indexed vectors."),
+    add_batch_size: int = typer.Option(64, help="Number of vectors added to the index at once."),
+    top_k: List[int] = typer.Option([1, 10, 100], help="Numbers of nearest neighbours to search."),
+    num_queries: int = typer.Option(200, help="Number of queries to search the index with."),
+    num_documents: List[int] = typer.Option(
+        [10, 100, 1000], help="Numbers of documents in each /search request."
+    ),
+    repeats: int = typer.Option(5, help="Number of times to repeat each timed run."),
+    output: Optional[Path] = typer.Option(None, help="File to write the results to, as JSON."),
+    baseline: Optional[Path] = typer.Option(
+        None, help="Results of an earlier run to report the change from."
+    ),
+) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        if model is None:
+            save_tiny_model(Path(directory))
+        model_path = model or directory
+        rows = [
+            *benchmark_encode(model_path, num_texts, batch_size, max_length, repeats),
+            *benchmark_index(
+                index_factory, index_size, embedding_dim, add_batch_size, top_k, num_queries
+            ),
+            *benchmark_search_request(model_path, num_documents, max_length, repeats),
+        ]
+
+    baseline_rows = json.loads(baseline.read_text())["results"] if baseline is not None else []
+    for row in rows:
+        change = compare(row, baseline_rows)
+        typer.echo(
+            ", ".join(
+                f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}"
+                for key, value in row.items()
+            )
+            + (f" ({change})" if change else "")
+        )
+    if output is not None:
+        environment = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "torch": torch.__version__,
+            "torch_threads": torch.get_num_threads(),
+            "transformers": transformers.__version__,
+            "faiss": faiss.__version__,
+            "model": model or "tiny",
+        }
+        output.write_text(json.dumps({"environment": environment, "results": rows}, indent=2))
+
+
+if __name__ == "__main__":
+    typer.run(main)
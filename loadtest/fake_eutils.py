@@ -0,0 +1,224 @@
+"""A local stand-in for the NCBI E-utilities efetch endpoint, for load testing the server without
+sending traffic to NCBI. E.g.
+
+    python loadtest/fake_eutils.py serve --port 8081 --latency 0.2 --error-rate 0.01
+
+Then start the server with `EUTILS_BASE_URL=http://localhost:8081/` (and
+`EUTILS_EFETCH_BASENAME=efetch.fcgi`).
+
+No recorded responses ship with this script, so by default every PMID gets a synthetic record.
+Real MEDLINE records can be recorded from the E-utilities once with
+
+    python loadtest/fake_eutils.py record pmids.txt --output pubmed.medline
+
+and replayed by passing the file (or any PubMed export, optionally gzipped) to `serve`, e.g.
+`serve pubmed.medline`. PMIDs missing from these fixtures still get a synthetic record, or, with
+--missing error, the error NCBI returns for PMIDs it doesn't know.
+"""
+
+import email
+import email.policy
+import gzip
+import random
+import re
+import signal
+import threading
+import time
+from enum import Enum
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+import requests  # type: ignore
+import typer
+
+app = typer.Typer(add_completion=False)
+
+# Matches the PMID line that opens each MEDLINE record.
+PMID_LINE = re.compile(r"^PMID- *(\d+)", re.MULTILINE)
+# Words synthetic records are made of.
+WORDS = (
+    "cell protein gene expression signaling pathway receptor binding kinase phosphorylation "
+    "regulation response tumor growth factor transcription mutation domain complex activity "
+    "increased decreased induced mediated required function role mechanism inhibition disease"
+).split()
+# The most PMIDs NCBI accepts in a single efetch request.
+MAX_EFETCH_RETMAX = 10000
+
+
+class Missing(str, Enum):
+    synthesize = "synthesize"
+    error = "error"
+
+
+def iter_medline_records(path: Path) -> Iterator[str]:
+    """Yields the MEDLINE records in `path`, as text."""
+    with gzip.open(path, "rt") if path.suffix == ".gz" else open(path) as f:  # type: ignore
+        # Records are separated by blank lines.
+        for record in re.split(r"\n\s*\n", f.read()):
+            if PMID_LINE.match(record.strip()):
+                yield record.strip()
+
+
+def synthetic_record(pmid: str) -> str:
+    """Returns a MEDLINE record for `pmid` with a random (but, for each PMID, fixed) title and
+    abstract.
+    """
+    rng = random.Random(int(pmid))
+    title = " ".join(rng.choices(WORDS, k=rng.randint(8, 20))).capitalize()
+    abstract = " ".join(rng.choices(WORDS, k=rng.randint(150, 300))).capitalize()
+    return f"PMID- {pmid}\nTI  - {title}.\nAB  - {abstract}."
+
+
+def parse_form(content_type: str, body: bytes) -> Dict[str, str]:
+    """Returns the fields of a form submitted as `content_type` (multipart/form-data, as sent by
+    the server, or application/x-www-form-urlencoded).
+    """
+    if content_type.startswith("multipart/form-data"):
+        message = email.message_from_bytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + body, policy=email.policy.HTTP
+        )
+        fields = {}
+        for part in message.iter_parts():  # type: ignore
+            name = part.get_param("name", header="content-disposition")
+            fields[str(name)] = part.get_payload(decode=True).decode()  # type: ignore
+        return fields
+    return {name: values[-1] for name, values in parse_qs(body.decode()).items()}
+
+
+class EfetchHandler(BaseHTTPRequestHandler):
+    """Answers efetch requests for MEDLINE records, after a random delay of `latency` +/-
+    `jitter` seconds. A fraction `error_rate` of requests fail with `error_status` instead.
+    """
+
+    records: Dict[str, str] = {}
+    missing: Missing = Missing.synthesize
+    latency: float = 0.0
+    jitter: float = 0.0
+    error_rate: float = 0.0
+    error_status: int = 503
+    # Counts of the requests served, by status code.
+    counts: Dict[int, int] = {}
+    counts_lock = threading.Lock()
+
+    def do_GET(self) -> None:
+        self.respond(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self) -> None:
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        form = parse_form(self.headers.get("Content-Type", ""), body)
+        self.respond({name: [value] for name, value in form.items()})
+
+    def respond(self, params: Dict[str, List[str]]) -> None:
+        time.sleep(max(0.0, random.uniform(self.latency - self.jitter, self.latency + self.jitter)))
+        pmids = [pmid for pmid in params.get("id", [""])[-1].split(",") if pmid]
+        if random.random() < self.error_rate:
+            self.send(self.error_status, f"Simulated error for {len(pmids)} PMIDs\n")
+        elif not urlparse(self.path).path.endswith("efetch.fcgi"):
+            self.send(404, "Only efetch.fcgi is supported\n")
+        elif params.get("rettype", [""])[-1] != "medline" or not pmids:
+            self.send(400, "Only rettype=medline requests with ids are supported\n")
+        elif len(pmids) > MAX_EFETCH_RETMAX:
+            self.send(400, f"Too many ids, the maximum is {MAX_EFETCH_RETMAX}\n")
+        else:
+            records = []
+            for pmid in pmids:
+                if pmid in self.records:
+                    records.append(self.records[pmid])
+                elif self.missing == Missing.synthesize and pmid.isdigit():
+                    records.append(synthetic_record(pmid))
+                else:
+                    records.append(
+                        f"id: {pmid} Error occurred: The following PMID is not available"
+                    )
+            self.send(200, "\n" + "\n\n".join(records) + "\n")
+
+    def send(self, status: int, text: str) -> None:
+        body = text.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with self.counts_lock:
+            self.counts[status] = self.counts.get(status, 0) + 1
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+@app.command()
+def serve(
+    fixtures: List[Path] = typer.Argument(None, help="MEDLINE files of records to replay."),
+    host: str = typer.Option("127.0.0.1", help="Host to listen on."),
+    port: int = typer.Option(8081, help="Port to listen on."),
+    latency: float = typer.Option(0.0, help="Mean seconds taken to answer each request."),
+    jitter: float = typer.Option(0.0, help="Maximum seconds the latency varies by either way."),
+    error_rate: float = typer.Option(0.0, help="Fraction of requests that fail."),
+    error_status: int = typer.Option(503, help="Status code of the requests that fail."),
+    missing: Missing = typer.Option(
+        Missing.synthesize, help="How to answer for PMIDs that aren't in the fixtures."
+    ),
+) -> None:
+    """Serves efetch requests for the records in `fixtures`."""
+    records = {
+        PMID_LINE.match(record).group(1): record  # type: ignore
+        for path in fixtures or []
+        for record in iter_medline_records(path)
+    }
+    EfetchHandler.records = records
+    EfetchHandler.missing = missing
+    EfetchHandler.latency = latency
+    EfetchHandler.jitter = jitter
+    EfetchHandler.error_rate = error_rate
+    EfetchHandler.error_status = error_status
+    server = ThreadingHTTPServer((host, port), EfetchHandler)
+    # Stop (and report the counts) when terminated too, e.g. by a script running a load test.
+    signal.signal(
+        signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown, daemon=True).start()
+    )
+    typer.echo(
+        f"Serving {len(records)} recorded records at http://{host}:{port}/efetch.fcgi", err=True
+    )
+    if missing == Missing.synthesize:
+        typer.echo("Synthesizing records for every other PMID", err=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    typer.echo(f"Requests served, by status code: {EfetchHandler.counts}", err=True)
+
+
+@app.command()
+def record(
+    pmids: Path = typer.Argument(..., help="File of PubMed uids, one per line."),
+    output: Path = typer.Option(..., help="MEDLINE file to write the records to."),
+    eutils_base_url: str = typer.Option(
+        "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/", help="Base URL of the E-utilities."
+    ),
+    api_key: Optional[str] = typer.Option(None, help="NCBI E-utilities API key."),
+    batch_size: int = typer.Option(200, help="Number of records to fetch per request."),
+) -> None:
+    """Fetches the MEDLINE records of `pmids` from the E-utilities, to replay with `serve`."""
+    uids = [line.strip() for line in pmids.read_text().splitlines() if line.strip()]
+    with open(output, "w") as f:
+        for i in range(0, len(uids), batch_size):
+            params = {
+                "db": "pubmed",
+                "id": ",".join(uids[i : i + batch_size]),
+                "rettype": "medline",
+                "retmode": "text",
+            }
+            if api_key:
+                params["api_key"] = api_key
+            response = requests.post(f"{eutils_base_url}efetch.fcgi", data=params, timeout=60)
+            response.raise_for_status()
+            f.write(response.text.strip() + "\n\n")
+            # NCBI allows 3 requests a second without an API key.
+            time.sleep(0.34)
+    typer.echo(f"Wrote the records of {len(uids)} PMIDs to {output}")
+
+
+if __name__ == "__main__":
+    app()
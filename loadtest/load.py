@@ -0,0 +1,174 @@
+"""Drives the /search endpoint of a running server with concurrent requests, and reports the
+throughput, latency percentiles and error rate of each kind of request. E.g.
+
+    python loadtest/load.py http://localhost:8000 --concurrency 16 --duration 60
+
+Requests are a mix (see --mix) of:
+
+- "text": a query and documents with their text, which is embedded as is
+- "pmid": a query and documents given as bare PMIDs, whose text is fetched from PubMed
+- "docs_only": as "pmid", but scoring only the given documents
+
+PMIDs are drawn from a pool of --num-pmids uids, so the larger the pool, the fewer documents are
+already indexed. Point the server at `loadtest/fake_eutils.py` rather than NCBI. Load is only sent
+once the server's /health/ready check succeeds.
+"""
+
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import numpy as np
+import requests  # type: ignore
+import typer
+
+KINDS = ("text", "pmid", "docs_only")
+# Words the text of "text" requests is made of.
+WORDS = (
+    "cell protein gene expression signaling pathway receptor binding kinase phosphorylation "
+    "regulation response tumor growth factor transcription mutation domain complex activity "
+    "increased decreased induced mediated required function role mechanism inhibition disease"
+).split()
+
+
+class Result(NamedTuple):
+    kind: str
+    seconds: float
+    # The status code of the response, or None if no response was received.
+    status: Optional[int]
+
+
+def parse_mix(mix: str) -> Dict[str, float]:
+    """Parses a mix of request kinds, e.g. "text=0.5,pmid=0.3,docs_only=0.2"."""
+    weights = {}
+    for entry in mix.split(","):
+        kind, _, weight = entry.partition("=")
+        if kind.strip() not in KINDS:
+            raise typer.BadParameter(f"Unknown kind of request {kind!r}, expected one of {KINDS}")
+        weights[kind.strip()] = float(weight)
+    return weights
+
+
+def make_request(
+    kind: str, rng: random.Random, num_pmids: int, num_documents: int, top_k: int
+) -> Dict[str, Any]:
+    """Returns the body of a random /search request of this `kind`."""
+    pmids = [str(pmid) for pmid in rng.sample(range(1, num_pmids + 1), num_documents + 1)]
+    if kind == "text":
+        texts = [" ".join(rng.choices(WORDS, k=rng.randint(10, 200))) for _ in pmids]
+        query, *documents = [{"uid": pmid, "text": text} for pmid, text in zip(pmids, texts)]
+    else:
+        query, *documents = [{"uid": pmid} for pmid in pmids]
+    return {
+        "query": query,
+        "documents": documents,
+        "top_k": top_k,
+        "docs_only": kind == "docs_only",
+    }
+
+
+def summarize(results: List[Result], elapsed: float) -> Dict[str, Any]:
+    """Returns the number, throughput, latency percentiles and error rate of `results`."""
+    if not results:
+        return {"requests": 0}
+    latencies = np.array([result.seconds for result in results]) * 1000
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    errors = sum(result.status != 200 for result in results)
+    return {
+        "requests": len(results),
+        "throughput_rps": len(results) / elapsed,
+        "latency_ms_p50": float(p50),
+        "latency_ms_p95": float(p95),
+        "latency_ms_p99": float(p99),
+        "error_rate": errors / len(results),
+    }
+
+
+def wait_until_ready(url: str, timeout: float) -> None:
+    """Waits up to `timeout` seconds for the server at `url` to be ready to serve searches, as
+    the server loads its model and index in the background after starting.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(f"{url}/health/ready", timeout=5).status_code == 200:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.5)
+    typer.echo(f"{url} wasn't ready to serve searches after {timeout:.0f}s", err=True)
+    raise typer.Exit(code=1)
+
+
+def main(
+    url: str = typer.Argument("http://localhost:8000", help="URL of the server."),
+    concurrency: int = typer.Option(8, help="Number of requests in flight at once."),
+    duration: float = typer.Option(30.0, help="Seconds to send requests for."),
+    mix: str = typer.Option(
+        "text=0.4,pmid=0.4,docs_only=0.2", help="Fraction of requests of each kind."
+    ),
+    num_pmids: int = typer.Option(100000, help="Number of distinct PMIDs to draw from."),
+    num_documents: int = typer.Option(10, help="Number of documents in each request."),
+    top_k: int = typer.Option(10, help="top_k of each request."),
+    timeout: float = typer.Option(60.0, help="Seconds to wait for each response."),
+    seed: int = typer.Option(13, help="Seed of the random requests."),
+    output: Optional[Path] = typer.Option(None, help="File to write the report to, as JSON."),
+    ready_timeout: float = typer.Option(
+        300.0, help="Seconds to wait for the server to be ready before sending load."
+    ),
+) -> None:
+    weights = parse_mix(mix)
+    wait_until_ready(url, ready_timeout)
+    results: List[Result] = []
+    results_lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(worker_seed: int) -> None:
+        rng = random.Random(worker_seed)
+        session = requests.Session()
+        while time.monotonic() < deadline:
+            kind = rng.choices(list(weights), weights=list(weights.values()))[0]
+            body = make_request(kind, rng, num_pmids, num_documents, top_k)
+            start = time.perf_counter()
+            try:
+                status = session.post(f"{url}/search", json=body, timeout=timeout).status_code
+            except requests.exceptions.RequestException:
+                status = None
+            with results_lock:
+                results.append(Result(kind, time.perf_counter() - start, status))
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(worker, seed + i) for i in range(concurrency)]:
+            future.result()
+    elapsed = time.monotonic() - start
+
+    report = {"all": summarize(results, elapsed)}
+    for kind in weights:
+        report[kind] = summarize([result for result in results if result.kind == kind], elapsed)
+    statuses: Dict[str, int] = {}
+    for result in results:
+        statuses[str(result.status)] = statuses.get(str(result.status), 0) + 1
+
+    typer.echo(f"{len(results)} requests in {elapsed:.1f}s, by status: {statuses}")
+    typer.echo(
+        f"{'kind':<12}{'requests':>10}{'req/s':>10}{'p50 (ms)':>11}{'p95 (ms)':>11}"
+        f"{'p99 (ms)':>11}{'errors':>9}"
+    )
+    for kind, summary in report.items():
+        if summary["requests"]:
+            typer.echo(
+                f"{kind:<12}{summary['requests']:>10}{summary['throughput_rps']:>10.1f}"
+                f"{summary['latency_ms_p50']:>11.1f}{summary['latency_ms_p95']:>11.1f}"
+                f"{summary['latency_ms_p99']:>11.1f}{summary['error_rate']:>9.1%}"
+            )
+    if output is not None:
+        output.write_text(json.dumps({**report, "statuses": statuses}, indent=2))
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,163 @@
+"""Reports the recall and latency of approximate nearest neighbour indices, relative to exact
+search with a flat index. E.g.
+
+    python scripts/ann_report.py --index-factory HNSW32 --index-factory "IVF1024,Flat"
+
+Vectors can also be compressed, e.g. --index-factory SQ8 or --index-factory "PQ192,RFlat", to
+compare the memory used per vector with the recall lost. By default, a synthetic dataset of
+clustered vectors is used. Pass --snapshot to use the vectors of an index snapshot (built with
+the default, flat index) instead.
+"""
+
+import json
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+import faiss
+import numpy as np
+import typer
+
+from semantic_search.common.util import (
+    add_to_faiss_index,
+    get_faiss_index_vectors,
+    set_faiss_search_parameters,
+    setup_faiss_index,
+)
+
+# The search-time parameter swept for each type of index.
+SEARCH_PARAMETERS = {"HNSW": "efSearch", "IVF": "nprobe"}
+
+
+def synthetic_vectors(
+    num_vectors: int,
+    embedding_dim: int,
+    num_clusters: int = 1000,
+    spread: float = 2.0,
+    seed: int = 13,
+) -> np.ndarray:
+    """Returns `num_vectors` random vectors loosely grouped into `num_clusters` overlapping
+    clusters, as embeddings of documents on related topics tend to be. `spread` controls how
+    much the clusters overlap.
+    """
+    rng = np.random.default_rng(seed)
+    centroids = rng.standard_normal((num_clusters, embedding_dim), dtype="float32")
+    assignments = rng.integers(num_clusters, size=num_vectors)
+    noise = rng.standard_normal((num_vectors, embedding_dim), dtype="float32")
+    return centroids[assignments] + spread * noise
+
+
+def time_search(index: faiss.Index, queries: np.ndarray, top_k: int) -> Tuple[np.ndarray, float]:
+    """Searches `index` one query at a time, as the service does, returning the ids of the
+    results and the median latency in milliseconds.
+    """
+    ids, latencies = [], []
+    for query in queries:
+        start = time.perf_counter()
+        _, query_ids = index.search(query[None, :], top_k)
+        latencies.append(time.perf_counter() - start)
+        ids.append(query_ids[0])
+    return np.stack(ids), float(np.median(latencies) * 1000)
+
+
+def bytes_per_vector(index: faiss.Index) -> float:
+    """Returns the size of `index`, as written to a snapshot, per vector."""
+    return len(faiss.serialize_index(index)) / index.ntotal
+
+
+def recall(ids: np.ndarray, true_ids: np.ndarray) -> float:
+    """Returns the fraction of the true nearest neighbours `true_ids` found in `ids`."""
+    return float(np.mean([len(set(a) & set(b)) / len(b) for a, b in zip(ids, true_ids)]))
+
+
+def main(
+    index_factory: List[str] = typer.Option(
+        ["HNSW32", "IVF1024,Flat"], help="faiss.index_factory descriptions to evaluate."
+    ),
+    snapshot: Optional[Path] = typer.Option(None, help="Index snapshot to take vectors from."),
+    num_vectors: int = typer.Option(100000, help="Number of synthetic vectors to index."),
+    embedding_dim: int = typer.Option(768, help="Dimension of the synthetic vectors."),
+    num_queries: int = typer.Option(1000, help="Number of queries to search with."),
+    top_k: int = typer.Option(10, help="Number of nearest neighbours to retrieve."),
+    search_parameter: List[int] = typer.Option(
+        [1, 4, 16, 64, 256], help="Values of efSearch (HNSW) or nprobe (IVF) to evaluate."
+    ),
+    rescore_k_factor: float = typer.Option(
+        4.0, help="Multiple of top_k candidates re-scored exactly by RFlat indices."
+    ),
+    output: Optional[Path] = typer.Option(None, help="File to write the report to, as JSON."),
+) -> None:
+    if snapshot is not None:
+        ids, vectors = get_faiss_index_vectors(faiss.read_index(str(snapshot)))
+        embedding_dim = vectors.shape[1]
+    else:
+        vectors = synthetic_vectors(num_vectors + num_queries, embedding_dim)
+        ids = np.arange(num_vectors + num_queries)
+    # Hold some vectors out of the index to query with.
+    ids, vectors, queries = ids[num_queries:], vectors[num_queries:], vectors[:num_queries]
+    queries = queries / np.linalg.norm(queries, axis=-1, keepdims=True)
+
+    flat = setup_faiss_index(embedding_dim)
+    add_to_faiss_index(ids, vectors, flat)
+    true_ids, flat_latency = time_search(flat, queries, top_k)
+    report: List[Dict[str, Any]] = [
+        {
+            "index_factory": "Flat",
+            "recall": 1.0,
+            "latency_ms": flat_latency,
+            "bytes_per_vector": bytes_per_vector(flat),
+        }
+    ]
+
+    for description in index_factory:
+        index = setup_faiss_index(embedding_dim, description)
+        start = time.perf_counter()
+        index.train(vectors)
+        add_to_faiss_index(ids, vectors, index)
+        build_time = time.perf_counter() - start
+        if description.endswith("RFlat"):
+            set_faiss_search_parameters(index, k_factor_rf=rescore_k_factor)
+        index_bytes_per_vector = bytes_per_vector(index)
+        parameter = next(
+            (name for prefix, name in SEARCH_PARAMETERS.items() if description.startswith(prefix)),
+            None,
+        )
+        values: List[Optional[int]] = [None] if parameter is None else list(search_parameter)
+        for value in values:
+            if parameter is not None and value is not None:
+                set_faiss_search_parameters(index, **{parameter: value})
+            found_ids, latency = time_search(index, queries, top_k)
+            report.append(
+                {
+                    "index_factory": description,
+                    "search_parameter": parameter,
+                    "search_parameter_value": value,
+                    "recall": recall(found_ids, true_ids),
+                    "latency_ms": latency,
+                    "build_time_s": build_time,
+                    "bytes_per_vector": index_bytes_per_vector,
+                }
+            )
+
+    typer.echo(f"{len(ids)} vectors, {num_queries} queries, recall@{top_k}")
+    typer.echo(
+        f"{'index':<20}{'parameter':<16}{'recall':>8}{'latency (ms)':>14}{'speedup':>9}"
+        f"{'bytes/vector':>14}"
+    )
+    for row in report:
+        parameter = (
+            f"{row['search_parameter']}={row['search_parameter_value']}"
+            if row.get("search_parameter")
+            else ""
+        )
+        typer.echo(
+            f"{row['index_factory']:<20}{parameter:<16}{row['recall']:>8.3f}"
+            f"{row['latency_ms']:>14.3f}{flat_latency / row['latency_ms']:>8.1f}x"
+            f"{row['bytes_per_vector']:>14.0f}"
+        )
+    if output is not None:
+        output.write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,285 @@
+"""Builds an index snapshot offline, from lists of PubMed uids or local MEDLINE files, which the
+server loads at startup. E.g.
+
+    python -m semantic_search.build_index pmids.txt pubmed.medline.gz --snapshot-dir ./snapshots
+
+Then start the server with `INDEX_SNAPSHOT_DIR=./snapshots` and the same model settings.
+"""
+
+import functools
+import gzip
+import itertools
+import multiprocessing
+import os
+import re
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from enum import Enum
+from pathlib import Path
+from typing import Callable, Collection, Deque, Dict, Iterator, List, Optional, Set, TextIO, Tuple
+
+import faiss
+import numpy as np
+import torch
+import typer
+from transformers import AutoConfig
+
+from semantic_search.common.util import (
+    MODEL_PRECISIONS,
+    Emoji,
+    add_to_faiss_index,
+    encode_by_length,
+    faiss_index_fingerprint,
+    faiss_index_is_flat,
+    get_faiss_index_ids,
+    get_faiss_index_vectors,
+    load_faiss_index,
+    quantize_model,
+    sample_faiss_index_vectors,
+    save_faiss_index,
+    setup_faiss_index,
+    setup_model_and_tokenizer,
+    storage_index_factory,
+)
+from semantic_search.ncbi import _iter_medline_docs, _parse_medline, iter_uids_to_docs
+
+# Matches the lines of a MEDLINE record, e.g. "PMID- 9887103".
+MEDLINE_LINE = re.compile(r"^[A-Z]{1,4}\s*- ")
+# Report progress every time this many more documents have been indexed.
+LOG_EVERY = 10000
+# Number of vectors to move from the flat index to the trained one at a time.
+TRAIN_COPY_CHUNK_SIZE = 65536
+
+app = typer.Typer(add_completion=False)
+
+
+class InputFormat(str, Enum):
+    auto = "auto"
+    pmids = "pmids"
+    medline = "medline"
+
+
+def _open(path: Path) -> TextIO:
+    return gzip.open(path, "rt") if path.suffix == ".gz" else open(path)  # type: ignore
+
+
+def detect_format(path: Path) -> InputFormat:
+    """Returns the format of `path`, judging by its first non-empty line."""
+    with _open(path) as f:
+        for line in f:
+            if line.strip():
+                return InputFormat.medline if MEDLINE_LINE.match(line) else InputFormat.pmids
+    return InputFormat.pmids
+
+
+def iter_documents(
+    paths: List[Path], input_format: InputFormat = InputFormat.auto, skip: Collection[int] = ()
+) -> Iterator[Dict[str, str]]:
+    """Yields the uid and text (i.e. title + abstract) of each document in `paths`, except those
+    whose uid is in `skip`. Files of PubMed uids (one per line) are fetched from PubMed, while
+    MEDLINE files are parsed as is.
+    """
+    for path in paths:
+        path_format = detect_format(path) if input_format == InputFormat.auto else input_format
+        with _open(path) as f:
+            if path_format == InputFormat.medline:
+                docs = _iter_medline_docs(_parse_medline(f), skip_invalid=True)
+                yield from (doc for doc in docs if int(doc["uid"]) not in skip)
+            else:
+                # Filter uids before fetching them, so that resuming a build doesn't fetch them all
+                # again.
+                uids = [line.strip() for line in f if line.strip()]
+                yield from iter_uids_to_docs(
+                    [uid for uid in uids if not (uid.isdigit() and int(uid) in skip)]
+                )
+
+
+def train_faiss_index(
+    index: faiss.Index, embedding_dim: int, index_factory: str, index_train_size: int
+) -> faiss.Index:
+    """Returns an index built from `index_factory`, trained on a sample of `index_train_size` of
+    the vectors in the flat `index`, which are then moved to it.
+    """
+    trained = setup_faiss_index(embedding_dim, index_factory)
+    trained.train(sample_faiss_index_vectors(index, index_train_size))
+    # Move the vectors in chunks, rather than holding a second copy of them all at once.
+    for start in range(0, index.ntotal, TRAIN_COPY_CHUNK_SIZE):
+        add_to_faiss_index(
+            *get_faiss_index_vectors(index, start, start + TRAIN_COPY_CHUNK_SIZE), trained
+        )
+    return trained
+
+
+# Set up in each worker process by `_init_worker`.
+_worker_encode: Optional[Callable[[List[str]], torch.Tensor]] = None
+
+
+def _init_worker(
+    pretrained_model_name_or_path: str,
+    cuda_device: int,
+    num_threads: int,
+    precision: str = "float32",
+    **kwargs,
+) -> None:
+    global _worker_encode
+    # Split the cores between workers, rather than having every worker use all of them.
+    torch.set_num_threads(num_threads)
+    tokenizer, model = setup_model_and_tokenizer(
+        pretrained_model_name_or_path, cuda_device=cuda_device
+    )
+    if precision == "int8":
+        model = quantize_model(model)
+    _worker_encode = functools.partial(
+        encode_by_length, tokenizer=tokenizer, model=model, precision=precision, **kwargs
+    )
+
+
+def _encode_in_worker(text: List[str]) -> np.ndarray:
+    return _worker_encode(text).cpu().numpy()  # type: ignore
+
+
+@app.command()
+def main(
+    inputs: List[Path] = typer.Argument(
+        ..., exists=True, dir_okay=False, help="Files of PubMed uids or MEDLINE records to index."
+    ),
+    snapshot_dir: Path = typer.Option(
+        ..., envvar="INDEX_SNAPSHOT_DIR", help="Directory to write the index snapshot to."
+    ),
+    input_format: InputFormat = typer.Option(
+        InputFormat.auto, help="Format of the input files. By default, it is detected per file."
+    ),
+    pretrained_model_name_or_path: str = typer.Option(
+        "johngiorgi/declutr-sci-base", envvar="PRETRAINED_MODEL_NAME_OR_PATH"
+    ),
+    max_length: Optional[int] = typer.Option(None, envvar="MAX_LENGTH"),
+    mean_pool: bool = typer.Option(True, envvar="MEAN_POOL"),
+    cuda_device: int = typer.Option(-1, envvar="CUDA_DEVICE"),
+    model_precision: str = typer.Option(
+        "float32", envvar="MODEL_PRECISION", help="One of float32, int8 or bf16."
+    ),
+    index_factory: str = typer.Option("Flat", envvar="INDEX_FACTORY"),
+    index_storage: str = typer.Option("float32", envvar="INDEX_STORAGE"),
+    index_rescore: bool = typer.Option(False, envvar="INDEX_RESCORE"),
+    index_train_size: int = typer.Option(100000, envvar="INDEX_TRAIN_SIZE"),
+    batch_size: int = typer.Option(64, envvar="BATCH_SIZE"),
+    max_batch_tokens: int = typer.Option(16384, envvar="MAX_BATCH_TOKENS"),
+    num_workers: int = typer.Option(2, help="Number of processes to embed documents with."),
+    chunk_size: int = typer.Option(1024, help="Number of documents to send a worker at a time."),
+    resume: bool = typer.Option(
+        True, help="Add to the most recent snapshot built with the same settings, if any."
+    ),
+    snapshot_every: int = typer.Option(
+        100,
+        help=(
+            "Write a snapshot every this many chunks, so that an interrupted build can be resumed"
+            " from the last one. 0 only writes a snapshot once every document is indexed."
+        ),
+    ),
+    keep: int = typer.Option(2, envvar="INDEX_SNAPSHOT_KEEP"),
+) -> None:
+    """Embeds the documents in INPUTS and writes them to an index snapshot in SNAPSHOT_DIR.
+    Documents already in the index are skipped.
+    """
+    if model_precision not in MODEL_PRECISIONS:
+        raise typer.BadParameter(f"must be one of {MODEL_PRECISIONS}", param_hint="model_precision")
+    embedding_dim = AutoConfig.from_pretrained(pretrained_model_name_or_path).hidden_size
+    # Describe the index as the server does.
+    index_factory = storage_index_factory(index_factory, index_storage, embedding_dim)
+    if index_rescore:
+        index_factory = f"{index_factory},RFlat"
+    fingerprint = faiss_index_fingerprint(
+        pretrained_model_name_or_path,
+        embedding_dim=embedding_dim,
+        mean_pool=mean_pool,
+        max_length=max_length,
+        index_factory=index_factory,
+    )
+    resumed = load_faiss_index(snapshot_dir, fingerprint) if resume else None
+    if resumed is not None:
+        index = resumed
+    else:
+        index = setup_faiss_index(embedding_dim, index_factory)
+        # As in the server, indices that need training start out flat.
+        if not index.is_trained:
+            index = setup_faiss_index(embedding_dim)
+    seen: Set[int] = get_faiss_index_ids(index)
+    num_indexed = 0
+    num_chunks = 0
+
+    def train_if_needed() -> None:
+        nonlocal index
+        # As in the server, the index is trained as soon as there are enough vectors, so that
+        # the flat index never holds many more than that.
+        if index_factory != "Flat" and faiss_index_is_flat(index):
+            if index.ntotal >= index_train_size:
+                typer.echo(f"Training a {index_factory} index on {index_train_size} vectors")
+                index = train_faiss_index(index, embedding_dim, index_factory, index_train_size)
+
+    def add(ids: List[int], future: Future) -> None:
+        nonlocal num_indexed, num_chunks
+        add_to_faiss_index(ids, future.result(), index)
+        if (num_indexed + len(ids)) // LOG_EVERY > num_indexed // LOG_EVERY:
+            typer.echo(f"Indexed {num_indexed + len(ids)} documents")
+        num_indexed += len(ids)
+        num_chunks += 1
+        train_if_needed()
+        # Chunks are added in order, so resuming from this snapshot picks up after this chunk.
+        if snapshot_every > 0 and num_chunks % snapshot_every == 0:
+            index_path = save_faiss_index(index, snapshot_dir, fingerprint, keep=keep)
+            typer.echo(f"Saved index snapshot {index_path} with {index.ntotal} vectors")
+
+    # A snapshot resumed from may already hold enough vectors to train on.
+    train_if_needed()
+    # An id repeated across the inputs is only indexed once.
+    docs = (
+        doc
+        for doc in iter_documents(inputs, input_format, skip=seen)
+        if int(doc["uid"]) not in seen
+    )
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        # Forking a process that has already used torch can deadlock, so start afresh.
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=functools.partial(
+            _init_worker,
+            pretrained_model_name_or_path,
+            cuda_device,
+            num_threads=max(1, (os.cpu_count() or 1) // num_workers),
+            precision=model_precision,
+            max_length=max_length,
+            mean_pool=mean_pool,
+            max_tokens=max_batch_tokens,
+            max_batch_size=batch_size,
+        ),
+    ) as executor:
+        # Bound the number of chunks in flight, so documents aren't read faster than they are
+        # embedded. Chunks are added to the index in the order they were read.
+        pending: Deque[Tuple[List[int], Future]] = deque()
+        while True:
+            chunk: Dict[int, str] = {}
+            for doc in itertools.islice(docs, chunk_size):
+                seen.add(int(doc["uid"]))
+                chunk[int(doc["uid"])] = doc["text"]
+            if not chunk:
+                break
+            future = executor.submit(_encode_in_worker, list(chunk.values()))
+            pending.append((list(chunk), future))
+            if len(pending) > 2 * num_workers:
+                add(*pending.popleft())
+        while pending:
+            add(*pending.popleft())
+
+    index_path = save_faiss_index(index, snapshot_dir, fingerprint, keep=keep)
+    typer.secho(
+        (
+            f"{Emoji.SUCCESS.value} Indexed {num_indexed} new documents. Saved index snapshot"
+            f" {index_path} with {index.ntotal} vectors."
+        ),
+        fg=typer.colors.GREEN,
+        bold=True,
+    )
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,94 @@
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, List, NamedTuple, Optional
+
+from semantic_search.common.metrics import profile_thread, request_profiles
+
+
+class _Request(NamedTuple):
+    items: List[Any]
+    future: Future
+    # The profiles of the caller's request, if it is being profiled.
+    profiles: Optional[List[Any]] = None
+
+
+class MicroBatcher:
+    """Collects the items submitted by concurrent callers into batches of up to `max_batch_size`
+    items, waiting at most `max_wait` seconds for a batch to fill up. Each batch is passed to
+    `func` in a single call, and the outputs are handed back to each caller in order. `func`
+    must return one output per item, as a sequence (e.g. a list or a `torch.Tensor`) that supports
+    slicing. Batches are run on `num_threads` background threads. A batch holding the items of a
+    request that is being profiled is profiled as a whole, and added to that request's profiles.
+    """
+
+    def __init__(
+        self,
+        func: Callable[[List[Any]], Any],
+        max_batch_size: int = 64,
+        max_wait: float = 0.005,
+        num_threads: int = 1,
+    ) -> None:
+        self.func = func
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue: "queue.Queue[_Request]" = queue.Queue()
+        for _ in range(num_threads):
+            threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, items: List[Any]) -> Future:
+        """Queues `items` to be batched, returning a future for their outputs."""
+        future: Future = Future()
+        self._queue.put(_Request(list(items), future, request_profiles.get()))
+        return future
+
+    async def __call__(self, items: List[Any]) -> Any:
+        """Queues `items` to be batched and waits for their outputs without blocking the running
+        event loop.
+        """
+        return await asyncio.wrap_future(self.submit(items))
+
+    def _collect(self) -> List[_Request]:
+        batch = [self._queue.get()]
+        batch_size = len(batch[0].items)
+        deadline = time.monotonic() + self.max_wait
+        while batch_size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            batch_size += len(request.items)
+        return batch
+
+    def _run(self) -> None:
+        while True:
+            batch = self._collect()
+            profiles = [request.profiles for request in batch if request.profiles is not None]
+            try:
+                with profile_thread(profiles):
+                    outputs = self.func([item for request in batch for item in request.items])
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0].future.set_exception(e)
+                    continue
+                # Don't fail every caller because of one bad input. Retry each request on its
+                # own so that the error is only returned to the caller that caused it.
+                for request in batch:
+                    profiles = [request.profiles] if request.profiles is not None else []
+                    try:
+                        with profile_thread(profiles):
+                            request.future.set_result(self.func(request.items))
+                    except Exception as e:
+                        request.future.set_exception(e)
+                continue
+            start = 0
+            for request in batch:
+                end = start + len(request.items)
+                request.future.set_result(outputs[start:end])
+                start = end
@@ -0,0 +1,152 @@
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Hashable, Iterable, List, Optional, Union
+
+if TYPE_CHECKING:
+    import torch
+
+# SQLite limits the number of variables in a single statement.
+MAX_SQLITE_VARIABLES = 500
+# Seconds between recounts of the documents in a `DocumentCache`, which otherwise only counts
+# the documents it adds and removes itself (see `DocumentCache.set_many`).
+DOCUMENT_RECOUNT_INTERVAL = 600.0
+
+
+class DocumentCache:
+    """A persistent, SQLite-backed store of document text keyed by uid. At most `max_size`
+    documents are kept, evicting the oldest first. If `ttl` is provided, documents older than
+    `ttl` seconds are treated as missing.
+    """
+
+    def __init__(
+        self, path: Union[str, Path], max_size: int = 1_000_000, ttl: Optional[float] = None
+    ) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(path), check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS documents"
+                " (uid TEXT PRIMARY KEY, text TEXT NOT NULL, created REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS documents_created ON documents (created)"
+            )
+            self._recount()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def _recount(self) -> None:
+        # Counting scans the whole table, so it is done rarely.
+        (self._size,) = self._connection.execute("SELECT COUNT(*) FROM documents").fetchone()
+        self._counted = time.monotonic()
+
+    def _count_cached(self, uids: List[str]) -> int:
+        """Returns how many of `uids` have a row in the cache, expired or not."""
+        count = 0
+        for i in range(0, len(uids), MAX_SQLITE_VARIABLES):
+            batch = uids[i : i + MAX_SQLITE_VARIABLES]
+            (batch_count,) = self._connection.execute(
+                f"SELECT COUNT(*) FROM documents WHERE uid IN ({','.join('?' * len(batch))})",
+                batch,
+            ).fetchone()
+            count += batch_count
+        return count
+
+    def _oldest_valid(self) -> float:
+        return time.time() - self.ttl if self.ttl is not None else float("-inf")
+
+    def get_many(self, uids: Iterable[str]) -> Dict[str, str]:
+        """Returns a dictionary keyed by the uids in `uids` of their cached text. uids that are not
+        cached, or whose documents have expired, are omitted.
+        """
+        uids = list(uids)
+        cached: Dict[str, str] = {}
+        with self._lock:
+            for i in range(0, len(uids), MAX_SQLITE_VARIABLES):
+                batch = uids[i : i + MAX_SQLITE_VARIABLES]
+                rows = self._connection.execute(
+                    f"SELECT uid, text FROM documents WHERE created >= ?"
+                    f" AND uid IN ({','.join('?' * len(batch))})",
+                    [self._oldest_valid(), *batch],
+                )
+                cached.update(rows)
+        return cached
+
+    def set_many(self, docs: List[Dict[str, str]]) -> None:
+        """Caches `docs`, a list of `{"uid": ..., "text": ...}` dictionaries, evicting expired
+        documents and, if the cache is over `max_size`, the oldest documents.
+
+        Rather than counting the documents on every call, the cache keeps a running count of the
+        documents it adds and removes. Documents added by other processes sharing the database are
+        only picked up by a recount every `DOCUMENT_RECOUNT_INTERVAL` seconds.
+        """
+        now = time.time()
+        uids = list({doc["uid"] for doc in docs})
+        with self._lock, self._connection:
+            if time.monotonic() - self._counted > DOCUMENT_RECOUNT_INTERVAL:
+                self._recount()
+            self._size += len(uids) - self._count_cached(uids)
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO documents (uid, text, created) VALUES (?, ?, ?)",
+                [(doc["uid"], doc["text"], now) for doc in docs],
+            )
+            self._size -= self._connection.execute(
+                "DELETE FROM documents WHERE created < ?", (self._oldest_valid(),)
+            ).rowcount
+            if self._size > self.max_size:
+                self._size -= self._connection.execute(
+                    "DELETE FROM documents WHERE uid IN"
+                    " (SELECT uid FROM documents ORDER BY created LIMIT ?)",
+                    (self._size - self.max_size,),
+                ).rowcount
+
+
+class EmbeddingCache:
+    """An in-memory, least-recently-used cache of embeddings. Embeddings are evicted once those
+    cached take up more than `max_bytes` bytes.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self._lock = threading.Lock()
+        self._embeddings: "OrderedDict[Hashable, torch.Tensor]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._embeddings)
+
+    def get(self, key: Hashable) -> Optional["torch.Tensor"]:
+        """Returns the embedding cached under `key`, or None if there isn't one."""
+        with self._lock:
+            embedding = self._embeddings.get(key)
+            if embedding is not None:
+                self._embeddings.move_to_end(key)
+            return embedding
+
+    def set(self, key: Hashable, embedding: "torch.Tensor") -> None:
+        """Caches `embedding` under `key`, evicting the least recently used embeddings if the
+        cache is over `max_bytes`.
+        """
+        # Copy the embedding to the CPU, so it doesn't hold on to the (GPU) memory of the batch
+        # it is a slice of.
+        embedding = embedding.detach().to("cpu", copy=True)
+        with self._lock:
+            if key in self._embeddings:
+                self.num_bytes -= self._size(self._embeddings.pop(key))
+            self._embeddings[key] = embedding
+            self.num_bytes += self._size(embedding)
+            while self.num_bytes > self.max_bytes and self._embeddings:
+                _, evicted = self._embeddings.popitem(last=False)
+                self.num_bytes -= self._size(evicted)
+
+    @staticmethod
+    def _size(embedding: "torch.Tensor") -> int:
+        return embedding.element_size() * embedding.nelement()
@@ -0,0 +1,136 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+import requests  # type: ignore
+from prometheus_client import Counter, Gauge, Histogram
+
+# Prometheus metrics, served by the /metrics endpoint of `semantic_search.main`.
+
+# Latencies range from well under a millisecond (e.g. searching a small index) to many seconds
+# (e.g. fetching thousands of documents from NCBI).
+LATENCY_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+REQUEST_LATENCY = Histogram(
+    "semantic_search_request_seconds",
+    "Time taken to handle a request.",
+    ["method", "path", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+# The stages of a search: "fetch" (of text from NCBI), "tokenize", "encode" (the model's forward
+# pass), "index_add" and "index_search".
+STAGE_LATENCY = Histogram(
+    "semantic_search_stage_seconds",
+    "Time taken by each stage of a search.",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+ENCODER_BATCH_SIZE = Histogram(
+    "semantic_search_encoder_batch_size",
+    "Number of inputs in each batch passed through the model.",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512),
+)
+ENCODER_PADDING_RATIO = Histogram(
+    "semantic_search_encoder_padding_ratio",
+    "Fraction of the tokens in each batch passed through the model that are padding.",
+    buckets=(0.0, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0),
+)
+# With several worker processes, report the largest value, i.e. that of the writer of a shared
+# index.
+INDEX_VECTORS = Gauge(
+    "semantic_search_index_vectors",
+    "Number of vectors in the index, including evicted vectors yet to be removed.",
+    multiprocess_mode="livemax",
+)
+INDEX_BYTES = Gauge(
+    "semantic_search_index_bytes",
+    "Estimated memory taken up by the vectors, ids and graph links of the index.",
+    multiprocess_mode="livemax",
+)
+NCBI_RETRIES = Counter(
+    "semantic_search_ncbi_retries",
+    "Number of requests to the NCBI E-utilities that were retried.",
+)
+NCBI_ERRORS = Counter(
+    "semantic_search_ncbi_errors",
+    "Number of requests to the NCBI E-utilities that failed, after any retries.",
+    ["reason"],
+)
+
+# The total time spent in each stage by the request being handled, if it asked for a breakdown
+# (see the Server-Timing header of `semantic_search.main`).
+request_timings: "ContextVar[Optional[Dict[str, float]]]" = ContextVar(
+    "request_timings", default=None
+)
+# The pyinstrument sessions recorded on each thread that worked on the request being handled, if
+# it asked to be profiled (see `profile_thread`).
+request_profiles: "ContextVar[Optional[List[Any]]]" = ContextVar("request_profiles", default=None)
+
+
+@contextmanager
+def time_stage(stage: str, observe: bool = True) -> Iterator[None]:
+    """Times the code run under this context manager as `stage`, recording it in `STAGE_LATENCY`
+    (if `observe`) and in the `request_timings` of the current request.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if observe:
+            STAGE_LATENCY.labels(stage).observe(elapsed)
+        timings = request_timings.get()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+
+@contextmanager
+def profile_thread(profiles: Optional[List[List[Any]]] = None) -> Iterator[None]:
+    """Profiles the code run under this context manager on the current thread, adding the session
+    to the `request_profiles` of the current request, if it is being profiled. Work done for
+    several requests at once (e.g. a batch) is instead added to each of `profiles`.
+    """
+    if profiles is None:
+        current = request_profiles.get()
+        profiles = [current] if current is not None else []
+    if not profiles:
+        yield
+        return
+    from pyinstrument import Profiler
+
+    profiler = Profiler(async_mode="disabled")
+    profiler.start()
+    try:
+        yield
+    finally:
+        session = profiler.stop()
+        for sessions in profiles:
+            sessions.append(session)
+
+
+def ncbi_error_reason(error: requests.exceptions.RequestException) -> str:
+    """Returns the `reason` label of `NCBI_ERRORS` for a request that failed with `error`."""
+    if isinstance(error, requests.exceptions.Timeout):
+        return "timeout"
+    if isinstance(error, requests.exceptions.HTTPError):
+        return str(error.response.status_code) if error.response is not None else "http"
+    if isinstance(error, requests.exceptions.ConnectionError):
+        return "connection"
+    return "other"
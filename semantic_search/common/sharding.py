@@ -0,0 +1,118 @@
+import io
+import struct
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+import requests
+
+from semantic_search.common.util import merge_faiss_search_results
+
+
+def pack_arrays(**arrays: np.ndarray) -> bytes:
+    """Serializes `arrays` for sending to or from a shard."""
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    return buffer.getvalue()
+
+
+def unpack_arrays(content: bytes) -> Dict[str, np.ndarray]:
+    """Deserializes arrays serialized by `pack_arrays`."""
+    with np.load(io.BytesIO(content)) as arrays:
+        return dict(arrays)
+
+
+class ShardedIndex:
+    """A client for an index of `embedding_dim`-dimensional vectors partitioned across the shard
+    servers at `urls` (see the `/shard` endpoints of `semantic_search.main`). Each id is routed to
+    one shard by a hash of its value, while searches are sent to every shard in parallel and their
+    results merged.
+    """
+
+    def __init__(
+        self, urls: List[str], embedding_dim: int, timeout: Optional[float] = 30.0
+    ) -> None:
+        self.urls = [url.rstrip("/") for url in urls]
+        self.embedding_dim = embedding_dim
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=len(urls))
+        # A session per thread, as sessions can't safely be shared between threads.
+        self._local = threading.local()
+
+    def __len__(self) -> int:
+        return len(self.urls)
+
+    def shard_of(self, id_: int) -> int:
+        """Returns the index of the shard `id_` belongs to."""
+        # A hash, rather than the id itself, spreads ids evenly even if they share a pattern.
+        return zlib.crc32(struct.pack("<q", id_)) % len(self.urls)
+
+    def _post(self, shard: int, endpoint: str, **arrays: np.ndarray) -> Dict[str, np.ndarray]:
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        response = self._local.session.post(
+            f"{self.urls[shard]}/shard/{endpoint}",
+            data=pack_arrays(**arrays),
+            headers={"Content-Type": "application/octet-stream"},
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        return unpack_arrays(response.content)
+
+    def _partition(self, ids: List[int]) -> Dict[int, List[int]]:
+        """Returns the positions in `ids` of the ids belonging to each shard."""
+        positions: Dict[int, List[int]] = {}
+        for i, id_ in enumerate(ids):
+            positions.setdefault(self.shard_of(id_), []).append(i)
+        return positions
+
+    def ids(self) -> Set[int]:
+        """Returns the ids of every vector in the index."""
+        results = self._executor.map(lambda shard: self._post(shard, "ids"), range(len(self)))
+        return {id_ for result in results for id_ in result["ids"].tolist()}
+
+    def add(self, ids: List[int], vectors: np.ndarray) -> None:
+        """Adds `vectors` to the shards their `ids` belong to."""
+        futures = [
+            self._executor.submit(
+                self._post,
+                shard,
+                "add",
+                ids=np.asarray([ids[i] for i in positions], dtype="int64"),
+                vectors=vectors[positions],
+            )
+            for shard, positions in self._partition(ids).items()
+        ]
+        for future in futures:
+            future.result()
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the scores and ids of the `k` nearest neighbours of each of `queries`, across
+        all shards.
+        """
+        results = self._executor.map(
+            lambda shard: self._post(shard, "search", queries=queries, k=np.asarray(k)),
+            range(len(self)),
+        )
+        return merge_faiss_search_results(
+            [(result["scores"], result["ids"]) for result in results], k
+        )
+
+    def reconstruct(self, ids: List[int]) -> np.ndarray:
+        """Returns the vectors stored under `ids`. Every id must be in the index."""
+        partition = self._partition(ids)
+        futures = {
+            shard: self._executor.submit(
+                self._post,
+                shard,
+                "reconstruct",
+                ids=np.asarray([ids[i] for i in positions], dtype="int64"),
+            )
+            for shard, positions in partition.items()
+        }
+        vectors = np.empty((len(ids), self.embedding_dim), dtype="float32")
+        for shard, future in futures.items():
+            vectors[partition[shard]] = future.result()["vectors"]
+        return vectors
@@ -0,0 +1,84 @@
+import fcntl
+import itertools
+import os
+import time
+from pathlib import Path
+from typing import IO, List, Optional, Tuple, Union
+
+import numpy as np
+
+
+class WriterLock:
+    """An exclusive lock on the file at `path`, used to elect a single writer among processes.
+    The lock is released when the process holding it exits, even if it crashes, so that another
+    process can take over.
+    """
+
+    def __init__(self, path: Union[str, Path]) -> None:
+        self.path = Path(path)
+        self._file: Optional[IO] = None
+
+    @property
+    def held(self) -> bool:
+        return self._file is not None
+
+    def acquire(self) -> bool:
+        """Tries to take the lock without blocking, returning True if this process holds it."""
+        if self._file is None:
+            f = open(self.path, "a")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                return False
+            self._file = f
+        return True
+
+    def release(self) -> None:
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+class Spool:
+    """A directory through which processes sharing an index pass each other the vectors they
+    add to it. Each batch of vectors is written to a file of its own (a "delta"), which the other
+    processes read and add to their view of the index.
+    """
+
+    def __init__(self, directory: Union[str, Path]) -> None:
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._sequence = itertools.count()
+
+    def names(self) -> List[str]:
+        """Returns the names of the deltas in the spool, oldest first."""
+        return sorted(path.name for path in self.directory.glob("delta-*.npz"))
+
+    def write(self, ids: List[int], vectors: np.ndarray) -> str:
+        """Writes `vectors`, with ids `ids`, to a new delta and returns its name."""
+        # Names sort by the time they were written, and hold the pid so that processes never clash.
+        name = f"delta-{time.time_ns():020d}-{os.getpid()}-{next(self._sequence)}.npz"
+        # Write to a temporary file and rename it so that readers never see a partial delta.
+        path = self.directory / name
+        with open(f"{path}.tmp", "wb") as f:
+            np.savez(f, ids=np.asarray(ids, dtype="int64"), vectors=vectors.astype("float32"))
+        os.replace(f"{path}.tmp", path)
+        return name
+
+    def read(self, name: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Returns the ids and vectors of the delta `name`, or None if it has been removed."""
+        try:
+            with np.load(self.directory / name) as delta:
+                return delta["ids"], delta["vectors"]
+        except FileNotFoundError:
+            return None
+
+    def remove(self, names: List[str]) -> None:
+        """Removes the deltas `names`, e.g. once they have been written to a snapshot."""
+        for name in names:
+            try:
+                (self.directory / name).unlink()
+            except FileNotFoundError:
+                pass
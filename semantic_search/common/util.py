@@ -1,13 +1,38 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import re
+import shutil
+import threading
+from concurrent.futures import Executor
+from contextlib import contextmanager
+from datetime import datetime
 from enum import Enum
-from typing import List, Optional, Tuple
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, Optional, Set, Tuple, Union
 
 import faiss
 import numpy as np
-import torch
 import typer
-from transformers import AutoModel, AutoTokenizer, PreTrainedModel, PreTrainedTokenizer
+from semantic_search.common.metrics import (
+    ENCODER_BATCH_SIZE,
+    ENCODER_PADDING_RATIO,
+    profile_thread,
+    time_stage,
+)
 from semantic_search.schemas import Document
-from semantic_search.ncbi import uids_to_docs
+from semantic_search.ncbi import iter_uids_to_docs
+
+if TYPE_CHECKING:
+    # Importing these takes seconds, so they are only imported once a model is loaded, rather than
+    # with this module. This lets the server start answering health checks sooner.
+    import torch
+    from transformers import PreTrainedModel, PreTrainedTokenizer
 
 UID = str
 
@@ -20,10 +45,67 @@ class Emoji(Enum):
     FAST = "\U0001F3C3"
 
 
+class ReadWriteLock:
+    """A lock that can be held by any number of readers at once, or by a single writer. Waiting
+    writers take priority over new readers, so a steady stream of readers can't starve them.
+    """
+
+    def __init__(self) -> None:
+        self._condition = threading.Condition()
+        self._readers = 0
+        self._writers_waiting = 0
+        self._writing = False
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        with self._condition:
+            while self._writing or self._writers_waiting:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if not self._readers:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        with self._condition:
+            self._writers_waiting += 1
+            while self._writing or self._readers:
+                self._condition.wait()
+            self._writers_waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+
+async def run_in_executor(executor: Executor, func: Callable, *args, **kwargs) -> Any:
+    """Runs `func(*args, **kwargs)` on `executor` without blocking the running event loop. `func`
+    sees the caller's context variables, and is profiled if the caller's request is.
+    """
+
+    def call() -> Any:
+        with profile_thread():
+            return func(*args, **kwargs)
+
+    loop = asyncio.get_event_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(executor, functools.partial(context.run, call))
+
+
 def get_device(cuda_device: int = -1) -> torch.device:
     """Return a `torch.cuda` device if `torch.cuda.is_available()` and `cuda_device>=0`.
     Otherwise returns a `torch.cpu` device.
     """
+    import torch
+
     if cuda_device != -1 and torch.cuda.is_available():
         device = torch.device("cuda")
         typer.secho(
@@ -48,6 +130,8 @@ def setup_model_and_tokenizer(
     """Given a HuggingFace Transformer `pretrained_model_name_or_path`, return the corresponding
     model and tokenizer. Optionally, places the model on `cuda_device`, if available.
     """
+    from transformers import AutoModel, AutoTokenizer
+
     device = get_device(cuda_device)
     # Load the Transformers tokenizer
     tokenizer = AutoTokenizer.from_pretrained(pretrained_model_name_or_path)
@@ -75,22 +159,97 @@ def setup_model_and_tokenizer(
     return tokenizer, model
 
 
-@torch.no_grad()
+def save_model_and_tokenizer(
+    tokenizer: PreTrainedTokenizer, model: PreTrainedModel, directory: Union[str, Path]
+) -> None:
+    """Saves `tokenizer` and `model` to `directory`, with the model's weights in the safetensors
+    format. The copy is written elsewhere and moved into place once complete, so that
+    `directory` never holds a partial copy, and if it already exists it is left as is.
+    """
+    directory = Path(directory)
+    directory.parent.mkdir(parents=True, exist_ok=True)
+    partial = directory.with_name(f"{directory.name}.{os.getpid()}.partial")
+    tokenizer.save_pretrained(str(partial))
+    model.save_pretrained(str(partial), safe_serialization=True)
+    try:
+        os.rename(partial, directory)
+    except OSError:
+        # Another process saved a copy first.
+        shutil.rmtree(partial)
+        return
+    typer.secho(
+        f"{Emoji.SUCCESS.value} Saved a copy of the model to {directory}.",
+        fg=typer.colors.GREEN,
+        bold=True,
+    )
+
+
+# The precisions a model can be run at. "int8" is applied to the model (see `quantize_model`),
+# while "bf16" is applied to each forward pass (see `encode_with_transformer`).
+MODEL_PRECISIONS = ("float32", "int8", "bf16")
+
+
+def quantize_model(model: PreTrainedModel) -> PreTrainedModel:
+    """Returns a copy of `model` whose linear layers compute with weights quantized to 8-bit
+    integers, and activations quantized on the fly (i.e. dynamic quantization). This is only
+    supported on the CPU.
+    """
+    import torch
+
+    if model.device.type != "cpu":
+        raise ValueError(f"int8 precision is only supported on the CPU, not {model.device}")
+    model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    typer.secho(
+        f"{Emoji.FAST.value} Quantized the linear layers of the model to int8.",
+        fg=typer.colors.GREEN,
+        bold=True,
+    )
+    return model
+
+
 def encode_with_transformer(
-    text: List[str],
+    text: Union[List[str], Dict[str, List[List[int]]]],
     tokenizer: PreTrainedTokenizer,
     model: PreTrainedModel,
     max_length: Optional[int] = None,
     mean_pool: bool = True,
+    precision: str = "float32",
 ) -> torch.Tensor:
+    """Embeds `text` with `model`. `text` may also be given already tokenized, as the unpadded
+    inputs returned by `tokenizer`, which are then only padded. If `precision` is "bf16", the
+    forward pass is run under bfloat16 autocast. Embeddings are always returned as float32.
+    """
+    import torch
 
-    inputs = tokenizer(
-        text, padding=True, truncation=True, max_length=max_length, return_tensors="pt"
-    )
+    if isinstance(text, dict):
+        # Padding is much cheaper than tokenizing again. Fast tokenizers advise against it, as
+        # tokenizing and padding in one call is faster than tokenizing and then padding, which
+        # doesn't apply here.
+        tokenizer.deprecation_warnings["Asking-to-pad-a-fast-tokenizer"] = True
+        inputs = tokenizer.pad(text, return_tensors="pt")
+    else:
+        with time_stage("tokenize"):
+            inputs = tokenizer(
+                text, padding=True, truncation=True, max_length=max_length, return_tensors="pt"
+            )
     for name, tensor in inputs.items():
         inputs[name] = tensor.to(model.device)
     attention_mask = inputs["attention_mask"]
-    output = model(**inputs).last_hidden_state
+    ENCODER_BATCH_SIZE.observe(len(attention_mask))
+    ENCODER_PADDING_RATIO.observe(1 - attention_mask.sum().item() / attention_mask.numel())
+    autocast = (
+        torch.autocast(model.device.type, dtype=torch.bfloat16)
+        if precision == "bf16"
+        else contextlib.nullcontext()
+    )
+    with time_stage("encode"):
+        with torch.no_grad(), autocast:
+            output = model(**inputs).last_hidden_state
+        # Pool at full precision, as summing many bfloat16 values loses accuracy.
+        output = output.float()
+        # CUDA kernels run asynchronously, so wait for them to finish before stopping the clock.
+        if output.is_cuda:
+            torch.cuda.synchronize(output.device)
 
     if mean_pool:
         embedding = torch.sum(output * attention_mask.unsqueeze(-1), dim=1) / torch.clamp(
@@ -102,25 +261,506 @@ def encode_with_transformer(
     return embedding
 
 
-def setup_faiss_index(embedding_dim: int) -> faiss.Index:
-    """Returns a simple `IndexFlatIP` FAISS index with a vector dimension size of `embedding_dim`
-    and an ID map for cosine similarity searching.
+def batch_by_length(
+    lengths: List[int], max_tokens: int, max_batch_size: Optional[int] = None
+) -> List[List[int]]:
+    """Returns the indices of the inputs with token `lengths`, sorted by length and grouped into
+    batches which, once padded to their longest input, contain at most `max_tokens` tokens and
+    `max_batch_size` inputs. An input longer than `max_tokens` is placed in a batch of its own.
+    """
+    batches: List[List[int]] = []
+    batch: List[int] = []
+    for i in sorted(range(len(lengths)), key=lengths.__getitem__):
+        # Inputs are sorted by length, so the current input is the longest in the batch.
+        if batch and ((len(batch) + 1) * lengths[i] > max_tokens or len(batch) == max_batch_size):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def encode_by_length(
+    text: List[str],
+    tokenizer: PreTrainedTokenizer,
+    model: PreTrainedModel,
+    max_length: Optional[int] = None,
+    mean_pool: bool = True,
+    max_tokens: int = 16384,
+    max_batch_size: Optional[int] = None,
+    precision: str = "float32",
+) -> torch.Tensor:
+    """Embeds `text` with `encode_with_transformer`, in batches of inputs of similar length (see
+    `batch_by_length`). The embeddings are returned in the same order as `text`.
     """
-    index = faiss.IndexFlatIP(embedding_dim)
-    index = faiss.IndexPreTransform(faiss.NormalizationTransform(embedding_dim), index)
-    index = faiss.IndexIDMap(index)
+    import torch
+
+    # Tokenize the inputs up front so that we can sort and batch them by their true length,
+    # maintaining the original indices so we can un-sort before returning the embeddings. Batching
+    # inputs of similar length minimizes the amount of computation performed on pads, and
+    # bounding the number of tokens per batch keeps memory usage predictable. Each batch is then
+    # padded from these inputs, rather than tokenized again.
+    with time_stage("tokenize"):
+        inputs = tokenizer(text, truncation=True, max_length=max_length)
+    batches = batch_by_length([len(ids) for ids in inputs["input_ids"]], max_tokens, max_batch_size)
+
+    embeddings = torch.cat(
+        [
+            encode_with_transformer(
+                {name: [values[i] for i in batch] for name, values in inputs.items()},
+                tokenizer=tokenizer,
+                model=model,
+                max_length=max_length,
+                mean_pool=mean_pool,
+                precision=precision,
+            )
+            for batch in batches
+        ]
+    )
+
+    # Unsort the embedded text so that it is returned in the same order it was recieved.
+    sorted_indices = torch.as_tensor(
+        [i for batch in batches for i in batch], dtype=torch.long, device=embeddings.device
+    )
+    return torch.index_select(embeddings, dim=0, index=torch.argsort(sorted_indices))
+
+
+def _make_faiss_index_reconstructable(index: faiss.Index) -> None:
+    """IVF indices can only reconstruct vectors by id once they have a direct map."""
+    try:
+        faiss.extract_index_ivf(index).make_direct_map()
+    except RuntimeError:
+        pass
+
+
+# faiss.index_factory descriptions of the ways vectors can be stored, see
+# `storage_index_factory`. Product quantization uses one byte per 4 dimensions.
+STORAGE_INDEX_FACTORIES = {"float32": "Flat", "fp16": "SQfp16", "int8": "SQ8", "pq": "PQ{pq_m}"}
+
+
+def storage_index_factory(index_factory: str, storage: str, embedding_dim: int) -> str:
+    """Returns the `index_factory` description (as passed to `setup_faiss_index`) changed to store
+    vectors at `storage` precision, one of "float32" (as is), "fp16", "int8" (scalar
+    quantization) or "pq" (product quantization). Raises a `ValueError` if `index_factory`
+    doesn't support this, in which case the storage must be described in `index_factory` itself.
+    """
+    if storage not in STORAGE_INDEX_FACTORIES:
+        raise ValueError(
+            f"Unknown storage {storage!r}, expected one of: {', '.join(STORAGE_INDEX_FACTORIES)}"
+        )
+    if storage == "float32":
+        return index_factory
+    code = STORAGE_INDEX_FACTORIES[storage].format(pq_m=embedding_dim // 4)
+    if index_factory == "Flat" and storage == "pq":
+        # A flat PQ index can't skip evicted vectors during a search (see `search_faiss_index`),
+        # while an IVF index with a single list scans every vector just the same, and can.
+        return f"IVF1,{code}"
+    if index_factory == "Flat":
+        return code
+    if index_factory.startswith("IVF") and index_factory.endswith(",Flat"):
+        return f"{index_factory[:-len('Flat')]}{code}"
+    # HNSW indices with product quantization only support L2 distances.
+    if re.fullmatch(r"HNSW\d+", index_factory) and storage != "pq":
+        return f"{index_factory},{code}"
+    raise ValueError(f"Can't store the vectors of a {index_factory!r} index as {storage!r}")
+
+
+def setup_faiss_index(embedding_dim: int, index_factory: str = "Flat") -> faiss.Index:
+    """Returns a FAISS index with a vector dimension size of `embedding_dim` and an ID map for
+    cosine similarity searching. Vectors are stored in an index built from the `index_factory`
+    description, e.g. "Flat" (the default) for exact search, or "HNSW32" or "IVF4096,Flat" for
+    approximate search. See: https://github.com/facebookresearch/faiss/wiki/The-index-factory
+    A description ending in ",RFlat" (e.g. "PQ192,RFlat") also keeps a copy of each vector as is,
+    which is used to re-score the best candidates of each search exactly.
+    """
+    rescore = index_factory.endswith(",RFlat")
+    if rescore:
+        index_factory = index_factory[: -len(",RFlat")]
+    index = faiss.index_factory(
+        embedding_dim, f"IDMap2,L2norm,{index_factory}", faiss.METRIC_INNER_PRODUCT
+    )
+    if rescore:
+        # faiss.index_factory would wrap the L2norm transform in the refinement, re-scoring with
+        # unnormalized vectors, so add it inside the transform ourselves.
+        pretransform = faiss.downcast_index(index.index)
+        refine = faiss.IndexRefineFlat(pretransform.index)
+        refine.own_fields = pretransform.own_fields
+        # Hand ownership of the refinement over to the transform, which deletes it.
+        refine.this.disown()
+        pretransform.index = refine
+    _make_faiss_index_reconstructable(index)
     return index
 
 
-def add_to_faiss_index(ids: List[int], embeddings: np.ndarray, index: faiss.Index) -> None:
-    """Adds the vectors `embeddings` to the `index` using the keys `ids`."""
+def _upgrade_faiss_id_map(index: faiss.Index) -> faiss.Index:
+    """Returns `index` with its `IndexIDMap` replaced by an `IndexIDMap2`, which can reconstruct
+    vectors by id. Snapshots written before `setup_faiss_index` used `IndexIDMap2` need this.
+    """
+    if not isinstance(index, faiss.IndexIDMap) or isinstance(index, faiss.IndexIDMap2):
+        return index
+    # IndexIDMap2 refuses to wrap a non-empty index, so hide its vectors while it is wrapped.
+    sub_index, ntotal = index.index, index.ntotal
+    sub_index.ntotal = 0
+    upgraded = faiss.IndexIDMap2(sub_index)
+    sub_index.ntotal = upgraded.ntotal = ntotal
+    faiss.copy_array_to_vector(faiss.vector_to_array(index.id_map), upgraded.id_map)
+    upgraded.construct_rev_map()
+    # Hand ownership of the wrapped index over, so it outlives the old ID map.
+    index.own_fields, upgraded.own_fields = False, True
+    _make_faiss_index_reconstructable(upgraded)
+    return upgraded
+
+
+def set_faiss_search_parameters(index: faiss.Index, **parameters: float) -> None:
+    """Sets the search-time `parameters` of `index`, e.g. `nprobe` for IVF indices or `efSearch`
+    for HNSW indices. Parameters that don't apply to this type of index are ignored.
+    """
+    parameter_space = faiss.ParameterSpace()
+    for name, value in parameters.items():
+        try:
+            parameter_space.set_index_parameter(index, name, value)
+        except RuntimeError:
+            pass
+
+
+def faiss_index_is_flat(index: faiss.Index) -> bool:
+    """Returns True if the vectors of `index`, as returned by `setup_faiss_index`, are stored in a
+    flat index.
+    """
+    return isinstance(
+        faiss.downcast_index(faiss.downcast_index(index.index).index), faiss.IndexFlat
+    )
+
+
+def _faiss_id_map_view(index: faiss.Index) -> np.ndarray:
+    """Returns the ID map of `index`, as returned by `setup_faiss_index`, as an array that views
+    it in place, i.e. which is only valid until vectors are added to the index.
+    """
+    if index.ntotal == 0:
+        return np.empty(0, dtype="int64")
+    return faiss.rev_swig_ptr(index.id_map.data(), index.ntotal)
+
+
+def get_faiss_index_vectors(
+    index: faiss.Index, start: int = 0, stop: Optional[int] = None
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the ids and (normalized) vectors of `index`, as returned by `setup_faiss_index`,
+    from position `start` up to `stop` (by default, the end). Vectors are reconstructed, so this
+    is only exact for indices that store vectors as is, e.g. flat indices.
+    """
+    stop = index.ntotal if stop is None else min(stop, index.ntotal)
+    # Only copy the ids asked for, rather than the whole ID map.
+    ids = _faiss_id_map_view(index)[start:stop].copy()
+    vectors = index.index.reconstruct_n(start, stop - start)
+    return ids, vectors
+
+
+def sample_faiss_index_vectors(
+    index: faiss.Index, n: int, rng: Optional[np.random.Generator] = None
+) -> np.ndarray:
+    """Returns `n` (normalized) vectors of `index`, as returned by `setup_faiss_index`, chosen at
+    random, e.g. to train another index on without copying every vector.
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    positions = np.sort(rng.choice(index.ntotal, min(n, index.ntotal), replace=False))
+    return index.index.reconstruct_batch(positions)
+
+
+def search_faiss_index(
+    index: faiss.Index,
+    queries: np.ndarray,
+    k: int,
+    excluded: Optional[faiss.IDSelector] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the scores and ids of the `k` nearest neighbours in `index`, as returned by
+    `setup_faiss_index`, of each of `queries`, skipping any vector whose id is selected by
+    `excluded`.
+    """
+    if excluded is None:
+        return index.search(queries, k)
+    # IVF indices take their search-time parameters from the SearchParameters, if given.
+    try:
+        params = faiss.SearchParametersIVF()
+        params.nprobe = faiss.extract_index_ivf(index).nprobe
+    except RuntimeError:
+        params = faiss.SearchParameters()
+    selector = faiss.IDSelectorNot(excluded)
+    storage = faiss.downcast_index(faiss.downcast_index(index.index).index)
+    if isinstance(storage, faiss.IndexRefine):
+        # Only the candidates need filtering, so the selector goes to the index that finds them.
+        # The ID map only translates ids for a selector of the top-level parameters, so
+        # translate them ourselves.
+        translated = faiss.IDSelectorTranslated(index.id_map, selector)
+        params.sel = translated
+        refine_params = faiss.IndexRefineSearchParameters()
+        refine_params.k_factor = storage.k_factor
+        refine_params.base_index_params = params
+        return index.search(queries, k, params=refine_params)
+    params.sel = selector
+    return index.search(queries, k, params=params)
+
+
+def merge_faiss_search_results(
+    results: List[Tuple[np.ndarray, np.ndarray]], k: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Merges the `results` (scores and ids, as returned by `search_faiss_index`) of searching
+    several indices for the same queries into the scores and ids of the `k` best of them.
+    """
+    scores = np.concatenate([scores for scores, _ in results], axis=1)
+    ids = np.concatenate([ids for _, ids in results], axis=1)
+    # Indices that find fewer than k results pad them with an id of -1, which should sort last.
+    scores = np.where(ids == -1, -np.inf, scores)
+    top_k = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+    return np.take_along_axis(scores, top_k, axis=1), np.take_along_axis(ids, top_k, axis=1)
+
+
+def empty_faiss_index_like(index: faiss.Index) -> faiss.Index:
+    """Returns an empty copy of `index`, which keeps its training and search-time parameters."""
+    # faiss.clone_index doesn't support the L2norm transform, so copy the index by serializing it.
+    copy = faiss.deserialize_index(faiss.serialize_index(index))
+    copy.reset()
+    # IndexIDMap2.reset leaves the reverse map of ids to positions as is, so ids of the old
+    # vectors would still reconstruct, returning whichever vector ends up at their position.
+    copy.construct_rev_map()
+    return copy
+
+
+def _add_stored_faiss_vectors(
+    source: faiss.Index, dest: faiss.Index, positions: np.ndarray, vectors: np.ndarray
+) -> None:
+    """Adds `vectors`, reconstructed from `positions` in the vector storage `source`, to the
+    vector storage `dest`, trained the same way, so that they are encoded as they were in
+    `source`. See `copy_faiss_index_vectors`.
+    """
+    source, dest = faiss.downcast_index(source), faiss.downcast_index(dest)
+    if isinstance(dest, faiss.IndexRefine):
+        # The vectors were reconstructed from the exact copies, which is what the base index
+        # encoded in the first place.
+        _add_stored_faiss_vectors(source.base_index, dest.base_index, positions, vectors)
+        dest.refine_index.add(vectors)
+        dest.ntotal = dest.refine_index.ntotal
+    elif isinstance(dest, faiss.IndexIVF):
+        # Keep each vector in the same list, rather than the one nearest to its reconstruction,
+        # which would encode it relative to another centroid. The direct map holds the list of
+        # each vector in its upper 32 bits.
+        direct_map = faiss.rev_swig_ptr(source.direct_map.array.data(), source.ntotal)
+        lists = np.ascontiguousarray(direct_map[positions] >> 32)
+        dest.add_core(len(vectors), faiss.swig_ptr(vectors), None, faiss.swig_ptr(lists))
+    else:
+        # Encoding the reconstruction of a vector gives back the same code.
+        dest.add(vectors)
+
+
+def copy_faiss_index_vectors(
+    source: faiss.Index, dest: faiss.Index, positions: Union[List[int], np.ndarray]
+) -> None:
+    """Adds the vectors at `positions` in `source`, as returned by `setup_faiss_index`, to `dest`,
+    an index like it (e.g. as returned by `empty_faiss_index_like`), under the same ids. Vectors
+    are copied as they are stored, so, unlike vectors that are reconstructed and added again,
+    compressed vectors don't change a little every time they are copied.
+
+    Rebuilding the map of ids to positions takes a pass over every id, so it is left to the
+    caller: call `dest.construct_rev_map()` once done copying, before reconstructing by id.
+    """
+    positions = np.asarray(positions, dtype="int64")
+    if len(positions) == 0:
+        return
+    ids = _faiss_id_map_view(source)[positions]
+    # The L2norm transform is reversed as is, so the vectors are reconstructed as they are stored
+    # and go straight to the storage, rather than being normalized (and so changed) again.
+    vectors = source.index.reconstruct_batch(positions)
+    source_transform = faiss.downcast_index(source.index)
+    dest_transform = faiss.downcast_index(dest.index)
+    _add_stored_faiss_vectors(source_transform.index, dest_transform.index, positions, vectors)
+    dest_transform.ntotal = dest_transform.index.ntotal
+    ntotal = dest.ntotal
+    dest.id_map.resize(ntotal + len(ids))
+    faiss.rev_swig_ptr(dest.id_map.data(), ntotal + len(ids))[ntotal:] = ids
+    dest.ntotal = ntotal + len(ids)
+
+
+def reconstruct_from_faiss_index(index: faiss.Index, ids: List[int]) -> np.ndarray:
+    """Returns the (normalized) vectors stored in `index`, as returned by `setup_faiss_index`,
+    under `ids`. Every id must be in the index.
+    """
+    return index.reconstruct_batch(np.asarray(ids, dtype="int64"))
+
+
+def add_to_faiss_index(
+    ids: List[int],
+    embeddings: np.ndarray,
+    index: faiss.Index,
+    indexed_ids: Optional[Set[int]] = None,
+) -> None:
+    """Adds the vectors `embeddings` to the `index` using the keys `ids`. If provided,
+    `indexed_ids` is updated to include `ids`.
+    """
     ids = np.asarray(ids).astype("int64")
     embeddings = embeddings.astype("float32")
     index.add_with_ids(embeddings, ids)
+    if indexed_ids is not None:
+        indexed_ids.update(ids.tolist())  # type: ignore
+
+
+def faiss_index_nbytes(index: faiss.Index) -> int:
+    """Returns an estimate of the memory taken up by the vectors, ids and (for HNSW indices) graph
+    links of `index`, as returned by `setup_faiss_index`.
+    """
+
+    def storage_nbytes(storage: faiss.Index) -> int:
+        storage = faiss.downcast_index(storage)
+        if isinstance(storage, faiss.IndexRefine):
+            return storage_nbytes(storage.base_index) + storage_nbytes(storage.refine_index)
+        if isinstance(storage, faiss.IndexHNSW):
+            # Each link is stored as a 32-bit id.
+            return storage_nbytes(storage.storage) + storage.hnsw.neighbors.size() * 4
+        return storage.sa_code_size() * storage.ntotal
+
+    # Ids are stored as 64-bit integers.
+    return storage_nbytes(faiss.downcast_index(index.index).index) + index.ntotal * 8
 
 
-def normalize_documents(pmids: List[str]) -> str:
-    normalized_docs = []
-    for doc in pmids:
-        normalized_docs.append(Document(**list(uids_to_docs([doc]))[0][0]))
-    return normalized_docs[0].text  # type: ignore
+def list_faiss_index_ids(
+    index: faiss.Index, start: int = 0, stop: Optional[int] = None
+) -> List[int]:
+    """Returns the ids of every vector in `index`, in the order they were added, or only those
+    from position `start` up to `stop`.
+    """
+    return _faiss_id_map_view(index)[start:stop].tolist()
+
+
+def get_faiss_index_ids(index: faiss.Index) -> Set[int]:
+    """Returns the ids of every vector in `index`. This scans the whole index, so prefer keeping
+    the result up-to-date with `add_to_faiss_index` over calling this repeatedly.
+    """
+    return set(list_faiss_index_ids(index))
+
+
+def faiss_index_fingerprint(
+    pretrained_model_name_or_path: str,
+    embedding_dim: int,
+    mean_pool: bool,
+    max_length: Optional[int],
+    index_factory: str,
+) -> Dict[str, Any]:
+    """Returns the settings an index snapshot must have been built with in order to be reused."""
+    return {
+        "pretrained_model_name_or_path": pretrained_model_name_or_path,
+        "embedding_dim": embedding_dim,
+        "mean_pool": mean_pool,
+        "max_length": max_length,
+        "index_factory": index_factory,
+    }
+
+
+def _list_snapshots(snapshot_dir: Path) -> List[Path]:
+    """Returns the metadata files of the complete snapshots in `snapshot_dir`, newest first."""
+    return sorted(snapshot_dir.glob("index-*.json"), reverse=True)
+
+
+def save_faiss_index(
+    index: Union[faiss.Index, np.ndarray],
+    snapshot_dir: Union[str, Path],
+    fingerprint: Dict[str, Any],
+    keep: int = 2,
+    ntotal: Optional[int] = None,
+) -> Path:
+    """Writes `index` to a new, timestamped snapshot in `snapshot_dir`, alongside a JSON file
+    holding `fingerprint`. Only the `keep` most recent snapshots are retained.
+
+    `index` may also be an index serialized by `faiss.serialize_index` (e.g. under a lock, so that
+    the lock isn't held while the snapshot is written), in which case `ntotal` must be its number
+    of vectors.
+    """
+    if isinstance(index, np.ndarray) and ntotal is None:
+        raise ValueError("ntotal must be given for a serialized index")
+    snapshot_dir = Path(snapshot_dir)
+    snapshot_dir.mkdir(parents=True, exist_ok=True)
+    name = f"index-{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}"
+    index_path = snapshot_dir / f"{name}.faiss"
+    metadata_path = snapshot_dir / f"{name}.json"
+
+    # Write to temporary files and rename them so that a crash mid-write never leaves a
+    # truncated snapshot behind. The metadata is written last, so its presence marks a
+    # snapshot as complete.
+    if isinstance(index, np.ndarray):
+        index.tofile(f"{index_path}.tmp")
+    else:
+        faiss.write_index(index, f"{index_path}.tmp")
+        ntotal = index.ntotal
+    os.replace(f"{index_path}.tmp", index_path)
+    metadata = {**fingerprint, "ntotal": ntotal, "created": datetime.utcnow().isoformat()}
+    with open(f"{metadata_path}.tmp", "w") as f:
+        json.dump(metadata, f)
+    os.replace(f"{metadata_path}.tmp", metadata_path)
+
+    for stale in _list_snapshots(snapshot_dir)[keep:]:
+        stale.with_suffix(".faiss").unlink()
+        stale.unlink()
+
+    return index_path
+
+
+def find_faiss_index_snapshot(
+    snapshot_dir: Union[str, Path], fingerprint: Dict[str, Any], warn: bool = True
+) -> Optional[Path]:
+    """Returns the metadata file of the most recent snapshot in `snapshot_dir` whose metadata
+    matches `fingerprint`, or None if there is no such snapshot. If `warn`, warns about each more
+    recent snapshot that doesn't match.
+    """
+    for metadata_path in _list_snapshots(Path(snapshot_dir)):
+        with open(metadata_path) as f:
+            metadata = json.load(f)
+        mismatched = [key for key, value in fingerprint.items() if metadata.get(key) != value]
+        if not mismatched:
+            return metadata_path
+        if warn:
+            typer.secho(
+                (
+                    f"{Emoji.WARNING.value} Skipping index snapshot {metadata_path.stem}, which"
+                    f" does not match the current settings for: {', '.join(mismatched)}."
+                ),
+                fg=typer.colors.YELLOW,
+                bold=True,
+            )
+    return None
+
+
+def read_faiss_index_snapshot(metadata_path: Path, io_flags: int = 0) -> faiss.Index:
+    """Returns the index of the snapshot with metadata file `metadata_path`. `io_flags` are
+    passed to `faiss.read_index`, e.g. to memory-map the index rather than read it into memory.
+    """
+    index_path = metadata_path.with_suffix(".faiss")
+    index = _upgrade_faiss_id_map(faiss.read_index(str(index_path), io_flags))
+    bytes_per_vector = index_path.stat().st_size / max(index.ntotal, 1)
+    typer.secho(
+        (
+            f"{Emoji.SUCCESS.value} Index snapshot {metadata_path.stem} with {index.ntotal}"
+            f" vectors ({bytes_per_vector:.0f} bytes per vector) loaded successfully."
+        ),
+        fg=typer.colors.GREEN,
+        bold=True,
+    )
+    return index
+
+
+def load_faiss_index(
+    snapshot_dir: Union[str, Path], fingerprint: Dict[str, Any], io_flags: int = 0
+) -> Optional[faiss.Index]:
+    """Returns the most recent snapshot in `snapshot_dir` whose metadata matches `fingerprint`,
+    or None if there is no such snapshot. `io_flags` are passed to `faiss.read_index`.
+    """
+    metadata_path = find_faiss_index_snapshot(snapshot_dir, fingerprint)
+    return read_faiss_index_snapshot(metadata_path, io_flags) if metadata_path else None
+
+
+def normalize_documents(pmids: List[str]) -> Dict[str, str]:
+    """Returns a dictionary keyed by the PubMed uids in `pmids` of their text (i.e. title +
+    abstract). All uids are fetched together, and uids that can't be retrieved are omitted.
+    """
+    normalized_docs = {}
+    for doc in iter_uids_to_docs(list(dict.fromkeys(pmids))):
+        document = Document(**doc)
+        normalized_docs[document.uid] = document.text
+    return normalized_docs  # type: ignore
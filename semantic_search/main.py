@@ -1,22 +1,75 @@
+import asyncio
+import hashlib
+import hmac
+import importlib.util
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from http import HTTPStatus
-from operator import itemgetter
-from typing import List, Optional, Tuple, Union, cast
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Set, Tuple, Union
 
 import faiss
-import torch
-from fastapi import FastAPI, Request
+import numpy as np
+from fastapi import Depends, FastAPI, Request, Response
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    generate_latest,
+    multiprocess,
+)
 from pydantic import BaseSettings
+from starlette.routing import Match
 
 from semantic_search import __version__
+from semantic_search.common.batching import MicroBatcher
+from semantic_search.common.cache import EmbeddingCache
+from semantic_search.common.metrics import (
+    INDEX_BYTES,
+    INDEX_VECTORS,
+    REQUEST_LATENCY,
+    request_profiles,
+    request_timings,
+    time_stage,
+)
+from semantic_search.common.sharding import ShardedIndex, pack_arrays, unpack_arrays
+from semantic_search.common.sharing import Spool, WriterLock
 from semantic_search.common.util import (
+    MODEL_PRECISIONS,
+    ReadWriteLock,
     add_to_faiss_index,
-    encode_with_transformer,
+    copy_faiss_index_vectors,
+    empty_faiss_index_like,
+    encode_by_length,
+    faiss_index_fingerprint,
+    faiss_index_is_flat,
+    faiss_index_nbytes,
+    find_faiss_index_snapshot,
+    get_faiss_index_ids,
+    get_faiss_index_vectors,
+    list_faiss_index_ids,
+    load_faiss_index,
+    merge_faiss_search_results,
+    read_faiss_index_snapshot,
+    reconstruct_from_faiss_index,
+    sample_faiss_index_vectors,
+    save_faiss_index,
+    search_faiss_index,
+    set_faiss_search_parameters,
     setup_faiss_index,
+    quantize_model,
     setup_model_and_tokenizer,
+    storage_index_factory,
     normalize_documents,
+    run_in_executor,
+    save_model_and_tokenizer,
 )
-from semantic_search.schemas import Model, Search, TopMatch
+from semantic_search.ncbi import FetchError
+from semantic_search.schemas import BatchSearch, Document, Model, Search, TopMatch
 from loguru import logger
 import sys
 from pathlib import Path
@@ -24,6 +77,9 @@ from dotenv import load_dotenv
 import os
 from fastapi import HTTPException
 
+if TYPE_CHECKING:
+    import torch
+
 dot_env_filepath = Path(__file__).absolute().parent.parent / ".env"
 load_dotenv(dot_env_filepath)
 
@@ -50,72 +106,916 @@ class Settings(BaseSettings):
     """
 
     pretrained_model_name_or_path: str = "johngiorgi/declutr-sci-base"
+    # Inputs are embedded in batches of at most batch_size inputs and max_batch_tokens tokens,
+    # counting pads.
     batch_size: int = 64
+    max_batch_tokens: int = 16384
     max_length: Optional[int] = None
     mean_pool: bool = True
     cuda_device: int = -1
+    # The precision the model is run at: "float32", "int8" (dynamic quantization of its linear
+    # layers, CPU only) or "bf16" (bfloat16 autocast). Lower precisions embed faster, at a small
+    # cost in accuracy, which is reported at startup.
+    model_precision: str = "float32"
+    # Directory to snapshot the index to. If None, the index is not persisted across restarts.
+    index_snapshot_dir: Optional[str] = None
+    # Seconds between periodic snapshots. A value <= 0 only snapshots on shutdown.
+    index_snapshot_interval: int = 600
+    index_snapshot_keep: int = 2
+    # The type of index to store vectors in, as a faiss.index_factory description. "Flat" is
+    # exact, brute-force search. Approximate indices, e.g. "HNSW32" or "IVF4096,Flat", scale far
+    # better. Indices that need training start out flat, and are trained in the background once
+    # they hold index_train_size vectors.
+    index_factory: str = "Flat"
+    index_train_size: int = 100000
+    # Search-time parameters of HNSW and IVF indices. Larger values trade speed for recall.
+    hnsw_ef_search: int = 64
+    ivf_nprobe: int = 16
+    # The precision vectors are stored at: "float32", "fp16", "int8" or "pq" (product
+    # quantization), using 4, 2, 1 and 1/4 bytes per dimension. Anything but "fp16" needs training.
+    index_storage: str = "float32"
+    # Also keep each vector as is, and use it to re-score the best index_rescore_k_factor * top_k
+    # candidates of each search exactly. This recovers accuracy lost to index_storage, but not
+    # the memory saved.
+    index_rescore: bool = False
+    index_rescore_k_factor: float = 4.0
+    # Number of threads used to search the index, off of the event loop.
+    num_workers: int = 2
+    # Text from concurrent requests is embedded together in batches of up to this many items,
+    # waiting at most max_batch_wait milliseconds for a batch to fill up.
+    max_batch_size: int = 64
+    max_batch_wait: float = 5.0
+    # Number of threads used to fetch documents from NCBI.
+    num_io_workers: int = 8
+    # Memory (in MB) set aside for caching the embeddings of recently seen text. 0 disables it.
+    embedding_cache_size: int = 256
+    # Maximum number of documents to keep in the index. Once it is full, the least recently used
+    # documents (i.e. added, or returned by a search) are evicted. 0 means there is no limit.
+    index_max_size: int = 0
+    # Evicted documents are only marked as removed (a "tombstone"), and are actually removed from
+    # the index in the background once they make up this fraction of it.
+    index_compact_threshold: float = 0.1
+    # Share one index between the processes of `uvicorn --workers N`, through index_snapshot_dir.
+    # One process (the "writer") keeps the index in memory and snapshots it, while the others
+    # memory-map its latest snapshot. Each process passes the vectors it adds to the others
+    # through a spool directory, which they check every index_sync_interval seconds.
+    index_shared: bool = False
+    index_sync_interval: float = 1.0
+    # Partition the index across the shard servers at these URLs, rather than keeping it in this
+    # process. Documents are added to one shard, chosen by a hash of their uid, while searches are
+    # sent to every shard in parallel and their results merged.
+    index_shards: List[str] = []
+    index_shard_timeout: float = 30.0
+    # Serve this process's index as a shard of a sharded index, through the /shard endpoints.
+    # Shards only store and search vectors, so the model isn't loaded.
+    index_shard: bool = False
+    # Callers sending this token in the X-Profile-Token header may ask for a profile of their
+    # request, which needs pyinstrument (the "profile" extra). None disables profiling.
+    profile_token: Optional[str] = None
+    # Load the model and index in the background, so that the server answers health checks right
+    # away. Until they are loaded, /health/ready reports progress and searches fail with a 503.
+    load_in_background: bool = True
+    # Directory to keep a local copy of the model in, saved the first time the model is loaded.
+    # The copy's weights are in the safetensors format, which loads faster than downloading the
+    # model or unpickling its weights.
+    local_model_dir: Optional[str] = None
 
 
 settings = Settings()
 model = Model()
+# Searches and snapshots may read model.index concurrently, but not while it is being modified.
+index_lock = ReadWriteLock()
+# Held while an index is being trained or compacted, so that only one is rebuilt at a time.
+rebuild_lock = threading.Lock()
+# Vectors are copied to a rebuilt index this many at a time, each chunk under its own read lock.
+INDEX_COPY_CHUNK_SIZE = 65536
+# While the index is being compacted, the ids and embeddings added to it, and those of evicted
+# documents that were restored, so that they can be added to the compacted index as well.
+added_during_compaction: Optional[List[Tuple[List[int], np.ndarray]]] = None
+# The ids in model.indexed_ids, least recently used first, if settings.index_max_size is set.
+# Searches update it while only holding a read lock on the index, so it has a lock of its own.
+last_used: "OrderedDict[int, None]" = OrderedDict()
+last_used_lock = threading.Lock()
+# Selects model.tombstones, so they can be excluded from searches. Built lazily, and reset
+# whenever model.tombstones changes.
+tombstone_selector: Optional[faiss.IDSelector] = None
+stop_snapshots = threading.Event()
+# If settings.index_shared, elects the process that writes the shared index, and holds the
+# vectors each process adds until they are snapshot.
+writer_lock: Optional[WriterLock] = None
+spool: Optional[Spool] = None
+# The deltas in the spool this process has added to its view of the index.
+applied_deltas: Set[str] = set()
+# The snapshot this process has memory-mapped, if it only reads the shared index.
+mapped_snapshot: Optional[Path] = None
+stop_sync = threading.Event()
+# The shards of the index, if settings.index_shards. This process then only tracks their ids.
+shards: Optional[ShardedIndex] = None
+# The stage of loading the model and index startup is at, or None once the server is ready to
+# serve searches, the time loading started and took, and the error it failed with, if any.
+loading_stage: Optional[str] = "starting"
+loading_started = time.monotonic()
+loading_time: Optional[float] = None
+loading_error: Optional[str] = None
+# Searching is CPU-bound, so it gets a small, bounded pool. Fetching documents is I/O-bound and
+# can afford more threads.
+executor = ThreadPoolExecutor(max_workers=settings.num_workers)
+io_executor = ThreadPoolExecutor(max_workers=settings.num_io_workers)
+embedding_cache = (
+    EmbeddingCache(settings.embedding_cache_size * 2**20)
+    if settings.embedding_cache_size > 0
+    else None
+)
+# Text embedded at startup to check how much a reduced settings.model_precision changes
+# embeddings.
+PRECISION_REFERENCE_TEXT = [
+    "The Drosophila activin receptor baboon signals through dSmad2 and controls cell"
+    " proliferation but not patterning during larval development.",
+    "Drosophila dSmad2 and Atr-I transmit activin/TGFbeta signals.",
+    "R-Smad competition controls activin receptor output in Drosophila.",
+    "Distinct signaling of Drosophila Activin/TGF-beta family members.",
+    "BRCA1 and BRCA2: different roles in a common pathway of genome protection.",
+    "Hallmarks of cancer: the next generation.",
+    "mTOR signaling in growth control and disease.",
+    "Structure of the SARS-CoV-2 spike receptor-binding domain bound to the ACE2 receptor.",
+]
+
+
+def embedding_cache_key(text: str) -> str:
+    """Returns the key `text` is cached under in `embedding_cache`. The key covers every setting
+    that affects the embedding, so that embeddings are never reused across models.
+    """
+    key = [
+        settings.pretrained_model_name_or_path,
+        settings.model_precision,
+        settings.mean_pool,
+        settings.max_length,
+        text,
+    ]
+    return hashlib.sha256(json.dumps(key).encode()).hexdigest()
 
 
-def encode(text: Union[str, List[str]]) -> torch.Tensor:
+def encode(text: Union[str, List[str]]) -> "torch.Tensor":
     if isinstance(text, str):
         text = [text]
-    # Sort the inputs by length, maintaining the original indices so we can un-sort
-    # before returning the embeddings. This speeds up embedding by minimizing the
-    # amount of computation performed on pads. Because this sorting happens before
-    # tokenization, it is only a proxy of the true lengths of the inputs to the model.
-    # In the future, it would be better to sort by length *after* tokenization which
-    # would lead to an even larger speedup.
-    # https://stackoverflow.com/questions/8372399/zip-with-list-output-instead-of-tuple
-    sorted_indices, text = cast(
-        Tuple[Tuple[int], List[str]], zip(*sorted(enumerate(text), key=itemgetter(1)))
-    )  # tell mypy explicitly the types of items in the unpacked tuple
-    unsorted_indices, _ = zip(*sorted(enumerate(sorted_indices), key=itemgetter(1)))
-
-    embeddings: torch.Tensor = []
-    for i in range(0, len(text), settings.batch_size):
-        embedding = encode_with_transformer(
-            list(text[i : i + settings.batch_size]),
-            tokenizer=model.tokenizer,
-            model=model.model,
-            mean_pool=settings.mean_pool,
+    if embedding_cache is None:
+        return _encode(text)
+
+    # Only embed the text we haven't seen before, and each distinct text only once.
+    keys = [embedding_cache_key(t) for t in text]
+    embeddings = [embedding_cache.get(key) for key in keys]
+    missing: Dict[str, int] = {}
+    for i, (key, embedding) in enumerate(zip(keys, embeddings)):
+        if embedding is None:
+            missing.setdefault(key, i)
+    if missing:
+        new_embeddings = dict(zip(missing, _encode([text[i] for i in missing.values()])))
+        for key, embedding in new_embeddings.items():
+            embedding_cache.set(key, embedding)
+        embeddings = [
+            new_embeddings[key] if embedding is None else embedding
+            for key, embedding in zip(keys, embeddings)
+        ]
+    import torch
+
+    device = next(model.model.parameters()).device
+    return torch.stack([embedding.to(device) for embedding in embeddings])  # type: ignore
+
+
+def _encode(text: List[str], reference_model: Optional["torch.nn.Module"] = None) -> "torch.Tensor":
+    """Embeds `text` with `model.model` at `settings.model_precision` or, if provided, with
+    `reference_model` at full precision.
+    """
+    return encode_by_length(
+        text,
+        tokenizer=model.tokenizer,
+        model=model.model if reference_model is None else reference_model,
+        max_length=settings.max_length,
+        mean_pool=settings.mean_pool,
+        max_tokens=settings.max_batch_tokens,
+        max_batch_size=settings.batch_size,
+        precision=settings.model_precision if reference_model is None else "float32",
+    )
+
+
+def check_model_precision(reference_model: "torch.nn.Module") -> "torch.Tensor":
+    """Logs how closely the embeddings of `PRECISION_REFERENCE_TEXT` at
+    `settings.model_precision` match those of `reference_model` at full precision, and returns
+    the cosine similarity of each pair.
+    """
+    import torch
+
+    embeddings = _encode(PRECISION_REFERENCE_TEXT)
+    reference_embeddings = _encode(PRECISION_REFERENCE_TEXT, reference_model=reference_model)
+    similarity = torch.cosine_similarity(embeddings, reference_embeddings)
+    logger.info(
+        f"Cosine similarity of {settings.model_precision} to float32 embeddings of"
+        f" {len(similarity)} reference texts: mean {similarity.mean():.4f},"
+        f" min {similarity.min():.4f}"
+    )
+    return similarity
+
+
+# Embeds the text of concurrent requests together, rather than running many small forward passes.
+# A single thread is used as the tokenizer can't be called concurrently, and each forward pass
+# already makes use of every core.
+encoder = MicroBatcher(
+    encode, max_batch_size=settings.max_batch_size, max_wait=settings.max_batch_wait / 1000
+)
+
+
+def index_fingerprint() -> Dict[str, Any]:
+    """Returns the fingerprint of index snapshots built with the current `settings`."""
+    return faiss_index_fingerprint(
+        settings.pretrained_model_name_or_path,
+        embedding_dim=model.config.hidden_size,
+        mean_pool=settings.mean_pool,
+        max_length=settings.max_length,
+        index_factory=index_description(),
+    )
+
+
+def snapshot_index() -> None:
+    """Snapshots `model.index` to `settings.index_snapshot_dir`."""
+    # Only copy the index under the lock, so that adds (and so searches, which queue behind a
+    # waiting add) aren't held up while it is written to disk.
+    with index_lock.read():
+        # Every delta applied so far is in the index, and so in the snapshot.
+        snapshot_deltas = list(applied_deltas)
+        serialized = faiss.serialize_index(model.index)
+        ntotal = model.index.ntotal
+    index_path = save_faiss_index(
+        serialized,
+        settings.index_snapshot_dir,  # type: ignore
+        fingerprint=index_fingerprint(),
+        keep=settings.index_snapshot_keep,
+        ntotal=ntotal,
+    )
+    if spool is not None:
+        spool.remove(snapshot_deltas)
+    logger.info(
+        f"Saved index snapshot {index_path} with {ntotal} vectors"
+        f" ({index_path.stat().st_size / max(ntotal, 1):.0f} bytes per vector)"
+    )
+
+
+def snapshot_index_periodically() -> None:
+    last_ntotal = model.index.ntotal
+    while not stop_snapshots.wait(settings.index_snapshot_interval):
+        # Don't bother writing a snapshot if nothing has been added since the last one.
+        if model.index.ntotal == last_ntotal:
+            continue
+        try:
+            snapshot_index()
+            last_ntotal = model.index.ntotal
+        except Exception as e:
+            logger.error(f"Error encountered in snapshot_index: {e}")
+
+
+def index_description() -> str:
+    """Returns the description of the index configured by `settings`, as passed to
+    `setup_faiss_index`.
+    """
+    description = storage_index_factory(
+        settings.index_factory, settings.index_storage, model.config.hidden_size
+    )
+    return f"{description},RFlat" if settings.index_rescore else description
+
+
+def set_search_parameters(index: faiss.Index) -> None:
+    set_faiss_search_parameters(
+        index,
+        efSearch=settings.hnsw_ef_search,
+        nprobe=settings.ivf_nprobe,
+        k_factor_rf=settings.index_rescore_k_factor,
+    )
+
+
+def setup_index() -> faiss.Index:
+    """Returns a new, empty index to store embeddings in, as configured by `settings`."""
+    embedding_dim = model.config.hidden_size
+    index = setup_faiss_index(embedding_dim, index_description())
+    # Indices that need training start out flat, until there are enough vectors to train them on.
+    if not index.is_trained:
+        index = setup_faiss_index(embedding_dim)
+    return index
+
+
+def index_needs_training() -> bool:
+    """Returns True if `model.index` is a flat stand-in for an index which needs training, and
+    there are enough vectors to train it on.
+    """
+    return (
+        index_description() != "Flat"
+        and faiss_index_is_flat(model.index)
+        and model.index.ntotal >= settings.index_train_size
+    )
+
+
+def copy_index_in_chunks(copy: Callable[[int, int], None], stop: Optional[int] = None) -> int:
+    """Calls `copy(start, stop)` for consecutive chunks of the positions in `model.index`, up to
+    `stop` or, by default, until it has caught up with the vectors being added, and returns the
+    position it copied up to. Each chunk is copied under its own read lock, so that adds, and the
+    searches queued behind them, are never held up for long.
+    """
+    start = 0
+    while True:
+        with index_lock.read():
+            end = min(start + INDEX_COPY_CHUNK_SIZE, model.index.ntotal if stop is None else stop)
+            if end <= start:
+                return start
+            copy(start, end)
+        start = end
+
+
+def train_index() -> None:
+    """Replaces `model.index` with an index built from `index_description()`, trained on a sample
+    of the vectors it holds. Searches continue against the old index while the new one is trained.
+    """
+    if not rebuild_lock.acquire(blocking=False):
+        return
+    try:
+        with index_lock.read():
+            if not index_needs_training():
+                return
+            sample = sample_faiss_index_vectors(model.index, settings.index_train_size)
+        logger.info(f"Training a {index_description()} index on {len(sample)} vectors")
+        index = setup_faiss_index(model.config.hidden_size, index_description())
+        index.train(sample)
+        empty_index = empty_faiss_index_like(index) if settings.index_max_size > 0 else None
+        set_search_parameters(index)
+
+        def copy(start: int, stop: int) -> None:
+            # The vectors of the flat index are stored as is, so they are simply added again.
+            add_to_faiss_index(*get_faiss_index_vectors(model.index, start, stop), index)
+
+        copied = copy_index_in_chunks(copy)
+        with index_lock.write():
+            # Carry over any vectors that were added since the last chunk was copied.
+            copy(copied, model.index.ntotal)
+            model.index, model.empty_index = index, empty_index
+        logger.info(f"Trained a {index_description()} index on {len(sample)} vectors")
+    except Exception as e:
+        logger.error(f"Error encountered in train_index: {e}")
+    finally:
+        rebuild_lock.release()
+
+
+def index_needs_compaction() -> bool:
+    """Returns True if enough of `model.index` has been evicted that it should be compacted."""
+    return len(model.tombstones) > settings.index_compact_threshold * model.index.ntotal
+
+
+def compact_index() -> None:
+    """Replaces `model.index` with a copy that leaves out the evicted vectors in
+    `model.tombstones`. Searches continue against the old index while the copy is built.
+    """
+    global added_during_compaction, tombstone_selector
+    if not rebuild_lock.acquire(blocking=False):
+        return
+    try:
+        with index_lock.read():
+            if not index_needs_compaction():
+                return
+            removed = set(model.tombstones)
+            # Vectors added from here on are added to the compacted index from their embeddings.
+            ntotal = model.index.ntotal
+            added: List[Tuple[List[int], np.ndarray]] = []
+            added_during_compaction = added
+        index = empty_faiss_index_like(model.empty_index)
+        set_search_parameters(index)
+        # The evicted vectors that were left out, some of which may be restored meanwhile.
+        left_out: Set[int] = set()
+
+        def copy(start: int, stop: int) -> None:
+            ids = np.asarray(list_faiss_index_ids(model.index, start, stop))
+            # Documents restored before their chunk is copied are simply kept.
+            evicted = np.isin(ids, list(removed & model.tombstones))
+            left_out.update(ids[evicted].tolist())
+            copy_faiss_index_vectors(model.index, index, start + np.flatnonzero(~evicted))
+
+        copy_index_in_chunks(copy, stop=ntotal)
+        index.construct_rev_map()
+        with index_lock.write():
+            # Add the vectors that were added while the copy was being built, and those of any of
+            # the evicted documents left out that were restored in the meantime.
+            restored = {id_ for id_ in left_out if id_ not in model.tombstones}
+            for ids, embeddings in added:
+                add = [i for i, id_ in enumerate(ids) if id_ in restored or id_ not in removed]
+                add_to_faiss_index([ids[i] for i in add], embeddings[add], index)
+            # Only the vectors left out are gone. Those restored before they were copied may
+            # have been evicted again since, and are still tombstones.
+            model.tombstones -= left_out
+            tombstone_selector = None
+            model.index = index
+        logger.info(f"Compacted the index, removing {len(left_out) - len(restored)} vectors")
+    except Exception as e:
+        logger.error(f"Error encountered in compact_index: {e}")
+    finally:
+        added_during_compaction = None
+        rebuild_lock.release()
+
+
+def rebuild_index() -> None:
+    """Trains and/or compacts `model.index`, as needed."""
+    train_index()
+    compact_index()
+    update_index_metrics()
+
+
+def is_writer() -> bool:
+    """Returns True if this process may modify `model.index`, i.e. it isn't sharing the index or
+    it is the shared index's writer.
+    """
+    return writer_lock is None or writer_lock.held
+
+
+def map_snapshot() -> None:
+    """Memory-maps the latest snapshot of the shared index as `model.index`, if it is newer than
+    the one currently mapped. Vectors in `model.overlay` that aren't in the snapshot are kept.
+    """
+    global mapped_snapshot
+    metadata_path = find_faiss_index_snapshot(
+        settings.index_snapshot_dir, index_fingerprint(), warn=False  # type: ignore
+    )
+    if metadata_path is None or metadata_path == mapped_snapshot:
+        return
+    # Only the vectors are mapped, so each process still holds its own copy of the ids (and of
+    # the graph, for HNSW indices).
+    index = read_faiss_index_snapshot(
+        metadata_path, io_flags=faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY
+    )
+    set_search_parameters(index)
+    indexed_ids = get_faiss_index_ids(index)
+    with index_lock.write():
+        overlay = None
+        if model.overlay is not None:
+            ids, vectors = get_faiss_index_vectors(model.overlay)
+            keep = np.isin(ids, list(indexed_ids), invert=True)
+            if keep.any():
+                overlay = setup_faiss_index(model.config.hidden_size)
+                add_to_faiss_index(ids[keep], vectors[keep], overlay, indexed_ids)
+        model.index, model.overlay, model.indexed_ids = index, overlay, indexed_ids
+        mapped_snapshot = metadata_path
+
+
+def promote_to_writer() -> None:
+    """Makes this process the writer of the shared index, e.g. after the previous writer exited,
+    by replacing its memory-mapped view of the index with a copy it can modify.
+    """
+    global mapped_snapshot
+    index = load_faiss_index(settings.index_snapshot_dir, index_fingerprint())  # type: ignore
+    if index is None:
+        index = setup_index()
+    set_search_parameters(index)
+    indexed_ids = get_faiss_index_ids(index)
+    with index_lock.write():
+        if model.overlay is not None:
+            ids, vectors = get_faiss_index_vectors(model.overlay)
+            keep = np.isin(ids, list(indexed_ids), invert=True)
+            add_to_faiss_index(ids[keep], vectors[keep], index, indexed_ids)
+        model.index, model.overlay, model.indexed_ids = index, None, indexed_ids
+        mapped_snapshot = None
+    logger.info(f"Became the writer of the shared index, with {index.ntotal} vectors")
+    if settings.index_snapshot_interval > 0:
+        stop_snapshots.clear()
+        threading.Thread(target=snapshot_index_periodically, daemon=True).start()
+
+
+def sync_index() -> None:
+    """Brings this process's view of the shared index up to date: takes over as the writer if
+    there is none, picks up the writer's latest snapshot if this process only reads the index,
+    and adds the vectors other processes have written to the spool since the last call.
+    """
+    if not writer_lock.held:  # type: ignore
+        if writer_lock.acquire():  # type: ignore
+            promote_to_writer()
+        else:
+            map_snapshot()
+    names = spool.names()  # type: ignore
+    # Forget the deltas that have since been removed, so that this doesn't grow forever.
+    applied_deltas.intersection_update(names)
+    for name in names:
+        if name in applied_deltas:
+            continue
+        delta = spool.read(name)  # type: ignore
+        if delta is not None:
+            ids, vectors = delta
+            add_to_index(ids.tolist(), vectors, publish=False)
+        applied_deltas.add(name)
+
+
+def sync_index_periodically() -> None:
+    while not stop_sync.wait(settings.index_sync_interval):
+        try:
+            sync_index()
+        except Exception as e:
+            logger.error(f"Error encountered in sync_index: {e}")
+
+
+def touch(ids: List[int]) -> None:
+    """Marks the indexed documents `ids` as recently used, so that they are evicted last."""
+    if settings.index_max_size > 0:
+        with last_used_lock:
+            for id_ in ids:
+                if id_ in last_used:
+                    last_used.move_to_end(id_)
+
+
+def evict() -> None:
+    """Evicts the least recently used documents from `model.index` until it holds at most
+    `settings.index_max_size` documents. Must be called while holding the write lock.
+    """
+    global tombstone_selector
+    with last_used_lock:
+        while len(last_used) > settings.index_max_size:
+            id_, _ = last_used.popitem(last=False)
+            model.indexed_ids.discard(id_)
+            model.tombstones.add(id_)
+            tombstone_selector = None
+
+
+def update_index_metrics() -> None:
+    """Sets the `INDEX_VECTORS` and `INDEX_BYTES` gauges to the current size of the index."""
+    with index_lock.read():
+        if shards is not None:
+            # The vectors are held by the shards, which report their own size.
+            INDEX_VECTORS.set(len(model.indexed_ids))
+            INDEX_BYTES.set(0)
+            return
+        indices = [index for index in (model.index, model.overlay) if index is not None]
+        INDEX_VECTORS.set(sum(index.ntotal for index in indices))
+        INDEX_BYTES.set(sum(faiss_index_nbytes(index) for index in indices))
+
+
+@time_stage("index_add")
+def add_to_index(ids: List[int], embeddings: np.ndarray, publish: bool = True) -> None:
+    """Adds `embeddings` to `model.index` under `ids`, skipping any id already in the index. If
+    the index is shared and `publish`, the new embeddings are also passed to the other processes.
+    """
+    global tombstone_selector
+    if shards is not None:
+        with index_lock.read():
+            new = [i for i, id_ in enumerate(ids) if id_ not in model.indexed_ids]
+        if new:
+            # Only count the documents as indexed once a shard has them.
+            shards.add([ids[i] for i in new], embeddings[new])
+            with index_lock.write():
+                model.indexed_ids.update(ids[i] for i in new)
+            update_index_metrics()
+        return
+    with index_lock.write():
+        # Another request may have added some of these ids while they were being embedded.
+        new = [i for i, id_ in enumerate(ids) if id_ not in model.indexed_ids]
+        if added_during_compaction is not None and new:
+            added_during_compaction.append(([ids[i] for i in new], embeddings[new]))
+        # Evicted documents that haven't been compacted away yet are restored as they are.
+        restored = [ids[i] for i in new if ids[i] in model.tombstones]
+        if restored:
+            model.tombstones.difference_update(restored)
+            model.indexed_ids.update(restored)
+            tombstone_selector = None
+            new = [i for i in new if ids[i] not in model.indexed_ids]
+        new_ids = [ids[i] for i in new]
+        if new and not is_writer():
+            if model.overlay is None:
+                model.overlay = setup_faiss_index(model.config.hidden_size)
+            add_to_faiss_index(new_ids, embeddings[new], model.overlay, model.indexed_ids)
+        elif new:
+            add_to_faiss_index(new_ids, embeddings[new], model.index, model.indexed_ids)
+        if settings.index_max_size > 0:
+            with last_used_lock:
+                last_used.update((id_, None) for id_ in restored + new_ids)
+            evict()
+        needs_rebuild = is_writer() and (index_needs_training() or index_needs_compaction())
+    if new and publish and spool is not None:
+        applied_deltas.add(spool.write(new_ids, embeddings[new]))
+    if new:
+        update_index_metrics()
+    if needs_rebuild:
+        threading.Thread(target=rebuild_index, daemon=True).start()
+
+
+@time_stage("index_search")
+def search_index(query_embeddings: np.ndarray, top_k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the scores and ids of the `top_k` nearest neighbours of each of `query_embeddings`
+    (one row per query).
+    """
+    global tombstone_selector
+    if shards is not None:
+        return shards.search(query_embeddings, top_k)
+    with index_lock.read():
+        excluded = None
+        if model.tombstones:
+            if tombstone_selector is None:
+                tombstone_selector = faiss.IDSelectorBatch(
+                    np.fromiter(model.tombstones, dtype="int64", count=len(model.tombstones))
+                )
+            excluded = tombstone_selector
+        # Can't search for more items than exist in the index
+        k = min(model.index.ntotal - len(model.tombstones), top_k)
+        if model.overlay is None and k <= 0:
+            empty = np.empty((len(query_embeddings), 0))
+            return empty.astype("float32"), empty.astype("int64")
+        if model.overlay is None:
+            return search_faiss_index(model.index, query_embeddings, k, excluded)
+        results = [
+            search_faiss_index(model.overlay, query_embeddings, min(model.overlay.ntotal, top_k))
+        ]
+        if k > 0:
+            results.append(search_faiss_index(model.index, query_embeddings, k, excluded))
+        return merge_faiss_search_results(results, top_k)
+
+
+def get_indexed_embeddings(ids: List[int]) -> np.ndarray:
+    """Returns the (normalized) embeddings stored in `model.index` for the indexed documents
+    `ids`. Fails with a 409 if any of them have been evicted, e.g. by a request adding other
+    documents in the meantime.
+    """
+    with index_lock.read():
+        evicted = [id_ for id_ in ids if id_ not in model.indexed_ids]
+    if evicted:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Documents {evicted[:10]} were evicted from the index while handling the"
+            f" request. Retry it, or send fewer than INDEX_MAX_SIZE ({settings.index_max_size})"
+            " documents at once",
+        )
+    if shards is not None:
+        return shards.reconstruct(ids)
+    with index_lock.read():
+        if model.overlay is None:
+            return reconstruct_from_faiss_index(model.index, ids)
+        overlay_ids = get_faiss_index_ids(model.overlay)
+        in_overlay = [i for i, id_ in enumerate(ids) if id_ in overlay_ids]
+        in_index = [i for i, id_ in enumerate(ids) if id_ not in overlay_ids]
+        embeddings = np.empty((len(ids), model.index.d), dtype="float32")
+        embeddings[in_overlay] = reconstruct_from_faiss_index(
+            model.overlay, [ids[i] for i in in_overlay]
         )
-        embeddings.append(embedding)
-    embeddings = torch.cat(embeddings)
+        embeddings[in_index] = reconstruct_from_faiss_index(model.index, [ids[i] for i in in_index])
+        return embeddings
 
-    # Unsort the embedded text so that it is returned in the same order it was recieved.
-    unsorted_indices = torch.as_tensor(unsorted_indices, dtype=torch.long, device=embeddings.device)
-    embeddings = torch.index_select(embeddings, dim=0, index=unsorted_indices)
 
-    return embeddings
+@time_stage("index_search")
+def score_documents(query_embeddings: np.ndarray, ids: List[int]) -> np.ndarray:
+    """Returns the similarity of each of `query_embeddings` (one row per query) to each of the
+    indexed documents `ids`. Only the vectors of these documents are looked up, so this scales
+    with `len(ids)` rather than the size of the index.
+    """
+    norms = np.linalg.norm(query_embeddings, axis=-1, keepdims=True)
+    return (query_embeddings / norms) @ get_indexed_embeddings(ids).T
+
+
+def check_settings() -> None:
+    """Raises a ValueError if `settings` are invalid, or can't be used together."""
+    if settings.model_precision not in MODEL_PRECISIONS:
+        raise ValueError(
+            f"model_precision must be one of {MODEL_PRECISIONS}, got {settings.model_precision!r}"
+        )
+    if settings.profile_token is not None and importlib.util.find_spec("pyinstrument") is None:
+        raise ValueError(
+            "profile_token requires pyinstrument, e.g. pip install semantic-search[profile]"
+        )
+    if settings.index_shard and settings.index_shards:
+        raise ValueError("index_shard and index_shards can't both be set")
+    if (settings.index_shard or settings.index_shards) and settings.index_max_size > 0:
+        # Documents evicted by a shard would still count as indexed by the coordinator.
+        raise ValueError("index_max_size is not supported with a sharded index")
+    if settings.index_shards and settings.index_shared:
+        raise ValueError("index_shared is not supported with index_shards")
+    if settings.index_shared and settings.index_snapshot_dir is None:
+        raise ValueError("index_shared requires index_snapshot_dir to be set")
+    if settings.index_shared and settings.index_max_size > 0:
+        raise ValueError("index_max_size is not supported with index_shared")
+
+
+def set_loading_stage(stage: Optional[str]) -> None:
+    """Records that startup has reached `stage`, or, if None, that it is done."""
+    global loading_stage, loading_time
+    loading_stage = stage
+    if stage is None:
+        loading_time = time.monotonic() - loading_started
+        logger.info(f"Ready to serve searches, after {loading_time:.1f}s")
+    else:
+        logger.info(f"Startup: {stage}")
+
+
+def load_model() -> None:
+    """Loads `model.model` and `model.tokenizer`, from `settings.local_model_dir` if it holds a
+    copy of the model, and otherwise from `settings.pretrained_model_name_or_path`, saving a copy
+    to `settings.local_model_dir` if it is set. Shards only load `model.config`.
+    """
+    path = settings.pretrained_model_name_or_path
+    if settings.local_model_dir is not None and Path(settings.local_model_dir).is_dir():
+        path = settings.local_model_dir
+    if settings.index_shard:
+        from transformers import AutoConfig
+
+        model.config = AutoConfig.from_pretrained(path)
+        return
+    model.tokenizer, model.model = setup_model_and_tokenizer(path, cuda_device=settings.cuda_device)
+    model.config = model.model.config
+    if settings.local_model_dir is not None and path != settings.local_model_dir:
+        save_model_and_tokenizer(model.tokenizer, model.model, settings.local_model_dir)
+    if settings.model_precision != "float32":
+        set_loading_stage("checking model precision")
+        reference_model = model.model
+        if settings.model_precision == "int8":
+            model.model = quantize_model(reference_model)
+        check_model_precision(reference_model)
+        del reference_model
 
 
-@app.on_event("startup")
 def app_startup():
+    """Loads the model and the index, after which the server is ready to serve searches."""
+    global tombstone_selector, writer_lock, spool, mapped_snapshot, shards, loading_started
+    global loading_error
 
-    model.tokenizer, model.model = setup_model_and_tokenizer(
-        settings.pretrained_model_name_or_path, cuda_device=settings.cuda_device
-    )
-    embedding_dim = model.model.config.hidden_size
-    model.index = setup_faiss_index(embedding_dim)
+    loading_started, loading_error = time.monotonic(), None
+    set_loading_stage("loading model")
+    load_model()
+    shards = None
+    if settings.index_shards:
+        set_loading_stage("connecting to index shards")
+        shards = ShardedIndex(
+            settings.index_shards, model.config.hidden_size, settings.index_shard_timeout
+        )
+        model.index, model.overlay, model.tombstones = None, None, set()
+        model.indexed_ids = shards.ids()
+        logger.info(f"Using {len(shards)} index shards, with {len(model.indexed_ids)} vectors")
+        set_loading_stage(None)
+        return
+
+    set_loading_stage("loading index")
+    writer_lock, spool, mapped_snapshot = None, None, None
+    applied_deltas.clear()
+    if settings.index_shared:
+        writer_lock = WriterLock(Path(settings.index_snapshot_dir) / "writer.lock")
+        spool = Spool(Path(settings.index_snapshot_dir) / "spool")
+        writer_lock.acquire()
+    model.index, model.overlay = None, None
+    model.tombstones = set()
+    tombstone_selector = None
+    if is_writer():
+        if settings.index_snapshot_dir is not None:
+            model.index = load_faiss_index(settings.index_snapshot_dir, index_fingerprint())
+        if model.index is None:
+            model.index = setup_index()
+        set_search_parameters(model.index)
+        model.indexed_ids = get_faiss_index_ids(model.index)
+        if settings.index_max_size > 0:
+            model.empty_index = empty_faiss_index_like(model.index)
+    else:
+        # Start from an empty index, in case the writer hasn't written a snapshot yet.
+        model.index = setup_index()
+        model.indexed_ids = set()
+        map_snapshot()
+    if settings.index_max_size > 0:
+        # Usage isn't persisted, so treat the documents added most recently as most recently used.
+        last_used.clear()
+        last_used.update((id_, None) for id_ in list_faiss_index_ids(model.index))
+        evict()
+    if is_writer() and (index_needs_training() or index_needs_compaction()):
+        threading.Thread(target=rebuild_index, daemon=True).start()
+
+    if spool is not None:
+        # Pick up any vectors added since the last snapshot, including by processes that have
+        # since exited.
+        set_loading_stage("syncing shared index")
+        sync_index()
+        stop_sync.clear()
+        threading.Thread(target=sync_index_periodically, daemon=True).start()
+    if (
+        is_writer()
+        and settings.index_snapshot_dir is not None
+        and settings.index_snapshot_interval > 0
+    ):
+        stop_snapshots.clear()
+        threading.Thread(target=snapshot_index_periodically, daemon=True).start()
+    set_loading_stage(None)
+
+
+def load_in_background() -> None:
+    global loading_error
+    try:
+        app_startup()
+    except Exception as e:
+        loading_error = f"{type(e).__name__}: {e}"
+        logger.exception("Error encountered while loading the model and index")
+
+
+@app.on_event("startup")
+def start_loading():
+    # Check the settings up front, so that the server fails to start if they are invalid.
+    check_settings()
+    if settings.load_in_background:
+        threading.Thread(target=load_in_background, daemon=True).start()
+    else:
+        app_startup()
+
+
+@app.on_event("shutdown")
+def app_shutdown():
+    stop_snapshots.set()
+    stop_sync.set()
+    # Don't overwrite the last snapshot with a partially loaded index.
+    ready = loading_stage is None
+    if ready and settings.index_snapshot_dir is not None and shards is None and is_writer():
+        snapshot_index()
+    if writer_lock is not None:
+        writer_lock.release()
 
 
 @app.middleware("http")
 async def log_middle(request: Request, call_next):
 
+    start = time.perf_counter()
     response = await call_next(request)
+    elapsed = time.perf_counter() - start
     status = response.status_code
     method = request.method
     path = request.url.path
     user_agent = request.headers.get("User-Agent")
-    logger.info(f"{method} {path} {status} {user_agent}")
+    logger.info(f"{method} {path} {status} {user_agent} {elapsed * 1000:.1f}ms")
+    # Label requests by the path of their route, so that unknown paths don't each get a series.
+    route = next(
+        (route.path for route in app.routes if route.matches(request.scope)[0] == Match.FULL),
+        "<unmatched>",
+    )
+    REQUEST_LATENCY.labels(method, route, status).observe(elapsed)
 
     return response
 
 
+def _request_option(request: Request, name: str) -> Optional[str]:
+    """Returns the value of the option `name` of `request`, given as a query parameter or an
+    X-`name` header, or None if it isn't set.
+    """
+    value = request.query_params.get(name, request.headers.get(f"X-{name}"))
+    if value is None or value.lower() in ("", "0", "false", "no"):
+        return None
+    return value.lower()
+
+
+@app.middleware("http")
+async def time_request(request: Request, call_next):
+    """If a request sets the `timing` option, adds a Server-Timing header breaking down the time
+    taken by each stage of the request. If it sets the `profile` option (and sends the
+    `profile_token`), profiles the request and returns the profile, as text or, if the option is
+    "html", as HTML, in place of the response.
+    """
+    timing = _request_option(request, "timing")
+    profile = _request_option(request, "profile")
+    if timing is None and profile is None:
+        return await call_next(request)
+    if profile is not None and (
+        settings.profile_token is None
+        or not hmac.compare_digest(
+            request.headers.get("X-Profile-Token", ""), settings.profile_token
+        )
+    ):
+        return JSONResponse({"detail": "Profiling requires a valid X-Profile-Token"}, 403)
+
+    timings: Dict[str, float] = {}
+    timings_token = request_timings.set(timings)
+    profiler = None
+    profiles: List[Any] = []
+    profiles_token = request_profiles.set(profiles if profile is not None else None)
+    if profile is not None:
+        from pyinstrument import Profiler
+
+        # This samples the event loop. The work the request hands off to the thread pools and to
+        # the encoder's thread is profiled on those threads, and added to `profiles`.
+        profiler = Profiler(async_mode="enabled")
+        profiler.start()
+    start = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        timings["total"] = time.perf_counter() - start
+        request_timings.reset(timings_token)
+        request_profiles.reset(profiles_token)
+        if profiler is not None:
+            profiler.stop()
+    if profiler is not None:
+        from pyinstrument.renderers import ConsoleRenderer, HTMLRenderer
+        from pyinstrument.session import Session
+
+        # The profile of each thread is shown as its own call tree.
+        session = profiler.last_session
+        for thread_session in profiles:
+            session = Session.combine(session, thread_session)
+        if profile == "html":
+            response = HTMLResponse(HTMLRenderer().render(session))
+        else:
+            response = PlainTextResponse(ConsoleRenderer().render(session))
+    response.headers["Server-Timing"] = ", ".join(
+        f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items()
+    )
+    return response
+
+
 @app.get("/", tags=["General"])
 def index(request: Request):
     """Health check."""
@@ -129,62 +1029,267 @@ def index(request: Request):
     return response
 
 
-@app.post("/search", tags=["Search"], response_model=List[TopMatch])
-async def search(search: Search):
-    """Returns the `top_k` most similar documents to `query` from the provided list of `documents`
-    and the index. When docs_only is True, returns all `documents` provided, and disregards `top_k`.
+@app.get("/health/live", tags=["General"])
+def liveness():
+    """Liveness check. Fails only if loading the model or index failed, in which case the server
+    should be restarted.
+    """
+    if loading_error is not None:
+        return JSONResponse({"status": "failed", "error": loading_error}, 503)
+    return {"status": "alive"}
+
+
+@app.get("/health/ready", tags=["General"])
+def readiness():
+    """Readiness check. Succeeds once the model and index are loaded. Until then, fails, reporting
+    the stage of loading reached and the seconds elapsed.
     """
-    ids = [int(doc.uid) for doc in search.documents]
-    texts = [document.text for document in search.documents]
+    if loading_error is not None:
+        return JSONResponse({"status": "failed", "error": loading_error}, 503)
+    if loading_stage is not None:
+        elapsed = round(time.monotonic() - loading_started, 1)
+        return JSONResponse({"status": "loading", "stage": loading_stage, "elapsed": elapsed}, 503)
+    return {"status": "ready", "loading_time": round(loading_time, 1)}  # type: ignore
+
+
+def require_ready() -> None:
+    """Fails requests that need the model or index with a 503 until they are loaded."""
+    if loading_error is not None:
+        raise HTTPException(status_code=503, detail=f"Loading failed: {loading_error}")
+    if loading_stage is not None:
+        raise HTTPException(
+            status_code=503, detail=f"Not ready: {loading_stage}", headers={"Retry-After": "1"}
+        )
+
+
+def require_shard() -> None:
+    """Hides the /shard endpoints of servers that aren't a shard of a sharded index, so that
+    clients can't add vectors to, or list, their index.
+    """
+    if not settings.index_shard:
+        raise HTTPException(status_code=404, detail="Not Found")
+
+
+def require_model() -> None:
+    """Fails searches sent to a shard of a sharded index, which only loads the model's config."""
+    if settings.index_shard:
+        raise HTTPException(
+            status_code=409,
+            detail="This server is a shard of a sharded index, send searches to its coordinator",
+        )
+
+
+@app.get("/metrics", tags=["General"])
+def metrics():
+    """Prometheus metrics, e.g. the latency of each stage of a search and the size of the index."""
+    if loading_stage is None:
+        update_index_metrics()
+    registry = REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        # Collect the metrics of every worker process, not just the one serving this request.
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(content=generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+
+async def embed_and_index(queries: List[Document], documents: List[Document]) -> np.ndarray:
+    """Adds any of `documents` not already in the index to it, and returns the embeddings of
+    `queries`, one row per query. The text of queries and documents that isn't provided is fetched
+    from PubMed in a single batch, except for queries that are already indexed, whose stored
+    embeddings are reused.
+    """
+    ids = [int(doc.uid) for doc in documents]
+    texts = [document.text for document in documents]
 
     # Only add items to the index if they do not already exist.
     # See: https://github.com/facebookresearch/faiss/issues/859
     # To do this, we first determine which of the incoming ids do not exist in the index
-    indexed_ids = set(faiss.vector_to_array(model.index.id_map).tolist())
+    indexed_ids = model.indexed_ids
 
-    if search.query.text is None and search.query.uid not in indexed_ids:
-        search.query.text = normalize_documents([search.query.uid])
+    # If a query is an indexed document, we already have its embedding and don't need its text.
+    indexed_queries = [
+        i for i, query in enumerate(queries) if query.text is None and int(query.uid) in indexed_ids
+    ]
+    queries_to_embed = [i for i in range(len(queries)) if i not in set(indexed_queries)]
+    touch(
+        [id_ for id_ in ids if id_ in indexed_ids] + [int(queries[i].uid) for i in indexed_queries]
+    )
 
-    for i, (id_, text) in enumerate(zip(ids, texts)):
-        try:
-            if text is None and id_ not in indexed_ids:
-                texts[i] = normalize_documents([str(id_)])
-        except HTTPException:
-            # Some bogus PMID - set text as empty string
-            logger.warning(f"Error encountered in normalize_documents: {id_}")
-            texts[i] = ""
-
-    # We then embed the corresponding text and update the index
-    to_embed = [(id_, text) for id_, text in zip(ids, texts) if id_ not in indexed_ids]
-    if to_embed:
-        ids, texts = zip(*to_embed)  # type: ignore
-        embeddings = encode(texts).cpu().numpy()  # type: ignore
-        add_to_faiss_index(ids, embeddings, model.index)
+    # Fetch the text of the queries and of any documents we don't have in a single batch
+    missing = [
+        i
+        for i, (id_, text) in enumerate(zip(ids, texts))
+        if text is None and id_ not in indexed_ids
+    ]
+    to_fetch = [str(ids[i]) for i in missing]
+    to_fetch.extend(queries[i].uid for i in queries_to_embed if queries[i].text is None)
+    fetched: Dict[str, str] = {}
+    if to_fetch:
+        with time_stage("fetch"):
+            try:
+                fetched = await run_in_executor(io_executor, normalize_documents, to_fetch)
+            except FetchError as e:
+                # Nothing has been indexed yet, so the request can simply be retried later.
+                raise HTTPException(status_code=502, detail=str(e))
 
-    # Embed the query
-    query_embedding = encode(search.query.text).cpu().numpy()  # type: ignore
-    num_indexed = model.index.ntotal
-    # Can't search for more items than exist in the index
-    top_k = min(num_indexed, search.top_k)
+    for i in queries_to_embed:
+        if queries[i].text is None:
+            if queries[i].uid not in fetched:
+                raise HTTPException(
+                    status_code=422, detail=f"Could not retrieve the text of {queries[i].uid}"
+                )
+            queries[i].text = fetched[queries[i].uid]
+    for i in missing:
+        if str(ids[i]) not in fetched:
+            # Some bogus PMID, for which PubMed returned no record - set text as empty string
+            logger.warning(f"Could not retrieve the text of {ids[i]}")
+        texts[i] = fetched.get(str(ids[i]), "")
 
-    if search.docs_only:
-        top_k = num_indexed
+    async def embed_queries() -> np.ndarray:
+        query_embeddings = np.empty((len(queries), model.config.hidden_size), "float32")
+        if queries_to_embed:
+            # Tokenizing and encoding are observed for each batch, rather than for each request.
+            with time_stage("embed_queries", observe=False):
+                embeddings = await encoder([queries[i].text for i in queries_to_embed])
+            query_embeddings[queries_to_embed] = embeddings.cpu().numpy()
+        if indexed_queries:
+            query_embeddings[indexed_queries] = await run_in_executor(
+                executor, get_indexed_embeddings, [int(queries[i].uid) for i in indexed_queries]
+            )
+        return query_embeddings
 
-    # Perform the search
-    top_k_scores, top_k_indicies = model.index.search(query_embedding, top_k)
+    # Start embedding the queries while the documents are embedded and added to the index.
+    query_embeddings_future = asyncio.ensure_future(embed_queries())
 
-    top_k_indicies = top_k_indicies.reshape(-1).tolist()
-    top_k_scores = top_k_scores.reshape(-1).tolist()
+    # We then embed the corresponding text and update the index. A dict is used so that an id
+    # repeated within the request is only added once.
+    to_embed = {id_: text for id_, text in zip(ids, texts) if id_ not in indexed_ids}
+    if to_embed:
+        with time_stage("embed_documents", observe=False):
+            embeddings = await encoder(list(to_embed.values()))
+        await run_in_executor(executor, add_to_index, list(to_embed), embeddings.cpu().numpy())
+
+    return await query_embeddings_future
+
+
+async def rank(
+    queries: List[Document],
+    query_embeddings: np.ndarray,
+    documents: List[Document],
+    top_k: int,
+    docs_only: bool,
+) -> List[List[TopMatch]]:
+    """Returns the `top_k` most similar documents in the index to each of `queries`, or, if
+    `docs_only`, the similarity of each of `documents`. A query never matches itself.
+    """
+    if docs_only:
+        # Score the given documents directly, rather than ranking the whole index.
+        ids = [int(doc.uid) for doc in documents]
+        scores = await run_in_executor(executor, score_documents, query_embeddings, ids)
+        top_k_indicies = [ids] * len(queries)
+    else:
+        scores, top_k_indicies = await run_in_executor(
+            executor, search_index, query_embeddings, top_k
+        )
+        top_k_indicies = top_k_indicies.tolist()
 
-    # Pick out results for the incoming ids in search.documents
-    if search.docs_only:
-        documents_positions = [top_k_indicies.index(id) for id in ids]
-        top_k_indicies = ids
-        top_k_scores = [top_k_scores[position] for position in documents_positions]
+    results = []
+    for query, query_top_k_indicies, query_scores in zip(queries, top_k_indicies, scores.tolist()):
+        results.append(
+            [
+                TopMatch(uid=uid, score=score)
+                for uid, score in zip(query_top_k_indicies, query_scores)
+                # Approximate indices pad their results with -1 if they find fewer than top_k.
+                if uid != int(query.uid) and uid != -1
+            ]
+        )
+    touch([int(match.uid) for matches in results for match in matches])
+    return results
 
-    if int(search.query.uid) in top_k_indicies:
-        index = top_k_indicies.index(int(search.query.uid))
-        del top_k_indicies[index], top_k_scores[index]
 
-    response = [TopMatch(uid=uid, score=score) for uid, score in zip(top_k_indicies, top_k_scores)]
+@app.post(
+    "/search",
+    tags=["Search"],
+    response_model=List[TopMatch],
+    dependencies=[Depends(require_model), Depends(require_ready)],
+)
+async def search(search: Search):
+    """Returns the `top_k` most similar documents to `query` from the provided list of `documents`
+    and the index. When docs_only is True, returns all `documents` provided, and disregards `top_k`.
+    """
+    query_embeddings = await embed_and_index([search.query], search.documents)
+    (response,) = await rank(
+        [search.query], query_embeddings, search.documents, search.top_k, search.docs_only
+    )
     return response
+
+
+@app.post(
+    "/search/batch",
+    tags=["Search"],
+    response_model=List[List[TopMatch]],
+    dependencies=[Depends(require_model), Depends(require_ready)],
+)
+async def batch_search(search: BatchSearch):
+    """Returns the `top_k` most similar documents to each of `queries` from the provided list of
+    `documents` and the index, in the same order as `queries`. When docs_only is True, returns all
+    `documents` provided for each query, and disregards `top_k`. All queries are embedded and
+    searched together, which is much faster than searching for them one at a time.
+    """
+    query_embeddings = await embed_and_index(search.queries, search.documents)
+    return await rank(
+        search.queries, query_embeddings, search.documents, search.top_k, search.docs_only
+    )
+
+
+def _shard_response(**arrays: np.ndarray) -> Response:
+    return Response(content=pack_arrays(**arrays), media_type="application/octet-stream")
+
+
+def _list_indexed_ids() -> np.ndarray:
+    with index_lock.read():
+        return np.fromiter(model.indexed_ids, dtype="int64", count=len(model.indexed_ids))
+
+
+@app.post(
+    "/shard/ids", tags=["Shard"], dependencies=[Depends(require_shard), Depends(require_ready)]
+)
+async def shard_ids() -> Response:
+    """Returns the ids of the vectors in this shard of a sharded index."""
+    return _shard_response(ids=await run_in_executor(executor, _list_indexed_ids))
+
+
+@app.post(
+    "/shard/add", tags=["Shard"], dependencies=[Depends(require_shard), Depends(require_ready)]
+)
+async def shard_add(request: Request) -> Response:
+    """Adds vectors to this shard of a sharded index."""
+    arrays = unpack_arrays(await request.body())
+    await run_in_executor(executor, add_to_index, arrays["ids"].tolist(), arrays["vectors"])
+    return _shard_response()
+
+
+@app.post(
+    "/shard/search", tags=["Shard"], dependencies=[Depends(require_shard), Depends(require_ready)]
+)
+async def shard_search(request: Request) -> Response:
+    """Returns the scores and ids of the nearest neighbours of some vectors in this shard of a
+    sharded index.
+    """
+    arrays = unpack_arrays(await request.body())
+    scores, ids = await run_in_executor(executor, search_index, arrays["queries"], int(arrays["k"]))
+    return _shard_response(scores=scores, ids=ids)
+
+
+@app.post(
+    "/shard/reconstruct",
+    tags=["Shard"],
+    dependencies=[Depends(require_shard), Depends(require_ready)],
+)
+async def shard_reconstruct(request: Request) -> Response:
+    """Returns the vectors stored under some ids in this shard of a sharded index."""
+    ids = unpack_arrays(await request.body())["ids"].tolist()
+    missing = [id_ for id_ in ids if id_ not in model.indexed_ids]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Ids not in this shard: {missing}")
+    return _shard_response(vectors=await run_in_executor(executor, get_indexed_embeddings, ids))
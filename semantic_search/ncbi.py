@@ -1,8 +1,11 @@
 import io
+import itertools
+import math
 import os
+import threading
 import time
 from pathlib import Path
-from typing import Any, Dict, Generator, List, Union
+from typing import Any, Dict, Generator, Iterable, Iterator, List, Optional, Union
 
 import requests  # type: ignore
 from Bio import Medline
@@ -11,6 +14,9 @@ from fastapi import HTTPException
 from loguru import logger
 from pydantic import BaseSettings
 
+from semantic_search.common.cache import DocumentCache
+from semantic_search.common.metrics import NCBI_ERRORS, NCBI_RETRIES, ncbi_error_reason
+
 
 def _compact(input: List) -> List:
     """Returns a list with None, False, and empty String removed"""
@@ -19,6 +25,10 @@ def _compact(input: List) -> List:
 
 # -- Setup and initialization --
 MAX_EFETCH_RETMAX = 10000
+# Number of fetched documents to accumulate before writing them to the local cache.
+DOC_CACHE_WRITE_SIZE = 1000
+# Responses with these status codes are worth retrying, e.g. when we are being rate limited.
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
 dot_env_filepath = Path(__file__).absolute().parent.parent / ".env"
 load_dotenv(dot_env_filepath)
 
@@ -33,9 +43,79 @@ class Settings(BaseSettings):
     eutils_efetch_url: str = eutils_base_url + os.getenv("EUTILS_EFETCH_BASENAME", "")
     eutils_esummary_url: str = eutils_base_url + os.getenv("EUTILS_ESUMMARY_BASENAME", "")
     http_request_timeout: int = int(os.getenv("HTTP_REQUEST_TIMEOUT", -1))
+    # Failed requests are retried up to http_max_retries times, waiting
+    # http_backoff_factor * 2 ** retry seconds between attempts.
+    http_max_retries: int = int(os.getenv("HTTP_MAX_RETRIES", 3))
+    http_backoff_factor: float = float(os.getenv("HTTP_BACKOFF_FACTOR", 0.5))
+    # Maximum number of connections to keep open to each host.
+    http_pool_size: int = int(os.getenv("HTTP_POOL_SIZE", 10))
+    # Maximum number of requests per second made to the EUTILS. NCBI allows 10 with an API key,
+    # and 3 without.
+    eutils_rate_limit: float = float(os.getenv("EUTILS_RATE_LIMIT", 10))
+    # Path to a local cache of fetched documents. If empty, documents are always fetched.
+    doc_cache_path: str = os.getenv("DOC_CACHE_PATH", "")
+    doc_cache_max_size: int = int(os.getenv("DOC_CACHE_MAX_SIZE", 1000000))
+    # Seconds a cached document is valid for. If -1, cached documents never expire.
+    doc_cache_ttl: int = int(os.getenv("DOC_CACHE_TTL", -1))
 
 
 settings = Settings()
+doc_cache = (
+    DocumentCache(
+        settings.doc_cache_path,
+        max_size=settings.doc_cache_max_size,
+        ttl=settings.doc_cache_ttl if settings.doc_cache_ttl >= 0 else None,
+    )
+    if settings.doc_cache_path
+    else None
+)
+
+
+class _RateLimiter:
+    """A token bucket that allows `rate` calls to `acquire` per second, in bursts of up to
+    `burst` calls. Safe to share between threads.
+    """
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Blocks until a call is allowed."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Reserve a token, which may put the bucket in debt that later callers wait out.
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        time.sleep(wait)
+
+
+# Reuse connections across requests, rather than paying for a new connection every time.
+_session = requests.Session()
+_adapter = requests.adapters.HTTPAdapter(pool_maxsize=settings.http_pool_size)
+_session.mount("https://", _adapter)
+_session.mount("http://", _adapter)
+_rate_limiter = _RateLimiter(settings.eutils_rate_limit)
+
+
+def _retry_delay(error: requests.exceptions.RequestException, retry: int) -> Optional[float]:
+    """Returns the number of seconds to wait before retrying a request that failed with `error`,
+    or None if it shouldn't be retried.
+    """
+    if isinstance(error, requests.exceptions.HTTPError):
+        if error.response is None or error.response.status_code not in RETRY_STATUS_CODES:
+            return None
+        retry_after = error.response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return float(retry_after)
+    elif not isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return None
+    return settings.http_backoff_factor * 2**retry
 
 
 # -- NCBI EUTILS --
@@ -43,35 +123,64 @@ def _safe_request(url: str, method: str = "GET", headers={}, **opts):
     user_agent = f"{settings.app_name}/{settings.app_version} ({settings.app_url};mailto:{settings.admin_email})"
     request_headers = {"user-agent": user_agent}
     request_headers.update(headers)
-    try:
-        r = requests.request(
-            method, url, headers=request_headers, timeout=settings.http_request_timeout, **opts
-        )
-        r.raise_for_status()
-    except requests.exceptions.Timeout as e:
-        logger.error(f"Timeout error {e}")
-        raise
-    except requests.exceptions.HTTPError as e:
-        logger.error(f"HTTP error {e}; status code: {r.status_code}")
-        raise
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Error in request {e}")
-        raise
-    else:
-        return r
+    for retry in range(settings.http_max_retries + 1):
+        _rate_limiter.acquire()
+        try:
+            r = _session.request(
+                method, url, headers=request_headers, timeout=settings.http_request_timeout, **opts
+            )
+            r.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            # Streamed responses hold on to their pooled connection until closed.
+            if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+                e.response.close()
+            delay = _retry_delay(e, retry)
+            if delay is not None and retry < settings.http_max_retries:
+                logger.warning(f"Error in request {e}; retrying in {delay}s")
+                NCBI_RETRIES.inc()
+                time.sleep(delay)
+                continue
+            NCBI_ERRORS.labels(ncbi_error_reason(e)).inc()
+            if isinstance(e, requests.exceptions.Timeout):
+                logger.error(f"Timeout error {e}")
+            elif isinstance(e, requests.exceptions.HTTPError):
+                logger.error(f"HTTP error {e}; status code: {r.status_code}")
+            else:
+                logger.error(f"Error in request {e}")
+            raise
+        else:
+            return r
+
+
+class FetchError(Exception):
+    """Raised when documents can't be fetched from the EUTILS, e.g. because NCBI is unreachable.
+    Unlike bogus uids, which are skipped, this means the documents may well exist.
+    """
 
 
-def _parse_medline(text: str) -> List[Dict[str, Any]]:
-    """Convert the rettype=medline to dict.
+def _iter_lines(response: requests.Response) -> Generator[str, None, None]:
+    """Yields the lines of a streamed `response` as they arrive, closing it once exhausted."""
+    # Fall back to UTF-8, otherwise lines are returned as bytes if the response has no charset.
+    response.encoding = response.encoding or "utf-8"
+    with response:
+        for line in response.iter_lines(chunk_size=65536, decode_unicode=True):
+            yield line + "\n"
+
+
+def _parse_medline(text: Union[str, Iterable[str]]) -> Iterator[Dict[str, Any]]:
+    """Convert the rettype=medline to dict. `text` is either the whole response, or an iterable
+    of its lines, in which case records are parsed lazily as lines are consumed.
     See https://www.nlm.nih.gov/bsd/mms/medlineelements.html
     """
-    f = io.StringIO(text)
+    f = io.StringIO(text) if isinstance(text, str) else text
     medline_records = Medline.parse(f)
     return medline_records
 
 
-def _get_eutil_records(eutil: str, ids: Union[str, List[str]], **opts) -> List[Dict[str, Any]]:
-    """Call one of the NCBI EUTILITIES and returns data as Python objects."""
+def _get_eutil_records(eutil: str, ids: Union[str, List[str]], **opts) -> Iterator[Dict[str, Any]]:
+    """Call one of the NCBI EUTILITIES and returns data as Python objects. The response is
+    streamed, and records are parsed as they are consumed.
+    """
     ids = [ids] if isinstance(ids, str) else ids
     eutils_params = {
         "db": "pubmed",
@@ -87,45 +196,96 @@ def _get_eutil_records(eutil: str, ids: Union[str, List[str]], **opts) -> List[D
         url = settings.eutils_efetch_url
     else:
         raise ValueError(f"Unsupported eutil '{eutil}''")
-    eutilResponse = _safe_request(url, "POST", files=eutils_params)
-    return _parse_medline(eutilResponse.text)
+    eutilResponse = _safe_request(url, "POST", files=eutils_params, stream=True)
+    return _parse_medline(_iter_lines(eutilResponse))
 
 
-def _medline_to_docs(records: List[Dict[str, str]]) -> List[Dict[str, str]]:
-    """Return a list Documents given a list of Medline records
+def _iter_medline_docs(
+    records: Iterable[Dict[str, str]], skip_invalid: bool = False
+) -> Generator[Dict[str, str], None, None]:
+    """Yield Documents one at a time given an iterable of Medline records. Records without a
+    PMID (e.g. for bogus uids) raise an HTTPException, or are skipped if `skip_invalid`.
     See https://www.nlm.nih.gov/bsd/mms/medlineelements.html
     """
-    docs = []
     for record in records:
         if "PMID" not in record:
+            if skip_invalid:
+                logger.warning(f"Skipping invalid record: {record['id:'][-1]}")
+                continue
             raise HTTPException(status_code=422, detail=record["id:"][-1])
         pmid = record["PMID"]
         abstract = record["AB"] if "AB" in record else ""
         title = record["TI"] if "TI" in record else ""
         text = " ".join(_compact([title, abstract]))
-        docs.append({"uid": pmid, "text": text})
-    return docs
+        yield {"uid": pmid, "text": text}
+
+
+def _medline_to_docs(
+    records: Iterable[Dict[str, str]], skip_invalid: bool = False
+) -> List[Dict[str, str]]:
+    """Return a list Documents given a list of Medline records. Records without a PMID (e.g. for
+    bogus uids) raise an HTTPException, or are skipped if `skip_invalid`.
+    See https://www.nlm.nih.gov/bsd/mms/medlineelements.html
+    """
+    return list(_iter_medline_docs(records, skip_invalid=skip_invalid))
+
+
+def _cache_as_fetched(docs: Iterable[Dict[str, str]]) -> Generator[Dict[str, str], None, None]:
+    """Yields `docs`, writing them to the local cache in batches as they go by."""
+    batch = []
+    try:
+        for doc in docs:
+            batch.append(doc)
+            if len(batch) == DOC_CACHE_WRITE_SIZE:
+                doc_cache.set_many(batch)  # type: ignore
+                batch = []
+            yield doc
+    finally:
+        if batch:
+            doc_cache.set_many(batch)  # type: ignore
 
 
 # -- Public methods --
-def uids_to_docs(uids: List[str]) -> Generator[List[Dict[str, str]], None, None]:
-    """Return uid, and text (i.e. title + abstract) given a PubMed uid"""
+def iter_uids_to_docs(uids: List[str]) -> Generator[Dict[str, str], None, None]:
+    """Yield uid, and text (i.e. title + abstract) given a PubMed uid, one document at a time.
+    Documents are read from the local cache where possible, and otherwise fetched in batches of up
+    to `MAX_EFETCH_RETMAX` uids. Fetched documents are yielded as soon as they are parsed, so
+    responses are never held in memory in full. Bogus uids, for which no record is returned, are
+    skipped. Raises a `FetchError` if a batch can't be fetched in full, after yielding the documents
+    that were.
+    """
+    if doc_cache is not None:
+        cached = doc_cache.get_many(uids)
+        for uid, text in cached.items():
+            yield {"uid": uid, "text": text}
+        uids = [uid for uid in uids if uid not in cached]
     num_uids = len(uids)
-    num_queries = num_uids // MAX_EFETCH_RETMAX + 1
+    num_queries = math.ceil(num_uids / MAX_EFETCH_RETMAX)
     for i in range(num_queries):
         lower = i * MAX_EFETCH_RETMAX
         upper = min([lower + MAX_EFETCH_RETMAX, num_uids])
         ids = uids[lower:upper]
+        start_time = time.time()
         try:
-            start_time = time.time()
             eutil_response = _get_eutil_records("efetch", ids, rettype="medline", retmode="text")
-            duration = time.time() - start_time
-            logger.debug(
-                f"Retrieved docs {lower} through {upper - 1} of {num_uids - 1} in {duration}s"
-            )
-        except Exception as e:
-            logger.warning(f"Error encountered in uids_to_docs: {e}")
-            logger.warning(f"Bypassing docs {lower} through {upper - 1} of {num_uids - 1}")
-            continue
-        else:
-            yield _medline_to_docs(eutil_response)
+            docs = _iter_medline_docs(eutil_response, skip_invalid=True)
+            if doc_cache is not None:
+                docs = _cache_as_fetched(docs)
+            yield from docs
+        # The response is streamed, so the connection can also drop, or return garbage, midway.
+        except (requests.exceptions.RequestException, ValueError) as e:
+            raise FetchError(f"Could not fetch docs {lower} through {upper - 1}: {e}") from e
+        duration = time.time() - start_time
+        logger.debug(f"Retrieved docs {lower} through {upper - 1} of {num_uids - 1} in {duration}s")
+
+
+def uids_to_docs(uids: List[str]) -> Generator[List[Dict[str, str]], None, None]:
+    """Return uid, and text (i.e. title + abstract) given a PubMed uid, in lists of up to
+    `MAX_EFETCH_RETMAX` documents. See `iter_uids_to_docs`.
+    """
+    docs = iter_uids_to_docs(uids)
+    while True:
+        batch = list(itertools.islice(docs, MAX_EFETCH_RETMAX))
+        if not batch:
+            return
+        yield batch
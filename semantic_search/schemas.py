@@ -1,10 +1,8 @@
-from typing import List, Optional
+from typing import Any, List, Optional, Set
 
 import faiss
 
 from pydantic import BaseModel, Field
-from transformers import PreTrainedModel, PreTrainedTokenizer
-
 
 UID = str
 
@@ -48,15 +46,69 @@ class Search(BaseModel):
         }
 
 
+class BatchSearch(BaseModel):
+    queries: List[Document] = Field(..., min_items=1)
+    documents: List[Document] = []
+    top_k: int = Field(10, gt=0, description="top_k must be greater than 0")
+    docs_only: bool = False
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "queries": [
+                    {
+                        "uid": "0",
+                        "text": "It has recently been shown that Craf is essential for Kras G12D-induced NSCLC.",
+                    },
+                    {
+                        "uid": "4",
+                        "text": "ERK1 and ERK2 are required for the growth of Kras-driven tumors.",
+                    },
+                ],
+                "documents": [
+                    {
+                        "uid": "1",
+                        "text": "Craf is essential for the onset of Kras-driven non-small cell lung cancer.",
+                    },
+                    {
+                        "uid": "2",
+                        "text": "Tumorigenesis is a multistage process that involves multiple cell types.",
+                    },
+                    {
+                        "uid": "3",
+                        "text": "Only concomitant ablation of ERK1 and ERK2 impairs tumor growth.",
+                    },
+                ],
+                "top_k": 3,
+            }
+        }
+
+
 class TopMatch(BaseModel):
     uid: UID
     score: float
 
 
 class Model(BaseModel):
-    tokenizer: PreTrainedModel = None
-    model: PreTrainedTokenizer = None
+    # A PreTrainedTokenizer, PreTrainedModel and PretrainedConfig. They aren't typed as such so
+    # that importing this module doesn't import transformers, which takes seconds.
+    tokenizer: Any = None
+    model: Any = None
+    # The config of `model`. Shards of a sharded index only load this, and not the model itself.
+    config: Any = None
     index: faiss.Index = None
+    # The ids of every vector in `index`, kept up-to-date by `add_to_faiss_index` so that
+    # membership checks don't have to scan the index.
+    indexed_ids: Set[int] = set()
+    # The ids of vectors that have been evicted, and so are no longer in `indexed_ids` or searched,
+    # but have yet to be removed from `index`.
+    tombstones: Set[int] = set()
+    # In a process that only reads a shared index, `index` is memory-mapped and read-only, so the
+    # vectors added since it was snapshot are kept in this (small) index instead.
+    overlay: faiss.Index = None
+    # An empty copy of `index`, trained the same way, which compaction copies the vectors that
+    # haven't been evicted to. Only kept if evictions are enabled.
+    empty_index: faiss.Index = None
 
     class Config:
         arbitrary_types_allowed = True
@@ -32,24 +32,25 @@ setuptools.setup(
         "License :: OSI Approved :: Apache Software License",
         "Operating System :: OS Independent",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8",
         "Programming Language :: Python :: 3.9",
         "Topic :: Scientific/Engineering :: Artificial Intelligence",
         "Typing :: Typed",
     ],
-    python_requires=">=3.7.0",
+    python_requires=">=3.8.0",
     install_requires=[
         "biopython>=1.78",
         "fastapi>=0.63.0",
-        "faiss-cpu>=1.7.0",
+        "faiss-cpu>=1.9.0",
         "uvicorn>=0.13.4",
-        "torch>=1.7.1",
-        "transformers>=4.3.3",
+        "torch>=1.10.0",
+        "transformers>=4.30.0",
+        "safetensors>=0.3.1",
         "typer>=0.3.2",
         "python-dotenv>=0.15.0",
         "xmltodict>=0.12.0",
         "loguru>=0.5.3",
+        "prometheus-client>=0.10.0",
     ],
     extras_require={
         "dev": [
@@ -61,7 +62,9 @@ setuptools.setup(
             "pytest-cov",
             "hypothesis",
             "mypy",
+            "pyinstrument>=5.0.0",
         ],
         "demo": ["streamlit", "watchdog", "validators"],
+        "profile": ["pyinstrument>=5.0.0"],
     },
 )
@@ -0,0 +1,71 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List
+
+import pytest
+
+from semantic_search.common.batching import MicroBatcher
+from semantic_search.common.metrics import request_profiles
+
+
+def test_micro_batcher_combines_concurrent_requests() -> None:
+    calls = []
+
+    def func(items):
+        calls.append(items)
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher(func, max_batch_size=64, max_wait=1.0)
+    futures = [batcher.submit([i, i + 1]) for i in range(0, 10, 2)]
+
+    assert [future.result() for future in futures] == [[i * 2, i * 2 + 2] for i in range(0, 10, 2)]
+    # Every request is batched into a single call
+    assert calls == [list(range(10))]
+
+
+def test_micro_batcher_respects_max_batch_size() -> None:
+    calls = []
+
+    def func(items):
+        calls.append(items)
+        return items
+
+    batcher = MicroBatcher(func, max_batch_size=2)
+    with ThreadPoolExecutor() as executor:
+        list(executor.map(lambda i: batcher.submit([i]).result(), range(10)))
+    assert all(len(items) <= 2 for items in calls)
+    assert sorted(item for items in calls for item in items) == list(range(10))
+
+
+def test_micro_batcher_isolates_errors() -> None:
+    ready = threading.Event()
+
+    def func(items):
+        ready.wait()
+        if None in items:
+            raise ValueError("bad input")
+        return items
+
+    batcher = MicroBatcher(func, max_batch_size=64, max_wait=1.0)
+    first, good, bad = batcher.submit([0]), batcher.submit([1]), batcher.submit([None])
+    ready.set()
+
+    assert first.result() == [0]
+    assert good.result() == [1]
+    with pytest.raises(ValueError):
+        bad.result()
+
+
+def test_micro_batcher_profiles_batches_of_profiled_requests() -> None:
+    batcher = MicroBatcher(lambda items: items, max_batch_size=64, max_wait=1.0)
+    profiles: List[Any] = []
+    token = request_profiles.set(profiles)
+    try:
+        profiled = batcher.submit([1])
+    finally:
+        request_profiles.reset(token)
+    unprofiled = batcher.submit([2])
+
+    assert profiled.result() == [1] and unprofiled.result() == [2]
+    # The batch both requests were in is profiled once, for the request that asked for it
+    assert len(profiles) == 1
@@ -0,0 +1,88 @@
+from pathlib import Path
+
+from typer.testing import CliRunner
+
+from semantic_search import build_index
+from semantic_search.build_index import InputFormat, app, detect_format, iter_documents
+from semantic_search.common.util import faiss_index_is_flat, get_faiss_index_ids, load_faiss_index
+from semantic_search.ncbi import FetchError
+
+runner = CliRunner()
+
+MEDLINE = """PMID- 1
+TI  - Craf is essential for the onset of Kras-driven non-small cell lung cancer.
+AB  - Tumorigenesis is a multistage process that involves multiple cell types.
+
+PMID- 2
+TI  - Only concomitant ablation of ERK1 and ERK2 impairs tumor growth.
+"""
+
+
+def test_iter_documents(tmp_path: Path) -> None:
+    medline = tmp_path / "pubmed.txt"
+    medline.write_text(MEDLINE)
+    assert detect_format(medline) == InputFormat.medline
+    assert list(iter_documents([medline])) == [
+        {
+            "uid": "1",
+            "text": (
+                "Craf is essential for the onset of Kras-driven non-small cell lung cancer."
+                " Tumorigenesis is a multistage process that involves multiple cell types."
+            ),
+        },
+        {"uid": "2", "text": "Only concomitant ablation of ERK1 and ERK2 impairs tumor growth."},
+    ]
+
+    pmids = tmp_path / "pmids.txt"
+    pmids.write_text("9887103\n30049242\n")
+    assert detect_format(pmids) == InputFormat.pmids
+
+
+def test_build_index(tmp_path: Path) -> None:
+    medline = tmp_path / "pubmed.txt"
+    medline.write_text(MEDLINE)
+    args = [str(medline), str(medline), "--snapshot-dir", str(tmp_path), "--num-workers", "1"]
+    result = runner.invoke(app, args)
+    assert result.exit_code == 0, result.output
+
+    # The snapshot can be loaded by the server, and documents are only indexed once
+    index = load_faiss_index(tmp_path, {"index_factory": "Flat"})
+    assert index is not None
+    assert index.ntotal == 2 and get_faiss_index_ids(index) == {1, 2}
+
+
+def test_resume_build_index(tmp_path: Path, monkeypatch) -> None:
+    medline = tmp_path / "pubmed.txt"
+    medline.write_text(
+        "\n".join(f"PMID- {uid}\nTI  - Document number {uid}.\n" for uid in range(1, 6))
+    )
+    pmids = tmp_path / "pmids.txt"
+    pmids.write_text("1\n6\n")
+    fetched = []
+
+    def iter_uids_to_docs(uids):
+        fetched.extend(uids)
+        if len(fetched) == 1:
+            raise FetchError("Connection refused")
+        yield from ({"uid": uid, "text": f"Document number {uid}."} for uid in uids)
+
+    monkeypatch.setattr(build_index, "iter_uids_to_docs", iter_uids_to_docs)
+    args = [str(medline), str(pmids), "--snapshot-dir", str(tmp_path), "--num-workers", "1"]
+    args += ["--chunk-size", "1", "--snapshot-every", "1"]
+    args += ["--index-factory", "IVF2,Flat", "--index-train-size", "4"]
+    result = runner.invoke(app, args)
+    assert isinstance(result.exception, FetchError)
+
+    # The chunks added before the build failed were snapshot, and are picked up when resumed
+    index = load_faiss_index(tmp_path, {"index_factory": "IVF2,Flat"})
+    assert index is not None and 0 < index.ntotal < 5
+    result = runner.invoke(app, args)
+    assert result.exit_code == 0, result.output
+    assert f"Indexed {6 - index.ntotal} new documents" in result.output
+    # Documents already indexed aren't fetched again
+    assert fetched == ["6", "6"]
+
+    # The index was trained once there were enough vectors to train it on
+    index = load_faiss_index(tmp_path, {"index_factory": "IVF2,Flat"})
+    assert index is not None and not faiss_index_is_flat(index)
+    assert get_faiss_index_ids(index) == {1, 2, 3, 4, 5, 6}
@@ -0,0 +1,54 @@
+import torch
+
+from semantic_search.common import cache
+from semantic_search.common.cache import DocumentCache, EmbeddingCache
+
+
+def test_document_cache(tmp_path) -> None:
+    doc_cache = DocumentCache(tmp_path / "docs.db")
+    doc_cache.set_many([{"uid": "1", "text": "one"}, {"uid": "2", "text": ""}])
+    assert doc_cache.get_many(["1", "2", "3"]) == {"1": "one", "2": ""}
+
+    # The cache persists across instances
+    assert DocumentCache(tmp_path / "docs.db").get_many(["1"]) == {"1": "one"}
+
+
+def test_document_cache_max_size(tmp_path, monkeypatch) -> None:
+    doc_cache = DocumentCache(tmp_path / "docs.db", max_size=2)
+    for i in range(4):
+        monkeypatch.setattr(cache.time, "time", lambda: float(i))
+        doc_cache.set_many([{"uid": str(i), "text": str(i)}])
+    # The oldest documents are evicted first
+    assert len(doc_cache) == 2
+    assert doc_cache.get_many(["0", "1", "2", "3"]) == {"2": "2", "3": "3"}
+
+    # Replacing cached documents doesn't count towards the size
+    doc_cache.set_many([{"uid": "2", "text": "two"}, {"uid": "3", "text": "three"}])
+    assert doc_cache.get_many(["2", "3"]) == {"2": "two", "3": "three"}
+    # Documents added by other processes are picked up by recounts
+    DocumentCache(tmp_path / "docs.db").set_many([{"uid": "4", "text": "4"}])
+    monkeypatch.setattr(cache, "DOCUMENT_RECOUNT_INTERVAL", 0.0)
+    doc_cache.set_many([{"uid": "5", "text": "5"}])
+    assert len(doc_cache) == 2
+
+
+def test_document_cache_ttl(tmp_path, monkeypatch) -> None:
+    doc_cache = DocumentCache(tmp_path / "docs.db", ttl=10)
+    monkeypatch.setattr(cache.time, "time", lambda: 0.0)
+    doc_cache.set_many([{"uid": "1", "text": "one"}])
+    monkeypatch.setattr(cache.time, "time", lambda: 5.0)
+    assert doc_cache.get_many(["1"]) == {"1": "one"}
+    monkeypatch.setattr(cache.time, "time", lambda: 11.0)
+    assert doc_cache.get_many(["1"]) == {}
+
+
+def test_embedding_cache() -> None:
+    # Room for two embeddings of four 32-bit floats
+    embedding_cache = EmbeddingCache(max_bytes=32)
+    for key in "abc":
+        embedding_cache.set(key, torch.rand(4))
+        # Using "a" makes "b" the least recently used embedding
+        embedding_cache.get("a")
+    assert len(embedding_cache) == 2 and embedding_cache.num_bytes == 32
+    assert embedding_cache.get("b") is None
+    assert embedding_cache.get("a") is not None and embedding_cache.get("c") is not None
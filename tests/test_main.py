@@ -1,9 +1,41 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
 from typing import Dict, List, Tuple
 
+import faiss
 import numpy as np
+import pytest
+import requests  # type: ignore
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
 
-from semantic_search import main
+from semantic_search import main, ncbi
+from semantic_search.common.util import (
+    add_to_faiss_index,
+    batch_by_length,
+    copy_faiss_index_vectors,
+    empty_faiss_index_like,
+    faiss_index_nbytes,
+    encode_by_length,
+    encode_with_transformer,
+    get_faiss_index_ids,
+    load_faiss_index,
+    quantize_model,
+    reconstruct_from_faiss_index,
+    save_faiss_index,
+    search_faiss_index,
+    set_faiss_search_parameters,
+    setup_faiss_index,
+    storage_index_factory,
+)
+from semantic_search.common.sharding import ShardedIndex, pack_arrays
+from semantic_search.common.sharing import Spool, WriterLock
 from semantic_search.main import app, app_startup, encode
 from transformers import PreTrainedModel, PreTrainedTokenizer, PreTrainedTokenizerFast
 
@@ -25,10 +57,193 @@ class TestMain:
         assert np.dot(embeddings[2], embeddings[0]) < np.dot(embeddings[2], embeddings[3])
         assert np.dot(embeddings[2], embeddings[1]) < np.dot(embeddings[2], embeddings[3])
 
+    def test_encode_preserves_order(self, inputs) -> None:
+        # Bypass the embedding cache, which would hand back the embeddings of the first call.
+        embeddings = main._encode(inputs)
+        for text, embedding in zip(inputs, embeddings):
+            assert np.allclose(embedding, main._encode([text])[0], atol=1e-4)
+
+    def test_encode_uses_embedding_cache(self, inputs, monkeypatch) -> None:
+        expected = encode(inputs)
+        encoded = []
+        original_encode = main._encode
+
+        def _encode(text):
+            encoded.extend(text)
+            return original_encode(text)
+
+        monkeypatch.setattr(main, "_encode", _encode)
+        # Only text that hasn't been embedded before is passed through the model, once.
+        embeddings = encode(["unseen", *inputs, "unseen"])
+        assert encoded == ["unseen"]
+        assert np.allclose(embeddings[1:-1], expected)
+        assert np.allclose(embeddings[0], embeddings[-1])
+
+    def test_batch_by_length(self) -> None:
+        batches = batch_by_length([5, 1, 3, 2, 10], max_tokens=6, max_batch_size=2)
+        assert batches == [[1, 3], [2], [0], [4]]
+
+    def test_encode_by_length(self, inputs) -> None:
+        def tokenized() -> float:
+            labels = {"stage": "tokenize"}
+            return REGISTRY.get_sample_value("semantic_search_stage_seconds_count", labels) or 0
+
+        before = tokenized()
+        # A small token budget splits the inputs into several batches
+        embeddings = encode_by_length(inputs, main.model.tokenizer, main.model.model, max_tokens=64)
+        # The inputs are tokenized once, and only padded batch by batch
+        assert tokenized() == before + 1
+        for text, embedding in zip(inputs, embeddings):
+            expected = encode_with_transformer([text], main.model.tokenizer, main.model.model)
+            assert np.allclose(embedding, expected[0], atol=1e-4)
+
+    def test_model_precision(self, monkeypatch) -> None:
+        reference_model = main.model.model
+        monkeypatch.setattr(main.settings, "model_precision", "bf16")
+        assert all(main.check_model_precision(reference_model) > 0.9)
+
+        monkeypatch.setattr(main.settings, "model_precision", "int8")
+        monkeypatch.setattr(main.model, "model", quantize_model(reference_model))
+        assert all(main.check_model_precision(reference_model) > 0.9)
+
     def test_setup_model_and_tokenizer(self) -> None:
         assert isinstance(main.model.tokenizer, (PreTrainedTokenizer, PreTrainedTokenizerFast))
         assert isinstance(main.model.model, PreTrainedModel)
 
+    def test_add_to_faiss_index(self) -> None:
+        index = setup_faiss_index(4)
+        indexed_ids = {1}
+        add_to_faiss_index([2, 3], np.random.rand(2, 4), index, indexed_ids)
+        assert indexed_ids == {1, 2, 3}
+        assert get_faiss_index_ids(index) == {2, 3}
+
+    def test_save_and_load_faiss_index(self, tmp_path) -> None:
+        index = setup_faiss_index(4)
+        add_to_faiss_index([1, 2], np.random.rand(2, 4), index)
+        fingerprint = {"embedding_dim": 4}
+        for _ in range(3):
+            save_faiss_index(index, tmp_path, fingerprint, keep=2)
+        # Only the most recent snapshots are kept
+        assert len(list(tmp_path.glob("*.faiss"))) == 2
+
+        loaded = load_faiss_index(tmp_path, fingerprint)
+        assert loaded is not None and loaded.ntotal == 2
+        # Snapshots built with different settings are never loaded
+        assert load_faiss_index(tmp_path, {"embedding_dim": 8}) is None
+
+        # Serialized indices are written as is
+        save_faiss_index(faiss.serialize_index(index), tmp_path, fingerprint, ntotal=index.ntotal)
+        loaded = load_faiss_index(tmp_path, fingerprint)
+        assert loaded is not None and loaded.ntotal == 2
+
+    def test_reconstruct_from_faiss_index(self, tmp_path) -> None:
+        embeddings = np.random.rand(3, 4).astype("float32")
+        normalized = embeddings / np.linalg.norm(embeddings, axis=-1, keepdims=True)
+        index = setup_faiss_index(4)
+        add_to_faiss_index([7, 3, 5], embeddings, index)
+        assert np.allclose(reconstruct_from_faiss_index(index, [5, 7]), normalized[[2, 0]])
+
+        # Snapshots of indices with an IndexIDMap are upgraded so they can be reconstructed from
+        legacy = faiss.index_factory(4, "IDMap,L2norm,Flat", faiss.METRIC_INNER_PRODUCT)
+        add_to_faiss_index([7, 3, 5], embeddings, legacy)
+        save_faiss_index(legacy, tmp_path, {})
+        loaded = load_faiss_index(tmp_path, {})
+        assert loaded is not None
+        assert np.allclose(reconstruct_from_faiss_index(loaded, [3]), normalized[[1]])
+        add_to_faiss_index([9], embeddings[:1], loaded)
+        assert np.allclose(reconstruct_from_faiss_index(loaded, [9]), normalized[[0]])
+
+    def test_storage_index_factory(self) -> None:
+        assert storage_index_factory("Flat", "float32", 768) == "Flat"
+        assert storage_index_factory("Flat", "pq", 768) == "IVF1,PQ192"
+        assert storage_index_factory("IVF1024,Flat", "fp16", 768) == "IVF1024,SQfp16"
+        assert storage_index_factory("HNSW32", "int8", 768) == "HNSW32,SQ8"
+        # faiss only supports L2 distances for HNSW with product quantization
+        with pytest.raises(ValueError):
+            storage_index_factory("HNSW32", "pq", 768)
+        with pytest.raises(ValueError):
+            storage_index_factory("Flat", "int4", 768)
+
+    # How far the stored (normalized) vectors, and so the scores, may be from the exact ones.
+    # Re-scored indices score with the exact vectors, whatever their storage.
+    @pytest.mark.parametrize(
+        "index_factory,atol",
+        [
+            ("Flat", 1e-6),
+            ("SQfp16", 1e-3),
+            ("SQ8", 1e-2),
+            ("IVF1,PQ8x4,RFlat", 1e-6),
+            ("SQ8,RFlat", 1e-6),
+        ],
+    )
+    def test_faiss_index_storage(self, index_factory, atol, tmp_path) -> None:
+        embeddings = np.random.default_rng(13).standard_normal((1000, 32)).astype("float32")
+        normalized = embeddings / np.linalg.norm(embeddings, axis=-1, keepdims=True)
+        ids = list(range(1, 1001))
+        index = setup_faiss_index(32, index_factory)
+        if not index.is_trained:
+            index.train(embeddings)
+        add_to_faiss_index(ids, embeddings, index)
+        set_faiss_search_parameters(index, k_factor_rf=4)
+
+        scores, found = index.search(embeddings[:100], 1)
+        assert found[:, 0].tolist() == ids[:100]
+        assert np.allclose(scores[:, 0], 1, atol=atol)
+        assert np.allclose(
+            reconstruct_from_faiss_index(index, ids[:100]), normalized[:100], atol=atol
+        )
+        # Excluded ids are skipped, including by the candidate search of re-scored indices
+        excluded = faiss.IDSelectorBatch(np.arange(1, 11, dtype="int64"))
+        _, found = search_faiss_index(index, embeddings[:20], 5, excluded)
+        assert not set(found.ravel().tolist()) & set(range(1, 11))
+        assert found[10:, 0].tolist() == ids[10:20]
+
+        # Snapshots keep the storage, and so the scores
+        save_faiss_index(index, tmp_path, {"index_factory": index_factory})
+        loaded = load_faiss_index(tmp_path, {"index_factory": index_factory})
+        assert loaded is not None and loaded.ntotal == 1000
+        set_faiss_search_parameters(loaded, k_factor_rf=4)
+        loaded_scores, loaded_found = loaded.search(embeddings[:100], 1)
+        assert loaded_found[:, 0].tolist() == ids[:100]
+        assert np.allclose(loaded_scores, scores, atol=1e-6)
+        assert faiss_index_nbytes(loaded) == faiss_index_nbytes(index)
+
+    def test_empty_faiss_index_like(self) -> None:
+        embeddings = np.random.rand(6, 4).astype("float32")
+        index = setup_faiss_index(4)
+        add_to_faiss_index([1, 2, 3, 4, 5], embeddings[:5], index)
+        empty = empty_faiss_index_like(index)
+        assert empty.ntotal == 0 and index.ntotal == 5
+        add_to_faiss_index([9], embeddings[5:], empty)
+        assert np.allclose(
+            reconstruct_from_faiss_index(empty, [9])[0] * np.linalg.norm(embeddings[5]),
+            embeddings[5],
+            atol=1e-5,
+        )
+        # The ids of the original vectors don't resolve to the new ones
+        with pytest.raises(RuntimeError):
+            reconstruct_from_faiss_index(empty, [1])
+
+    @pytest.mark.parametrize("index_factory", ["SQ8", "IVF4,PQ8x4", "HNSW8,SQ8", "IVF4,SQ8,RFlat"])
+    def test_copy_faiss_index_vectors(self, index_factory) -> None:
+        embeddings = np.random.default_rng(13).standard_normal((1000, 32)).astype("float32")
+        ids = list(range(1, 1001))
+        index = setup_faiss_index(32, index_factory)
+        index.train(embeddings)
+        add_to_faiss_index(ids, embeddings, index)
+
+        copy = empty_faiss_index_like(index)
+        for start in range(0, 1000, 300):
+            copy_faiss_index_vectors(index, copy, np.arange(start, min(start + 300, 1000), 2))
+        copy.construct_rev_map()
+        assert get_faiss_index_ids(copy) == set(ids[::2])
+        # Compressed vectors are copied as they are, rather than compressed again
+        stored = reconstruct_from_faiss_index(index, ids[::2])
+        assert np.array_equal(reconstruct_from_faiss_index(copy, ids[::2]), stored)
+        assert faiss_index_nbytes(copy) < faiss_index_nbytes(index)
+        _, found = copy.search(embeddings[:20:2], 1)
+        assert found[:, 0].tolist() == ids[:20:2]
+
     def test_index(self) -> None:
         response = client.get("/")
         assert response.status_code == 200
@@ -64,3 +279,392 @@ class TestMain:
         actual_uids = [item["uid"] for item in actual_response.json()]
         expected_uids = [item["uid"] for item in expected_response]
         assert set(actual_uids) == set(expected_uids)
+
+    def test_search_with_indexed_query(self, monkeypatch) -> None:
+        documents = [{"uid": str(uid), "text": f"Document number {uid}."} for uid in range(1, 4)]
+        request = {"query": {"uid": "1", "text": "Document number 1."}, "documents": documents}
+        assert client.post("/search", json.dumps(request)).status_code == 200
+
+        def normalize_documents(pmids):
+            raise AssertionError(f"Tried to fetch {pmids}")
+
+        # The embedding of an indexed query is reused, so its text doesn't have to be fetched
+        monkeypatch.setattr(main, "normalize_documents", normalize_documents)
+        request = {"query": {"uid": "1"}, "documents": [{"uid": "2"}, {"uid": "3"}]}
+        response = client.post("/search", json.dumps({**request, "docs_only": True}))
+        assert response.status_code == 200
+        assert [item["uid"] for item in response.json()] == ["2", "3"]
+
+    def test_search_when_pubmed_is_unreachable(self, monkeypatch) -> None:
+        def refuse(*args, **kwargs):
+            raise requests.exceptions.ConnectionError("Connection refused")
+
+        monkeypatch.setattr(ncbi._session, "request", refuse)
+        monkeypatch.setattr(ncbi.settings, "http_backoff_factor", 0)
+        documents = [{"uid": "91000001"}, {"uid": "91000002"}]
+        request = {"query": {"uid": "1", "text": "Document number 1."}, "documents": documents}
+        ntotal = main.model.index.ntotal
+        response = client.post("/search", json.dumps(request))
+        assert response.status_code == 502
+        # Documents that couldn't be fetched are not indexed, so they are fetched again next time
+        assert main.model.index.ntotal == ntotal
+        assert not {91000001, 91000002} & main.model.indexed_ids
+
+    def test_batch_search(self, dummy_request_with_test: Request) -> None:
+        request, _ = dummy_request_with_test
+        queries = [
+            json.loads(request)["query"],
+            {"uid": "30049242", "text": "TGF-β signaling in Drosophila."},
+        ]
+        documents = json.loads(request)["documents"]
+        for docs_only in (False, True):
+            batch_request = {"queries": queries, "documents": documents, "docs_only": docs_only}
+            response = client.post("/search/batch", json.dumps(batch_request))
+            assert response.status_code == 200
+            # Each query gets the same results it would get if it were searched for on its own
+            assert len(response.json()) == len(queries)
+            for query, matches in zip(queries, response.json()):
+                single_request = {"query": query, "documents": documents, "docs_only": docs_only}
+                expected = client.post("/search", json.dumps(single_request)).json()
+                assert [match["uid"] for match in matches] == [m["uid"] for m in expected]
+                assert np.allclose(
+                    [match["score"] for match in matches], [m["score"] for m in expected], atol=1e-4
+                )
+
+    def test_metrics(self) -> None:
+        documents = [{"uid": str(uid), "text": f"Document number {uid}."} for uid in range(1, 4)]
+        request = {"query": {"uid": "1", "text": "Document number 1."}, "documents": documents}
+        assert client.post("/search", json.dumps(request)).status_code == 200
+
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        metrics = response.text
+        for stage in ("tokenize", "encode", "index_add", "index_search"):
+            assert f'semantic_search_stage_seconds_count{{stage="{stage}"}}' in metrics
+        assert "semantic_search_encoder_batch_size_count" in metrics
+        assert (
+            'semantic_search_request_seconds_count{method="POST",path="/search",status="200"}'
+            in metrics
+        )
+        assert f"semantic_search_index_vectors {float(main.model.index.ntotal)}" in metrics
+
+    def test_server_timing(self, monkeypatch) -> None:
+        documents = [{"uid": str(uid), "text": f"Document number {uid}."} for uid in range(1, 4)]
+        request = json.dumps({"query": {"uid": "1", "text": "Timing."}, "documents": documents})
+        assert "Server-Timing" not in client.post("/search", request).headers
+
+        response = client.post("/search?timing=true", request)
+        assert response.status_code == 200
+        stages = dict(
+            entry.split(";dur=") for entry in response.headers["Server-Timing"].split(", ")
+        )
+        assert {"embed_queries", "index_search", "total"} <= set(stages)
+        assert all(float(duration) >= 0 for duration in stages.values())
+
+        # Profiling is only allowed for callers with the profile token
+        headers = {"X-Profile": "true"}
+        assert client.post("/search", request, headers=headers).status_code == 403
+        monkeypatch.setattr(main.settings, "profile_token", "secret")
+        # New documents, so that they are embedded rather than found in the index
+        documents = [
+            {"uid": str(uid), "text": f"Profiled document {uid}. " * 50} for uid in range(4, 8)
+        ]
+        request = json.dumps({"query": {"uid": "4", "text": "Profiled."}, "documents": documents})
+        response = client.post("/search", request, headers={**headers, "X-Profile-Token": "secret"})
+        assert response.status_code == 200
+        assert "search" in response.text
+        # The work handed off to the encoder's thread is profiled too
+        assert "encode_with_transformer" in response.text
+        assert "total" in response.headers["Server-Timing"]
+
+    def test_profile_under_load(self, monkeypatch) -> None:
+        # Profiled requests are handled as usual, so they can run alongside other requests
+        monkeypatch.setattr(main.settings, "profile_token", "secret")
+        statuses: List[int] = []
+
+        def send(i: int, headers: Dict[str, str]) -> None:
+            for j in range(5):
+                # Long, distinct texts keep the encoder (and its tokenizer) busy
+                documents = [
+                    {"uid": str(1000 * (5 * i + j) + uid), "text": f"Document {i} {j} {uid}. " * 50}
+                    for uid in range(1, 9)
+                ]
+                request = {
+                    "query": {"uid": str(1000 * (5 * i + j)), "text": f"Query {i} {j}. " * 50},
+                    "documents": documents,
+                }
+                response = client.post("/search", json.dumps(request), headers=headers)
+                statuses.append(response.status_code)
+
+        profiled = {"X-Profile": "true", "X-Profile-Token": "secret"}
+        threads = [
+            threading.Thread(target=send, args=(i, profiled if i % 2 else {})) for i in range(1, 9)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert statuses == [200] * 40
+
+    def test_health_checks(self, monkeypatch) -> None:
+        assert client.get("/health/live").status_code == 200
+        response = client.get("/health/ready")
+        assert response.status_code == 200
+        assert response.json()["status"] == "ready"
+
+        # Searches are turned away until the model and index are loaded
+        monkeypatch.setattr(main, "loading_stage", "loading model")
+        assert client.get("/health/live").status_code == 200
+        response = client.get("/health/ready")
+        assert response.status_code == 503
+        assert response.json()["stage"] == "loading model"
+        request = {"query": {"uid": "1", "text": "Loading."}, "documents": []}
+        response = client.post("/search", json.dumps(request))
+        assert response.status_code == 503
+        assert "Retry-After" in response.headers
+
+        monkeypatch.setattr(main, "loading_error", "Model not found")
+        assert client.get("/health/live").status_code == 503
+
+    def test_shard_endpoints_need_index_shard(self) -> None:
+        # Other servers hide them, so that their index can't be listed or added to
+        request = pack_arrays(ids=np.asarray([42]), vectors=np.random.rand(1, 4).astype("float32"))
+        assert client.post("/shard/add", data=request).status_code == 404
+        assert client.post("/shard/ids").status_code == 404
+        assert 42 not in main.model.indexed_ids
+
+    def test_check_settings(self, monkeypatch) -> None:
+        main.check_settings()
+        monkeypatch.setattr(main.settings, "index_shared", True)
+        monkeypatch.setattr(main.settings, "index_snapshot_dir", None)
+        with pytest.raises(ValueError):
+            main.check_settings()
+
+    def test_local_model_dir(self, tmp_path, monkeypatch) -> None:
+        local_model_dir = tmp_path / "model"
+        monkeypatch.setattr(main.settings, "local_model_dir", str(local_model_dir))
+        main.load_model()
+        assert (local_model_dir / "model.safetensors").exists()
+        assert not list(tmp_path.glob("*.partial"))
+
+        # Later starts load the local copy
+        main.load_model()
+        assert main.model.model.name_or_path == str(local_model_dir)
+
+    def test_evict_and_compact_index(self, monkeypatch) -> None:
+        monkeypatch.setattr(main.settings, "index_max_size", 3)
+        monkeypatch.setattr(main.settings, "index_compact_threshold", 0.5)
+        app_startup()
+        embeddings = np.random.rand(10, main.model.model.config.hidden_size).astype("float32")
+
+        main.add_to_index([1, 2, 3], embeddings[1:4])
+        main.touch([1])
+        # The least recently used document is evicted, but stays in the index as a tombstone
+        main.add_to_index([4], embeddings[4:5])
+        assert main.model.indexed_ids == {1, 3, 4} and main.model.tombstones == {2}
+        _, ids = main.search_index(embeddings[2:3], 10)
+        assert ids.tolist() == [[i for i in ids[0] if i != 2]] and len(ids[0]) == 3
+        # Evicted documents are restored as they are, if they haven't been compacted away
+        main.add_to_index([2], embeddings[2:3])
+        assert main.model.indexed_ids == {1, 2, 4} and main.model.index.ntotal == 4
+
+        # Once enough documents have been evicted, the index is compacted in the background
+        main.add_to_index([5, 6, 7], embeddings[5:8])
+        assert main.model.indexed_ids == {5, 6, 7}
+        deadline = time.monotonic() + 10
+        while main.model.index.ntotal > 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert main.model.index.ntotal == 3 and not main.model.tombstones
+        # Compacted vectors can no longer be looked up, not even by requests that saw them indexed
+        with pytest.raises(RuntimeError):
+            reconstruct_from_faiss_index(main.model.index, [1])
+        with pytest.raises(HTTPException) as error:
+            main.get_indexed_embeddings([5, 1])
+        assert error.value.status_code == 409
+        assert np.allclose(main.score_documents(embeddings[6:7], [6]), 1, atol=1e-5)
+        app_startup()
+
+    def test_compact_index_keeps_compressed_vectors(self, monkeypatch) -> None:
+        monkeypatch.setattr(main.settings, "index_factory", "IVF4,PQ8x4")
+        monkeypatch.setattr(main.settings, "index_train_size", 300)
+        monkeypatch.setattr(main.settings, "index_max_size", 300)
+        monkeypatch.setattr(main.settings, "index_compact_threshold", 0.1)
+        monkeypatch.setattr(main, "INDEX_COPY_CHUNK_SIZE", 64)
+        app_startup()
+        rng = np.random.default_rng(13)
+        embeddings = rng.standard_normal((340, main.model.config.hidden_size)).astype("float32")
+        ids = list(range(1, 341))
+
+        main.add_to_index(ids[:300], embeddings[:300])
+        deadline = time.monotonic() + 10
+        while main.faiss_index_is_flat(main.model.index) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        stored = reconstruct_from_faiss_index(main.model.index, ids[40:300])
+
+        # Evicting the 40 least recently used documents triggers a compaction
+        main.add_to_index(ids[300:], embeddings[300:])
+        deadline = time.monotonic() + 10
+        while main.model.index.ntotal > 300 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert main.model.index.ntotal == 300 and not main.model.tombstones
+        assert get_faiss_index_ids(main.model.index) == set(ids[40:])
+        # The remaining vectors are unchanged, rather than compressed once more
+        assert np.array_equal(reconstruct_from_faiss_index(main.model.index, ids[40:300]), stored)
+        monkeypatch.undo()
+        app_startup()
+
+    @pytest.mark.parametrize("index_factory", ["IVF4,Flat", "HNSW8"])
+    def test_train_index(self, index_factory, tmp_path, monkeypatch) -> None:
+        def search_parameters() -> Dict[str, int]:
+            storage = faiss.downcast_index(faiss.downcast_index(main.model.index.index).index)
+            if isinstance(storage, faiss.IndexHNSW):
+                return {"efSearch": storage.hnsw.efSearch}
+            return {"nprobe": faiss.extract_index_ivf(main.model.index).nprobe}
+
+        monkeypatch.setattr(main.settings, "index_factory", index_factory)
+        monkeypatch.setattr(main.settings, "index_train_size", 256)
+        monkeypatch.setattr(main.settings, "ivf_nprobe", 2)
+        monkeypatch.setattr(main.settings, "hnsw_ef_search", 24)
+        monkeypatch.setattr(main.settings, "index_max_size", 250)
+        monkeypatch.setattr(main.settings, "index_snapshot_dir", str(tmp_path))
+        monkeypatch.setattr(main.settings, "index_snapshot_interval", 0)
+        app_startup()
+        # Indices that need training (IVF, unlike HNSW) start out flat
+        assert main.faiss_index_is_flat(main.model.index) == index_factory.startswith("IVF")
+        # Spread out, rather than uniform in [0, 1), so that HNSW reliably finds the nearest vector
+        rng = np.random.default_rng(13)
+        embeddings = rng.standard_normal((260, main.model.config.hidden_size)).astype("float32")
+        ids = list(range(1, 261))
+
+        # Once enough vectors are indexed, the index is trained in the background, if need be
+        main.add_to_index(ids, embeddings)
+        deadline = time.monotonic() + 10
+        while main.faiss_index_is_flat(main.model.index) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert not main.faiss_index_is_flat(main.model.index)
+        assert main.model.index.ntotal == 260
+        assert search_parameters() == {"nprobe": 2} or search_parameters() == {"efSearch": 24}
+        # Evicted vectors are excluded from searches of the trained index
+        assert main.model.tombstones == set(range(1, 11))
+        _, found = main.search_index(embeddings[:20], 5)
+        assert not set(found.ravel().tolist()) & main.model.tombstones
+        assert found[10:, 0].tolist() == ids[10:20]
+
+        # The trained index is snapshot and reloaded, with the current search parameters
+        main.snapshot_index()
+        monkeypatch.setattr(main.settings, "ivf_nprobe", 3)
+        monkeypatch.setattr(main.settings, "hnsw_ef_search", 48)
+        app_startup()
+        assert not main.faiss_index_is_flat(main.model.index)
+        assert main.model.index.ntotal == 260
+        assert search_parameters() == {"nprobe": 3} or search_parameters() == {"efSearch": 48}
+        _, found = main.search_index(embeddings[10:20], 1)
+        assert found[:, 0].tolist() == ids[10:20]
+        monkeypatch.undo()
+        app_startup()
+
+    def test_shared_index(self, tmp_path, monkeypatch) -> None:
+        monkeypatch.setattr(main.settings, "index_shared", True)
+        monkeypatch.setattr(main.settings, "index_snapshot_dir", str(tmp_path))
+        monkeypatch.setattr(main.settings, "index_snapshot_interval", 0)
+        # Sync by hand, rather than in the background.
+        monkeypatch.setattr(main.settings, "index_sync_interval", 3600)
+        # Another process holds the writer lock, so this one only reads the index.
+        writer = WriterLock(tmp_path / "writer.lock")
+        assert writer.acquire()
+        app_startup()
+        assert not main.is_writer()
+        embedding_dim = main.model.model.config.hidden_size
+        embeddings = np.random.rand(4, embedding_dim).astype("float32")
+
+        # Vectors added by a reader are searchable right away, and passed on through the spool
+        main.add_to_index([1, 2], embeddings[:2])
+        _, ids = main.search_index(embeddings[:1], 10)
+        assert ids[0][0] == 1 and main.model.overlay.ntotal == 2
+        assert len(Spool(tmp_path / "spool").names()) == 1
+
+        # Readers memory-map the writer's snapshots as they are written
+        index = setup_faiss_index(embedding_dim)
+        add_to_faiss_index([1, 2, 3], embeddings[:3], index)
+        save_faiss_index(index, tmp_path, main.index_fingerprint())
+        main.sync_index()
+        assert main.model.overlay is None and main.model.indexed_ids == {1, 2, 3}
+        assert np.allclose(main.score_documents(embeddings[2:3], [3]), 1, atol=1e-4)
+
+        # If the writer exits, a reader takes over
+        writer.release()
+        main.add_to_index([4], embeddings[3:4])
+        main.sync_index()
+        assert main.is_writer() and main.model.overlay is None
+        assert main.model.index.ntotal == 4
+        main.app_shutdown()
+        monkeypatch.undo()
+        app_startup()
+
+    def test_sharded_index(self, monkeypatch) -> None:
+        # Start two shard servers, on free ports
+        ports = []
+        for _ in range(2):
+            with socket.socket() as sock:
+                sock.bind(("127.0.0.1", 0))
+                ports.append(sock.getsockname()[1])
+        env = {
+            **os.environ,
+            "INDEX_SHARD": "true",
+            "PRETRAINED_MODEL_NAME_OR_PATH": main.settings.pretrained_model_name_or_path,
+        }
+        processes = [
+            subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "semantic_search.main:app", "--port", str(port)],
+                env=env,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            for port in ports
+        ]
+        urls = [f"http://127.0.0.1:{port}" for port in ports]
+        try:
+            deadline = time.monotonic() + 60
+            while time.monotonic() < deadline:
+                try:
+                    ShardedIndex(urls, embedding_dim=1).ids()
+                    break
+                except Exception:
+                    time.sleep(0.1)
+            monkeypatch.setattr(main.settings, "index_shards", urls)
+            app_startup()
+            embedding_dim = main.model.config.hidden_size
+            embeddings = np.random.rand(20, embedding_dim).astype("float32")
+            main.add_to_index(list(range(20)), embeddings)
+
+            # Shards only serve the /shard endpoints
+            request = {"query": {"uid": "1", "text": "Sharded."}, "documents": []}
+            assert requests.post(f"{urls[0]}/search", json=request).status_code == 409
+
+            # Each document is added to exactly one shard
+            shard_ids = [ShardedIndex([url], embedding_dim).ids() for url in urls]
+            assert all(shard_ids) and not shard_ids[0] & shard_ids[1]
+            assert shard_ids[0] | shard_ids[1] == set(range(20))
+
+            # Results match those of a single index holding every document
+            index = setup_faiss_index(embedding_dim)
+            add_to_faiss_index(list(range(20)), embeddings, index)
+            expected_scores, expected_ids = index.search(embeddings[:3], 5)
+            scores, ids = main.search_index(embeddings[:3], 5)
+            assert np.array_equal(ids, expected_ids)
+            assert np.allclose(scores, expected_scores, atol=1e-5)
+            assert np.allclose(
+                main.get_indexed_embeddings([3, 17]),
+                reconstruct_from_faiss_index(index, [3, 17]),
+                atol=1e-5,
+            )
+
+            # The coordinator learns which documents are indexed from the shards at startup
+            app_startup()
+            assert main.model.indexed_ids == set(range(20))
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+        monkeypatch.undo()
+        app_startup()
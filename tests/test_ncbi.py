@@ -1,12 +1,21 @@
+import io
+import time
+
 import pytest
+import requests  # type: ignore
 import types
+import urllib3
 from fastapi.exceptions import HTTPException
 
+from semantic_search import ncbi
 from semantic_search.ncbi import (
+    FetchError,
+    _RateLimiter,
     _medline_to_docs,
     _safe_request,
     _parse_medline,
     _get_eutil_records,
+    iter_uids_to_docs,
     uids_to_docs,
     Settings,
 )
@@ -21,6 +30,15 @@ def test_invalid_uid_test():
         _medline_to_docs(records)
 
 
+def test_skip_invalid_uid_test():
+    records = [
+        {"id:": ["93846392868"]},
+        {"PMID": "9887103", "TI": "A title.", "AB": "An abstract."},
+    ]
+    expected = [{"uid": "9887103", "text": "A title. An abstract."}]
+    assert _medline_to_docs(records, skip_invalid=True) == expected
+
+
 def test_safe_request():
     eutils_params = {
         "db": "pubmed",
@@ -33,6 +51,51 @@ def test_safe_request():
     assert _safe_request(url, "POST", files=eutils_params).status_code == 200
 
 
+def test_safe_request_retries(monkeypatch):
+    statuses = [503, 429, 200]
+    responses = []
+
+    def request(*args, **kwargs):
+        response = requests.Response()
+        response.status_code = statuses.pop(0)
+        response.raw = io.BytesIO(b"")
+        responses.append(response)
+        return response
+
+    monkeypatch.setattr(ncbi._session, "request", request)
+    monkeypatch.setattr(ncbi.settings, "http_backoff_factor", 0)
+    assert _safe_request("https://example.com").status_code == 200
+    assert not statuses
+    # Failed responses are closed, releasing their connections, before retrying
+    assert [response.raw.closed for response in responses] == [True, True, False]
+
+
+def test_safe_request_does_not_retry_client_errors(monkeypatch):
+    statuses = [404, 200]
+    responses = []
+
+    def request(*args, **kwargs):
+        response = requests.Response()
+        response.status_code = statuses.pop(0)
+        response.raw = io.BytesIO(b"")
+        responses.append(response)
+        return response
+
+    monkeypatch.setattr(ncbi._session, "request", request)
+    with pytest.raises(requests.exceptions.HTTPError):
+        _safe_request("https://example.com")
+    assert responses[0].raw.closed
+
+
+def test_rate_limiter():
+    rate_limiter = _RateLimiter(rate=50, burst=2)
+    start = time.monotonic()
+    for _ in range(7):
+        rate_limiter.acquire()
+    # The first 2 calls are a burst, the following 5 are limited to 50 per second.
+    assert time.monotonic() - start >= 0.1
+
+
 def test_get_eutil_records():
     eutil = "efetch"
     _id = "9887103"
@@ -483,3 +546,24 @@ def test_uids_to_docs():
     actual = uids_to_docs(uids)
     assert isinstance(actual, types.GeneratorType)
     assert list(actual) == expected
+
+
+def test_iter_uids_to_docs_when_the_stream_breaks(monkeypatch):
+    class BrokenStream(io.BytesIO):
+        def stream(self, chunk_size, decode_content=True):
+            yield b"PMID- 1\nTI  - A title.\n\nPMID- 2\nTI  - A tit"
+            raise urllib3.exceptions.ProtocolError("Connection broken")
+
+    def request(*args, **kwargs):
+        response = requests.Response()
+        response.status_code = 200
+        response.raw = BrokenStream()
+        return response
+
+    monkeypatch.setattr(ncbi._session, "request", request)
+    docs = iter_uids_to_docs(["1", "2", "3"])
+    # Documents received before the connection dropped are kept, but the rest of the batch isn't
+    # silently skipped, as if they were bogus uids
+    assert next(docs) == {"uid": "1", "text": "A title."}
+    with pytest.raises(FetchError):
+        next(docs)
@@ -0,0 +1,28 @@
+import numpy as np
+
+from semantic_search.common.sharing import Spool, WriterLock
+
+
+def test_writer_lock(tmp_path) -> None:
+    writer, reader = WriterLock(tmp_path / "writer.lock"), WriterLock(tmp_path / "writer.lock")
+    assert writer.acquire() and writer.held
+    # Only one holder at a time
+    assert not reader.acquire() and not reader.held
+    # Once the writer lets go, another can take over
+    writer.release()
+    assert reader.acquire() and not writer.held
+
+
+def test_spool(tmp_path) -> None:
+    spool = Spool(tmp_path / "spool")
+    vectors = np.random.rand(3, 4).astype("float32")
+    first = spool.write([1, 2], vectors[:2])
+    second = Spool(tmp_path / "spool").write([3], vectors[2:])
+    # Deltas are listed oldest first, and never partially written
+    assert spool.names() == [first, second]
+    ids, delta_vectors = spool.read(first)  # type: ignore
+    assert ids.tolist() == [1, 2] and np.array_equal(delta_vectors, vectors[:2])
+
+    spool.remove([first])
+    assert spool.names() == [second]
+    assert spool.read(first) is None